@@ -1,69 +1,95 @@
-from fastapi import FastAPI, Request, WebSocket
-from fastapi.responses import JSONResponse, Response, HTMLResponse, RedirectResponse, FileResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, HTMLResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-from sse_starlette.sse import EventSourceResponse
-from typing import Dict, List
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 import uuid
+import os
 import asyncio
-from collections import defaultdict, deque
-import json
 from fastapi.logger import logger
 import logging
-from pywebpush import webpush, WebPushException
-import random
-import ssl
+from push import PushDispatcher, SubscriptionRegistry
 import hashlib
+import hmac
+import ipaddress
 from OpenSSL import SSL
 from datetime import datetime
-from starlette.middleware.base import BaseHTTPMiddleware
+from contextlib import asynccontextmanager
+from session_store import create_session_store, resume_point, wait_any
+from events import AUTH_COMPLETE, AUTH_FAILED, CLEANUP_SESSION, EventBus, SSEChannel, SSEResponse, WebSocketChannel, encode_batch, encode_sessions
+from broker import create_broker
+from expiry import ExpiryReaper
+import metrics
+from logging_config import configure_logging
+from middleware import RequestLoggingMiddleware
+from render_cache import TemplateCache, etag_matches
+from webhooks import WebhookDispatcher, check_callback_url, create_outbox
+from drain import Drainer
+from serialization import JSONResponse, dumps, loads
+from ratelimit import limiter_from_env, retry_after, retry_after_header
+from assets import AssetFiles, build_assets
+import wire
+from challenges import ChallengeGenerator
+from models import (BatchPollRequest, GeneratedPinResponse, GeneratePinRequest, MobileMessage, PinGuess,
+                    PinOptionsResponse, PinUpdate, PushRegistration, SessionResponse, StepUpRequest, Username,
+                    UsernameRequest, VerificationResponse, VerifiedResponse, describe_errors)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Render the static page variants before the first request needs them
+    pages.warm()
+    # Evict expired sessions, step-ups and polling queues in the background
+    reaper.start()
+    # Exchange events with other workers (no-op for the in-process broker)
+    await broker.start()
+    loop_lag.start()
+    # Send step-up results to relying parties' callback URLs
+    webhook_dispatcher.start()
+    # Drain SSE/WebSocket clients as soon as shutdown begins (see drain.py)
+    drainer.start()
+    yield
+    await drainer.stop()
+    await webhook_dispatcher.stop()
+    await loop_lag.stop()
+    await broker.stop()
+    await reaper.stop()
+    # Flush the session journal, if there is one
+    sessions.close()
+    push_dispatcher.close()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+# Every route encodes through serialization.JSONResponse (orjson when available)
+app = FastAPI(lifespan=lifespan, default_response_class=JSONResponse)
 
-class LoggingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        # Log request
-        logger.info(f"Request: {request.method} {request.url}")
-        
-        # Log request body for POST/PUT requests
-        if request.method in ["POST", "PUT"]:
-            try:
-                body = await request.body()
-                if body:
-                    try:
-                        # Try to parse as JSON
-                        json_body = json.loads(body)
-                        logger.info(f"  {json.dumps(json_body, indent=2)}")
-                    except:
-                        # If not JSON, log as string
-                        logger.info(f"  {body.decode()}")
-            except Exception as e:
-                logger.error(f"Error reading request body: {e}")
-        
-        # Process request and get response
-        response = await call_next(request)
-        
-        # Log response
-        logger.info(f"Response: {response.status_code}")
-        
-        return response
+@app.exception_handler(RequestValidationError)
+async def invalid_request(request: Request, exc: RequestValidationError):
+    """Malformed bodies and parameters get the same 400 {"error": ...} as the handlers' own checks"""
+    return JSONResponse(
+        status_code=400,
+        content={"error": describe_errors(exc.errors())}
+    )
 
-# Add logging middleware
-app.add_middleware(LoggingMiddleware)
+# Log through a background writer thread (see logging_config.py)
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# Request logging, timing and X-Request-ID (pure ASGI, so SSE streams pass straight through)
+app.add_middleware(RequestLoggingMiddleware)
 
-# Mount static files directory
-app.mount("/static", StaticFiles(directory="v2/static", html=True), name="static")
+# Fingerprinted, pre-compressed static assets (see assets.py); the originals stay reachable
+STATIC_DIR = "v2/static"
+ASSET_BUILD_DIR = os.environ.get("STRONGHOLD_ASSET_BUILD_DIR", "build/static")
+assets = build_assets(STATIC_DIR, ASSET_BUILD_DIR)
+app.mount("/static", AssetFiles(STATIC_DIR, ASSET_BUILD_DIR, assets), name="static")
 
-# Setup templates
-templates = Jinja2Templates(directory="v2/templates")
+# Rendered HTML pages, cached with ETags (see render_cache.py)
+pages = TemplateCache("v2/templates")
+pages.env.globals["asset"] = assets.url
+INDEX_PAGE = pages.page("index.html", continue_action="startSession()", show_footer=False)
+MOBILE_PAGE = pages.page("mobile.html", continue_action="mobileStepUp.startSession()", show_footer=True)
+WEBAUTHN_PAGE = pages.page("webauthn.html")
+SAMPLE_PAGE = pages.page("sample-integration.html", show_footer=False)
+PAYMENT_PAGE = pages.page("payment.html", show_footer=False)
+DASHBOARD_PAGE = pages.page("dashboard.html", show_footer=False)
 
 # Define allowed origins
 ALLOWED_ORIGINS = [
@@ -84,18 +110,16 @@ app.add_middleware(
     allow_origin_regex=".*"  # Allow all origins for iframe support
 )
 
-# Store active SSE connections
-CONNECTIONS: Dict[str, asyncio.Queue] = defaultdict(asyncio.Queue)
-
-# Store WebSocket connections
-WS_CONNECTIONS: Dict[str, WebSocket] = {}
+# Behind a reverse proxy, take the client address (used for per-IP rate limits and
+# the logs) from X-Forwarded-For, but only when the request came from one of these
+# (comma-separated IPs or CIDRs). uvicorn's --forwarded-allow-ips does the same.
+TRUSTED_PROXIES = [host.strip() for host in os.environ.get("STRONGHOLD_TRUSTED_PROXIES", "").split(",")
+                   if host.strip()]
+if TRUSTED_PROXIES:
+    app.add_middleware(ProxyHeadersMiddleware, trusted_hosts=TRUSTED_PROXIES)
 
-# Store subscriptions (in a real app, use a database)
-push_subscriptions = {}
-
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Push subscriptions, indexed by endpoint, username and session
+push_subscriptions = SubscriptionRegistry()
 
 # Add these constants at the top
 VAPID_PRIVATE_KEY = "your_generated_private_key"
@@ -104,249 +128,483 @@ VAPID_CLAIMS = {
     "sub": "mailto:gavin@gbag.co.uk"
 }
 
-# Add this with other global variables
-POLLING_EVENTS = defaultdict(lambda: deque(maxlen=100))
-
-# Add a mapping dictionary for step-up IDs to client IDs
-STEP_UP_TO_CLIENT = {}
-
 # Add at the top with other global variables
 CURRENT_PIN = None
 
-# Add to the global variables at the top
-pins = {}  # Store PINs by client_id
-step_up_pins = {}  # Store PINs by step_up_id
+# SSE keepalive ping interval, and how long a stalled write may take before the
+# client is treated as gone (seconds)
+SSE_PING_INTERVAL = float(os.environ.get("STRONGHOLD_SSE_PING_INTERVAL", 15))
+SSE_SEND_TIMEOUT = float(os.environ.get("STRONGHOLD_SSE_SEND_TIMEOUT", 30))
+
+# Upper bound for how long /poll-updates holds a long-poll request open (seconds)
+LONG_POLL_MAX_WAIT = float(os.environ.get("STRONGHOLD_LONG_POLL_MAX_WAIT", 30))
+# How long a drain waits for connections to go, and the window clients are told to reconnect in (ms)
+DRAIN_TIMEOUT = float(os.environ.get("STRONGHOLD_DRAIN_TIMEOUT", 10))
+RECONNECT_MIN = int(os.environ.get("STRONGHOLD_RECONNECT_MIN_MS", 1000))
+RECONNECT_MAX = int(os.environ.get("STRONGHOLD_RECONNECT_MAX_MS", 10000))
+drainer = Drainer(DRAIN_TIMEOUT, RECONNECT_MIN, RECONNECT_MAX)
+# Bearer token for /admin/*; without one only loopback clients may call them
+ADMIN_TOKEN = os.environ.get("STRONGHOLD_ADMIN_TOKEN", "").encode()
+
+# permessage-deflate on WebSockets (uvicorn's default; `--ws-per-message-deflate false` turns it off)
+WS_PER_MESSAGE_DEFLATE = os.environ.get("STRONGHOLD_WS_PER_MESSAGE_DEFLATE", "on") != "off"
+
+# Most sessions one batched POST /poll-updates may ask for
+BATCH_POLL_MAX_SESSIONS = int(os.environ.get("STRONGHOLD_BATCH_POLL_MAX_SESSIONS", 500))
+
+# PINs and the option sets the mobile picks from, drawn from the OS CSPRNG
+PIN_LENGTH = int(os.environ.get("STRONGHOLD_PIN_LENGTH", 2))
+PIN_OPTIONS = int(os.environ.get("STRONGHOLD_PIN_OPTIONS", 3))
+MOBILE_PIN_LENGTH = int(os.environ.get("STRONGHOLD_MOBILE_PIN_LENGTH", 5))
+challenges = ChallengeGenerator(PIN_LENGTH, PIN_OPTIONS)
+
+# Sessions, PINs, step-up mappings, WebSockets and polling queues, all with TTLs
+reaper = ExpiryReaper()
+sessions = create_session_store(reaper=reaper)
+
+# Fans events out to SSE, WebSocket and polling channels. Set STRONGHOLD_BROKER
+# (and STRONGHOLD_SESSION_STORE) to a shared sqlite:/// file to run several workers.
+broker = create_broker()
+bus = EventBus(sessions, broker)
+
+# Metrics served on /metrics; hot paths hold on to pre-allocated samples
+CONNECTIONS = metrics.Gauge("stronghold_sse_connections", "Open SSE connections")
+WS_CONNECTIONS = metrics.Gauge("stronghold_websocket_connections", "Open WebSocket connections")
+POLLING_EVENTS = metrics.Gauge("stronghold_polling_queued_events", "Events waiting in polling queues",
+                               function=sessions.queued_events)
+ACTIVE_SESSIONS = metrics.Gauge("stronghold_active_sessions", "Sessions held by this worker's store",
+                                function=lambda: len(sessions))
+PIN_VERIFICATIONS = metrics.Counter("stronghold_pin_verifications_total", "PIN checks by result",
+                                    labelnames=("result",))
+PIN_SUCCESS = PIN_VERIFICATIONS.labels("success")
+PIN_FAILURE = PIN_VERIFICATIONS.labels("failure")
+STEP_UP_LATENCY = metrics.Histogram("stronghold_step_up_duration_seconds",
+                                    "Time from step-up initiation to auth_complete")
+step_up_timer = metrics.LatencyTracker(STEP_UP_LATENCY)
+loop_lag = metrics.LoopLagMonitor()
+
+# Server-to-server step-ups report their result to a signed callback (see webhooks.py)
+WEBHOOK_SECRET = os.environ.get("STRONGHOLD_WEBHOOK_SECRET", "").encode()
+if not WEBHOOK_SECRET:
+    WEBHOOK_SECRET = os.urandom(32)
+    logger.warning("STRONGHOLD_WEBHOOK_SECRET is not set; webhooks are signed with a throwaway key")
+webhook_dispatcher = WebhookDispatcher(create_outbox(), WEBHOOK_SECRET)
+# Relying parties authenticate to /api/step-ups with "Authorization: Bearer <key>"
+API_KEYS = [key.strip().encode() for key in os.environ.get("STRONGHOLD_API_KEYS", "").split(",") if key.strip()]
+if not API_KEYS:
+    logger.warning("STRONGHOLD_API_KEYS is not set; /api/step-ups will refuse every request")
+
+def bearer_token_valid(request, tokens):
+    """Whether the request's "Authorization: Bearer" token is one of `tokens`"""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    token = token.strip().encode()
+    # Compare against every token so the time taken doesn't say which one was close
+    return sum(hmac.compare_digest(token, candidate) for candidate in tokens) > 0
+
+def admin_allowed(request):
+    """STRONGHOLD_ADMIN_TOKEN if one is set, otherwise a client on this host"""
+    if ADMIN_TOKEN:
+        return bearer_token_valid(request, [ADMIN_TOKEN])
+    host = request.client.host if request.client else None
+    try:
+        return host is not None and ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def admin_denied():
+    return JSONResponse(
+        status_code=403,
+        content={"error": "Admin access required"},
+        headers={"WWW-Authenticate": "Bearer"}
+    )
+
+def notify_webhook(session_id, event_type):
+    """Queue a signed callback if the step-up was created through the API"""
+    # Kept on the session record, so any worker sharing the store can send it
+    record = sessions.get(session_id)
+    if record is None or record.callback_url is None:
+        return None
+    return webhook_dispatcher.enqueue(record.callback_url, {
+        "id": uuid.uuid4().hex,
+        "type": event_type,
+        "session_id": session_id,
+        "username": record.username,
+        "created": int(datetime.now().timestamp()),
+    })
+
+# Token buckets for the session and PIN endpoints, as "RATE/BURST" per second
+RATE_LIMITS = os.environ.get("STRONGHOLD_RATE_LIMITS", "on").lower() not in ("0", "off", "false", "no")
+# ("0" or "off" turns one off); the per-IP key is the client address after STRONGHOLD_TRUSTED_PROXIES
+ip_limiter = limiter_from_env("STRONGHOLD_IP_RATE_LIMIT", "20/100", "ip")
+username_limiter = limiter_from_env("STRONGHOLD_USERNAME_RATE_LIMIT", "1/10", "username")
+# PIN guesses per session: a handful straight away, then one every five seconds
+session_limiter = limiter_from_env("STRONGHOLD_SESSION_RATE_LIMIT", "0.2/5", "session")
+websocket_limiter = limiter_from_env("STRONGHOLD_WEBSOCKET_RATE_LIMIT", "5/20", "websocket")
+
+def throttle(request, endpoint, username=None, session_id=None):
+    """A 429 response if the caller is over its per-IP, username or session limit, else None"""
+    if not RATE_LIMITS:
+        return None
+    host = request.client.host if request.client else None
+    wait = retry_after(
+        (ip_limiter, (endpoint, host) if host else None),
+        (username_limiter, (endpoint, username) if isinstance(username, str) else None),
+        (session_limiter, (endpoint, session_id) if isinstance(session_id, str) else None),
+    )
+    if not wait:
+        return None
+    logger.warning("Rate limited %s from %s", endpoint, host)
+    return JSONResponse(
+        status_code=429,
+        content={"error": "Too many requests"},
+        headers={"Retry-After": retry_after_header(wait)}
+    )
 
-# Add to global variables
-active_sessions = {}  # Store username -> session_id mapping
-session_pins = {}    # Store session_id -> PIN mapping
+def publish_auth_complete(session_id):
+    """Tell the browser (and any callback) the step-up succeeded and record how long it took"""
+    step_up_timer.stop(session_id)
+    notify_webhook(session_id, "auth_complete")
+    sessions.set_callback_url(session_id, None)
+    return bus.publish(session_id, AUTH_COMPLETE)
+
+def publish_auth_failed(session_id):
+    """Tell the browser (and any callback) the PIN was wrong"""
+    notify_webhook(session_id, "auth_failed")
+    return bus.publish(session_id, AUTH_FAILED)
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     """Serve main page"""
-    return templates.TemplateResponse("index.html", {
-        "request": request,
-        "continue_action": "startSession()",
-        "show_footer": False
-    })
+    return INDEX_PAGE.response(request)
 
 @app.get("/mobile", response_class=HTMLResponse)
 async def mobile(request: Request):
     """Serve mobile page"""
-    return templates.TemplateResponse("mobile.html", {
-        "request": request,
-        "continue_action": "mobileStepUp.startSession()",
-        "show_footer": True
-    })
+    return MOBILE_PAGE.response(request)
 
 @app.get("/webauthn", response_class=HTMLResponse)
 async def mobile(request: Request):
     """Serve webauthn page"""
-    return templates.TemplateResponse("webauthn.html", {"request": request})
+    return WEBAUTHN_PAGE.response(request)
 
 
 @app.get("/register-sse")
-async def register_sse(request: Request):
+async def register_sse(request: Request, session_id: str = None):
     """
     Endpoint for registering SSE connections.
     Returns a client_id that should be used for future requests.
+    With `session_id` the stream follows an existing session's events instead.
+    Every event carries an id of "<client_id>:<seq>", so a browser that
+    reconnects with Last-Event-ID gets the events it missed replayed.
     """
-    client_id = str(uuid.uuid4())
+    if drainer.draining:
+        # Shutting down: the browser retries and lands on another worker
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Server is restarting"},
+            headers={"Retry-After": str(max(RECONNECT_MIN // 1000, 1))}
+        )
+    resume_id, _, resume_seq = request.headers.get("last-event-id", "").rpartition(":")
+    if session_id in sessions:
+        client_id = session_id
+    elif resume_id and resume_id in sessions:
+        client_id = resume_id
+    else:
+        client_id = str(uuid.uuid4())
+        # A record (with the session TTL) gives the stream a replay log
+        sessions.ensure(client_id)
     
     # Log connection attempt
-    logger.info(f"🔄 SSE connection attempt from {request.client.host}")
-    logger.info(f"📡 Request headers: {request.headers}")
+    logger.debug("🔄 SSE connection attempt from %s", request.client.host)
+    
+    # Attach the channel immediately so no events are missed
+    channel = SSEChannel()
+    sessions.attach(client_id, channel)
+    drainer.track(channel)
+    CONNECTIONS.inc()
+    logger.debug("✅ Created new connection for client: %s", client_id)
     
-    # Create the queue immediately
-    CONNECTIONS[client_id] = asyncio.Queue()
-    logger.info(f"✅ Created new connection for client: {client_id}")
+    # Events published before this point that the browser hasn't seen
+    missed = []
+    if resume_id == client_id and resume_seq.isdigit():
+        missed = sessions.events(client_id).since(resume_point(int(resume_seq)))
+    replayed_through = missed[-1][0] if missed else 0
     
     async def event_generator():
         try:
             # Send initial message with client ID
-            logger.info(f"📤 Sending initial client ID message to {client_id}")
+            logger.debug("📤 Sending initial client ID message to %s", client_id)
             yield {
-                "data": json.dumps({"client_id": client_id})
+                "data": dumps({"client_id": client_id}).decode()
             }
             
+            for seq, payload in missed:
+                event = loads(payload)
+                yield {
+                    "id": f"{client_id}:{seq}",
+                    "event": event["type"],
+                    "data": payload.decode()
+                }
+            
             while True:
-                message = await CONNECTIONS[client_id].get()
-                logger.info(f"📤 Sending message to client {client_id}: {message}")
-                if message.get("type") == "close":
+                entry = await channel.get()
+                if entry is None:
                     break
-                data = json.dumps(message["data"])
+                seq, event = entry
+                if seq <= replayed_through:
+                    continue  # already replayed from the log
+                logger.debug("📤 Sending %s to client %s", event.type, client_id)
                 yield {
-                    "event": message["event"],
-                    "data": data
+                    "id": f"{client_id}:{seq}",
+                    "event": event.type,
+                    "data": event.text
+                }
+            
+            if channel.reconnect_after is not None:
+                # Draining: everything queued went out above; spread the reconnects
+                yield {
+                    "event": "reconnect",
+                    "retry": channel.reconnect_after,
+                    "data": dumps({"type": "reconnect", "data": {"retry": channel.reconnect_after}}).decode()
                 }
         except asyncio.CancelledError:
-            logger.error(f"❌ SSE connection cancelled for client: {client_id}")
+            logger.debug("SSE connection closed by client: %s", client_id)
         except Exception as e:
-            logger.error(f"❌ Error in SSE connection: {str(e)}")
+            logger.error("❌ Error in SSE connection: %s", e)
         finally:
-            CONNECTIONS.pop(client_id, None)
-            logger.info(f"👋 Cleaned up connection for client: {client_id}")
+            sessions.detach(client_id, channel)
+            drainer.untrack(channel)
+            CONNECTIONS.dec()
+            logger.debug("👋 Cleaned up connection for client: %s", client_id)
 
-    return EventSourceResponse(event_generator())
-
-@app.post("/initiate-step-up/{client_id}")
-async def initiate_step_up(client_id: str):
-    """Initiate a step-up for a client"""
-    logger.info(f"🔄 Initiating step-up for client: {client_id}")
-    
-    step_up_id = str(uuid.uuid4())
-    
-    # Store the mapping
-    STEP_UP_TO_CLIENT[step_up_id] = client_id
-    logger.info(f"🔗 Mapped step_up_id {step_up_id} to client_id {client_id}")
-    
-    # Create event with consistent format for both SSE and polling
-    event = {
-        "type": "step_up_initiated",
-        "data": step_up_id
-    }
-    
-    # Store for both SSE and polling
-    if client_id in CONNECTIONS:
-        logger.info(f"📤 Sending via SSE to client: {client_id}")
-        await CONNECTIONS[client_id].put({
-            "event": "step_up_initiated",
-            "data": step_up_id
-        })
-    
-    logger.info(f"📤 Adding event to polling queue for client: {client_id}")
-    POLLING_EVENTS[client_id].append(event)
-    
-    return {"status": "success", "step_up_id": step_up_id}
+    # The grace period keeps the stream alive on shutdown while the drain flushes it
+    return SSEResponse(event_generator(), ping=SSE_PING_INTERVAL, send_timeout=SSE_SEND_TIMEOUT,
+                       shutdown_grace_period=DRAIN_TIMEOUT)
 
+# Declared before /initiate-step-up/{client_id}, which would otherwise match it
 @app.post("/initiate-step-up/mobile-pin")
-async def initiate_mobile_pin_step_up():
+async def initiate_mobile_pin_step_up(request: Request):
     """Initiate a step-up for mobile PIN verification"""
     try:
+        limited = throttle(request, "mobile-pin")
+        if limited is not None:
+            return limited
         step_up_id = str(uuid.uuid4())
         client_id = str(uuid.uuid4())
-        STEP_UP_TO_CLIENT[step_up_id] = client_id
         
         # Generate a PIN for this step-up
-        pin = str(random.randint(10000, 99999))
-        step_up_pins[step_up_id] = pin
-        logger.info(f"Generated PIN {pin} for step_up_id {step_up_id}")
+        pin = challenges.pin(MOBILE_PIN_LENGTH)
+        sessions.add_step_up(client_id, step_up_id, pin)
+        logger.debug("Generated PIN for step_up_id %s", step_up_id)
         
         return {
             "step_up_id": step_up_id,
             "pin": pin
         }
     except Exception as e:
-        logger.error(f"Error initiating mobile PIN step-up: {str(e)}")
+        logger.error("Error initiating mobile PIN step-up: %s", e)
         return JSONResponse(
             status_code=500,
             content={"error": str(e)}
         )
 
+@app.post("/initiate-step-up/{client_id}")
+async def initiate_step_up(client_id: str):
+    """Initiate a step-up for a client"""
+    logger.debug("🔄 Initiating step-up for client: %s", client_id)
+    
+    step_up_id = str(uuid.uuid4())
+    
+    # Store the mapping
+    sessions.add_step_up(client_id, step_up_id)
+    step_up_timer.start(client_id)
+    logger.debug("🔗 Mapped step_up_id %s to client_id %s", step_up_id, client_id)
+    
+    # Deliver to SSE and polling clients
+    bus.publish(client_id, {
+        "type": "step_up_initiated",
+        "data": step_up_id
+    })
+    
+    return {"status": "success", "step_up_id": step_up_id}
+
 @app.post("/complete-step-up/{client_id}")
 async def complete_step_up(client_id: str):
     """
     Endpoint to mark a step-up as complete.
     Sends completion event through SSE.
     """
-    if client_id not in CONNECTIONS:
+    if not bus.has_subscribers(client_id):
         return JSONResponse(
             status_code=404,
             content={"error": "Client connection not found"}
         )
 
     # Send step-up completed event
-    await CONNECTIONS[client_id].put({
-        "event": "step_up_completed",
-        "data": "{}"
+    bus.publish(client_id, {
+        "type": "step_up_completed",
+        "data": {}
     })
 
     # Close the connection
-    await CONNECTIONS[client_id].put({"type": "close"})
+    bus.close(client_id, SSEChannel)
 
     return {"status": "success"}
 
+async def receive_ws_message(websocket: WebSocket) -> dict:
+    """Next client message: a JSON text frame, or a MessagePack binary frame (see wire.py)"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    if message.get("bytes") is not None:
+        return wire.decode_message(message["bytes"])
+    return loads(message["text"])
+
 @app.websocket("/ws/{step_up_id}")
 async def websocket_endpoint(websocket: WebSocket, step_up_id: str):
     try:
-        await websocket.accept()
-        logger.info(f"✅ WebSocket connection accepted for step_up_id: {step_up_id}")
+        if drainer.draining:
+            # 1012: service restart; the client reconnects to another worker
+            await websocket.close(code=1012)
+            return
+        # Binary MessagePack frames for clients that ask (subprotocol or ?encoding=msgpack)
+        encoding, subprotocol = wire.negotiate(websocket.scope.get("subprotocols"),
+                                               websocket.query_params.get("encoding"))
+        await websocket.accept(subprotocol=subprotocol)
+        logger.debug("✅ WebSocket connection accepted for step_up_id: %s (%s)", step_up_id, encoding)
         
-        # Store the connection
-        WS_CONNECTIONS[step_up_id] = websocket
+        # Attach the connection; events are written by the channel's pump task
+        channel = WebSocketChannel(websocket, encoding=encoding)
+        sessions.attach(step_up_id, channel)
+        drainer.track(channel)
+        WS_CONNECTIONS.inc()
+        writer = asyncio.create_task(channel.pump())
         
         try:
+            host = websocket.client.host if websocket.client else None
             while True:
-                message = await websocket.receive_json()
-                logger.info(f"📩 Received message: {message}")
+                message = await receive_ws_message(websocket)
+                if RATE_LIMITS and websocket_limiter is not None and not websocket_limiter.allow((step_up_id, host)):
+                    # 1008: policy violation
+                    logger.warning("WebSocket message rate exceeded for step_up_id: %s", step_up_id)
+                    await websocket.close(code=1008)
+                    break
+                logger.debug("📩 Received message: %s", message)
                 
                 if message.get('type') == 'auth_complete':
                     # Get the client_id from the mapping
-                    client_id = STEP_UP_TO_CLIENT.get(step_up_id)
-                    logger.info(f"Found client_id {client_id} for step_up_id {step_up_id}")
+                    client_id = sessions.session_for_step_up(step_up_id)
+                    logger.debug("Found client_id %s for step_up_id %s", client_id, step_up_id)
                     
                     if client_id:
-                        # Send via SSE if available
-                        if client_id in CONNECTIONS:
-                            logger.info(f"Sending auth_complete via SSE to client: {client_id}")
-                            await CONNECTIONS[client_id].put({
-                                "event": "auth_complete",
-                                "data": "{}"
-                            })
-                        
-                        # Also add to polling queue
-                        logger.info(f"Adding auth_complete to polling queue for client: {client_id}")
-                        POLLING_EVENTS[client_id].append({
-                            "type": "auth_complete",
-                            "data": None
-                        })
+                        publish_auth_complete(client_id)
                     else:
-                        logger.error(f"No client_id found for step_up_id: {step_up_id}")
+                        logger.error("No client_id found for step_up_id: %s", step_up_id)
                 
         except WebSocketDisconnect:
-            logger.info(f"👋 WebSocket connection closed for step_up_id: {step_up_id}")
-            if step_up_id in WS_CONNECTIONS:
-                del WS_CONNECTIONS[step_up_id]
+            logger.debug("👋 WebSocket connection closed for step_up_id: %s", step_up_id)
         except Exception as e:
-            logger.error(f"❌ Error processing WebSocket message: {str(e)}")
-            # Don't close the connection on error
-            pass
+            logger.error("❌ Error processing WebSocket message: %s", e)
+        finally:
+            sessions.detach(step_up_id, channel)
+            WS_CONNECTIONS.dec()
+            if channel.reconnect_after is not None:
+                # Draining: let the pump flush and send the reconnect hint
+                await writer
+            channel.close()
+            writer.cancel()
+            drainer.untrack(channel)
             
     except Exception as e:
-        logger.error(f"❌ Error in WebSocket connection: {e}")
+        logger.error("❌ Error in WebSocket connection: %s", e)
         raise
 
-@app.route('/register-push', methods=['POST'])
-def register_push():
-    subscription_info = request.json
-    push_subscriptions[subscription_info.get('endpoint')] = subscription_info
-    return jsonify({'status': 'success'})
-
-def send_push_notification(message):
-    for subscription in push_subscriptions.values():
-        try:
-            webpush(
-                subscription_info=subscription,
-                data=message,
-                vapid_private_key=VAPID_PRIVATE_KEY,
-                vapid_claims=VAPID_CLAIMS
+@app.post("/register-push")
+async def register_push(body: PushRegistration):
+    """
+    Register a browser push subscription.
+    Accepts the PushSubscription JSON itself, or {"subscription": ..., "username": ..., "session_id": ...}
+    so step-ups for that user or session can be pushed to the device.
+    """
+    try:
+        subscription_info = body.subscription_info()
+        if not isinstance(subscription_info.get('endpoint'), str) or not subscription_info['endpoint']:
+            return JSONResponse(
+                status_code=400,
+                content={"error": "Subscription endpoint is required"}
             )
-        except WebPushException as e:
-            print("Push notification failed:", e)
+        push_subscriptions.add(subscription_info, body.username, body.session_id)
+        logger.info("Registered push subscription for username: %s", body.username)
+        return {"status": "success"}
+    except Exception as e:
+        logger.error("Error registering push subscription: %s", e)
+        return JSONResponse(
+            status_code=500,
+            content={"error": str(e)}
+        )
+
+def prune_push_subscription(subscription):
+    """Forget a subscription the push service reported as gone"""
+    push_subscriptions.remove(subscription.get('endpoint'))
+
+push_dispatcher = PushDispatcher(VAPID_PRIVATE_KEY, VAPID_CLAIMS, on_gone=prune_push_subscription)
+
+async def send_push_notification(message, session_id=None, username=None):
+    """Push a message to a session's or user's devices (or every device when neither is given)"""
+    if session_id is not None:
+        subscriptions = push_subscriptions.for_session(session_id)
+    elif username is not None:
+        subscriptions = push_subscriptions.for_username(username)
+    else:
+        subscriptions = push_subscriptions.all()
+    results = await push_dispatcher.send_many(subscriptions, message)
+    return sum(results)
 
 @app.post("/test-notification")
-async def test_notification():
-    """Send a test notification to all registered devices"""
+async def test_notification(session_id: str = None, username: str = None):
+    """Send a test notification to a session's or user's devices, or all registered devices"""
     try:
-        send_push_notification("Test notification from Stronghold Step-up!")
-        return {"status": "success"}
+        sent = await send_push_notification("Test notification from Stronghold Step-up!", session_id, username)
+        return {"status": "success", "sent": sent}
     except Exception as e:
-        logger.error(f"Error sending test notification: {e}")
+        logger.error("Error sending test notification: %s", e)
         return JSONResponse(
             status_code=500,
             content={"error": str(e)}
         )
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics for this process"""
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.post("/admin/drain")
+async def drain_connections(request: Request):
+    """
+    Stop taking new SSE/WebSocket connections and send the open ones away
+    with a reconnect hint. For deploy hooks that run before the process is
+    signalled; returns once they are gone or the drain deadline passes.
+    """
+    if not admin_allowed(request):
+        return admin_denied()
+    logger.warning("🚰 Drain requested by %s", request.client.host if request.client else None)
+    remaining = await drainer.drain()
+    return {"status": "drained" if not remaining else "timeout", "remaining": remaining}
+
+@app.delete("/admin/drain")
+async def resume_connections(request: Request):
+    """Undo a drain (e.g. an aborted deploy) and accept SSE/WebSocket connections again"""
+    if not admin_allowed(request):
+        return admin_denied()
+    if not drainer.resume():
+        return JSONResponse(
+            status_code=409,
+            content={"error": "Server is shutting down"}
+        )
+    return {"status": "accepting"}
+
 @app.get("/vapid-public-key")
 async def get_vapid_public_key():
     """Endpoint to get the VAPID public key"""
@@ -356,51 +614,93 @@ async def get_vapid_public_key():
 async def register_polling():
     """Endpoint for registering polling clients"""
     client_id = str(uuid.uuid4())
-    logger.info(f"🔄 Registering polling client: {client_id}")
+    logger.debug("🔄 Registering polling client: %s", client_id)
     # Initialize polling events queue for this client
-    POLLING_EVENTS[client_id] = deque()
+    sessions.ensure(client_id)
+    sessions.reset_events(client_id)
     return {"client_id": client_id}
 
 @app.get("/poll-updates/{client_id}")
-async def poll_updates(client_id: str):
-    """Endpoint for polling updates when SSE is blocked"""
-    logger.info(f"📥 Polling request from client: {client_id}")
-    events = []
-    while POLLING_EVENTS[client_id]:
-        event = POLLING_EVENTS[client_id].popleft()
-        events.append(event)
-        logger.info(f"📤 Sending polled event: {event}")
-    return {"events": events}
+async def poll_updates(client_id: str, wait: float = 0, cursor: int = None):
+    """
+    Endpoint for polling updates when SSE is blocked.
+    With `wait` (seconds) the request is held open until an event is queued
+    or the timeout passes, so clients can long-poll instead of polling on a timer.
+    With `cursor` (the "cursor" of the previous response) only later events are
+    returned and nothing is lost if a response never arrives; without it the
+    server remembers what was already sent.
+    """
+    logger.debug("📥 Polling request from client: %s", client_id)
+    # Unknown IDs get an empty response rather than a new queue
+    queue = sessions.events(client_id, create=client_id in sessions)
+    if queue is None:
+        return {"events": []}
+    if cursor is not None:
+        cursor = resume_point(cursor)
+    if wait > 0:
+        await queue.wait(min(wait, LONG_POLL_MAX_WAIT), cursor)
+    # Events are queued already encoded, so the body is just joined together
+    events, cursor = queue.read(cursor)
+    logger.debug("📤 Sending %s polled events to client: %s", len(events), client_id)
+    return Response(content=encode_batch(events, cursor), media_type="application/json")
+
+@app.post("/poll-updates")
+async def poll_updates_batch(body: BatchPollRequest):
+    """
+    Poll many sessions in one request, for pages and gateways that follow
+    several step-ups at once. The body is
+    {"sessions": {client_id: cursor or null, ...}, "wait": seconds}
+    ("sessions" may also be a plain list of IDs). With `wait` the request is
+    held open until any of the sessions has an event. The response has an
+    {"events", "cursor"} entry per session, as from /poll-updates/{client_id}.
+    """
+    requested = body.sessions
+    if isinstance(requested, list):
+        requested = dict.fromkeys(requested)
+    if len(requested) > BATCH_POLL_MAX_SESSIONS:
+        return JSONResponse(status_code=400,
+                            content={"error": f"At most {BATCH_POLL_MAX_SESSIONS} sessions per request"})
+    wait = body.wait
+
+    logger.debug("📥 Batched polling request for %s sessions", len(requested))
+    queues = {}
+    for client_id, cursor in requested.items():
+        queue = sessions.events(client_id, create=client_id in sessions)
+        if queue is not None:
+            queues[client_id] = (queue, None if cursor is None else resume_point(cursor))
+    if wait > 0:
+        await wait_any(list(queues.values()), min(wait, LONG_POLL_MAX_WAIT))
+
+    batches = []
+    for client_id in requested:
+        if client_id in queues:
+            queue, cursor = queues[client_id]
+            batches.append((client_id, encode_batch(*queue.read(cursor))))
+        else:
+            batches.append((client_id, encode_batch([])))
+    return Response(content=encode_sessions(batches), media_type="application/json")
 
 @app.post("/send-message/{step_up_id}")
-async def send_message(step_up_id: str, message: dict):
+async def send_message(step_up_id: str, message: MobileMessage):
     """Send a message to the browser from an external app"""
-    logger.info(f"📱 Received external message for step_up_id: {step_up_id}")
+    logger.debug("📱 Received external message for step_up_id: %s", step_up_id)
     
     # Get the client ID from the mapping
-    client_id = STEP_UP_TO_CLIENT.get(step_up_id)
+    client_id = sessions.session_for_step_up(step_up_id)
     if not client_id:
-        logger.error(f"❌ No client_id found for step_up_id: {step_up_id}")
+        logger.error("❌ No client_id found for step_up_id: %s", step_up_id)
         return JSONResponse(
             status_code=404,
             content={"error": "Step-up ID not found"}
         )
 
-    # Add message to polling queue
-    logger.info(f"➡️ Adding message to polling queue for client: {client_id}")
-    POLLING_EVENTS[client_id].append({
+    # Deliver to SSE, WebSocket and polling clients
+    logger.debug("➡️ Sending message to client: %s", client_id)
+    bus.publish(client_id, {
         "type": "mobile_message",
-        "data": message["content"]
+        "data": message.content
     })
     
-    # Send via SSE if available
-    if client_id in CONNECTIONS:
-        logger.info(f"➡️ Sending message via SSE for client: {client_id}")
-        await CONNECTIONS[client_id].put({
-            "event": "mobile_message",
-            "data": message["content"]
-        })
-    
     return {"status": "success"}
 
 @app.get("/get-current-pin")
@@ -414,7 +714,7 @@ async def get_current_pin():
         )
     # Find the step-up ID for the current PIN
     step_up_id = None
-    for sid, pin in step_up_pins.items():
+    for sid, pin in sessions.step_up_pins():
         if pin == CURRENT_PIN:
             step_up_id = sid
             break
@@ -424,180 +724,151 @@ async def get_current_pin():
         "step_up_id": step_up_id
     }
 
-@app.post("/verify-pin")
-async def verify_pin(request: Request):
+@app.post("/verify-pin", response_model=VerifiedResponse)
+async def verify_pin(request: Request, body: PinGuess):
     """Verify a PIN and return a session ID if correct"""
     try:
-        data = await request.json()
-        pin = data.get('pin')
-        session_id = data.get('session_id')
+        pin = body.pin
+        session_id = body.session_id
+        # Shares its buckets with /verify-pin-selection: both are PIN guesses
+        limited = throttle(request, "verify-pin", session_id=session_id)
+        if limited is not None:
+            return limited
         
-        logger.info(f'Verifying PIN: user selected {pin} for session {session_id}')
-        correct_pin = session_pins.get(session_id)
-        logger.info(f'Correct PIN for session {session_id} is {correct_pin}')
+        logger.debug('Verifying PIN for session %s', session_id)
+        correct_pin = sessions.pin(session_id)
+        if correct_pin is None:
+            return JSONResponse(
+                status_code=404,
+                content={'error': 'Session not found'}
+            )
         
-        if str(pin) == str(correct_pin):
-            logger.info(f'PIN verified successfully for session {session_id}')
+        if pin == correct_pin:
+            PIN_SUCCESS.inc()
+            logger.info('PIN verified successfully for session %s', session_id)
             # Notify browser of successful authentication
-            event = {
-                'type': 'auth_complete',
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            # Add event to polling queue
-            if session_id in POLLING_EVENTS:
-                logger.info(f'Adding auth_complete event to polling queue for session {session_id}')
-                POLLING_EVENTS[session_id].append(event)
-            
-            # Also send through WebSocket if connected
-            if session_id in WS_CONNECTIONS:
-                logger.info(f'Sending auth_complete through WebSocket for session {session_id}')
-                await WS_CONNECTIONS[session_id].send_json(event)
+            publish_auth_complete(session_id)
             
-            return JSONResponse(content={'session_id': session_id})
+            return VerifiedResponse(session_id=session_id)
         else:
-            logger.error(f'PIN verification failed for session {session_id}: user entered {pin}, expected {correct_pin}')
+            PIN_FAILURE.inc()
+            logger.warning('PIN verification failed for session %s', session_id)
             
-            # Send auth_failed event through WebSocket
-            if session_id in WS_CONNECTIONS:
-                logger.info(f'Sending auth_failed through WebSocket for session {session_id}')
-                try:
-                    await WS_CONNECTIONS[session_id].send_json({
-                        'type': 'auth_failed',
-                        'timestamp': datetime.now().isoformat()
-                    })
-                    
-                    # Add cleanup event to polling queue
-                    if session_id in POLLING_EVENTS:
-                        POLLING_EVENTS[session_id].append({
-                            'type': 'cleanup_session',
-                            'timestamp': datetime.now().isoformat()
-                        })
-                        
-                    # Clean up session after browser has been notified
-                    async def delayed_cleanup():
-                        await asyncio.sleep(1)  # Give browser time to process the auth_failed event
-                        if session_id in session_pins:
-                            del session_pins[session_id]
-                        if session_id in POLLING_EVENTS:
-                            del POLLING_EVENTS[session_id]
-                        if session_id in WS_CONNECTIONS:
-                            del WS_CONNECTIONS[session_id]
-                        # Remove from active_sessions
-                        for username, sess_id in list(active_sessions.items()):
-                            if sess_id == session_id:
-                                del active_sessions[username]
-                        logger.info(f'Cleaned up failed session {session_id}')
-                    
-                    # Schedule the cleanup
-                    asyncio.create_task(delayed_cleanup())
-                    
-                except Exception as e:
-                    logger.error(f'Error sending auth_failed event: {str(e)}')
+            # Send auth_failed event to the browser (and callback), on whichever worker it's connected
+            publish_auth_failed(session_id)
+            bus.publish(session_id, CLEANUP_SESSION)
+            
+            if bus.has_subscribers(session_id):
+                # Clean up session after browser has been notified
+                async def delayed_cleanup():
+                    await asyncio.sleep(1)  # Give browser time to process the auth_failed event
+                    sessions.delete(session_id)
+                    logger.info('Cleaned up failed session %s', session_id)
+                
+                # Schedule the cleanup
+                asyncio.create_task(delayed_cleanup())
             
             return JSONResponse(
                 status_code=400,
                 content={'error': 'Invalid PIN'}
             )
     except Exception as e:
-        logger.error(f'Error verifying PIN: {str(e)}')
+        logger.error('Error verifying PIN: %s', e)
         return JSONResponse(
             status_code=500,
             content={'error': str(e)}
         )
 
 @app.post("/update-pin")
-async def update_pin(pin_data: dict):
+async def update_pin(pin_data: PinUpdate):
     """Update the current valid PIN"""
     global CURRENT_PIN
-    CURRENT_PIN = pin_data.get("pin")
+    CURRENT_PIN = pin_data.pin
     return {"status": "success"}
 
-@app.post("/get-pin-options", response_class=JSONResponse)
-async def get_pin_options(request: Request):
-    """Get PIN options for mobile device"""
+def pin_options_response(request: Request, username: str):
+    """
+    The PIN options for the user's session. They are chosen once per PIN and
+    kept on the session (so they expire with it): fresh decoys on every call
+    would give the PIN away to anyone comparing responses. The ETag lets the
+    mobile revalidate with If-None-Match and get a 304.
+    """
     try:
-        data = await request.json()
-        username = data.get('username')
-        logger.info(f"\nProcessing PIN options request:")
-        logger.info(f"  Username: {username}")
-        if not username:
-            logger.error("  Error: No username provided")
-            return JSONResponse(
-                status_code=400,
-                content={"error": "Username is required"}
-            )
+        limited = throttle(request, "get-pin-options", username=username)
+        if limited is not None:
+            return limited
+        logger.debug("Processing PIN options request for username: %s", username)
 
         # Get session_id for this username
-        session_id = active_sessions.get(username)
-        logger.info(f"  Found session_id: {session_id}")
+        session_id = sessions.session_for_username(username)
         if not session_id:
-            logger.error(f"  Error: No active session found")
+            logger.warning("No active session found for username: %s", username)
             return JSONResponse(
                 status_code=404,
                 content={"error": "No active session found for username"}
             )
 
-        # Get the correct PIN for this session
-        correct_pin = session_pins.get(session_id)
-        logger.info(f"  Correct PIN: {correct_pin}")
+        record = sessions.get(session_id)
+        if record is None or not record.pin:
+            return JSONResponse(
+                status_code=404,
+                content={"error": "No PIN issued for this session"}
+            )
+        pin_options = record.pin_options
+        if not pin_options or record.pin not in pin_options:
+            # The correct PIN among distinct random decoys, shuffled
+            pin_options = challenges.option_set(record.pin)
+            sessions.set_pin_options(session_id, pin_options)
 
-        # Generate 3 completely random PINs
-        pins = {correct_pin}  # Include the correct PIN
-        while len(pins) < 3:
-            pins.add(str(random.randint(10, 99)))
-        
-        # Convert to list and shuffle
-        pin_options = list(pins)
-        random.shuffle(pin_options)
-        
-        logger.info(f"Returning PIN options: {pin_options} including correct PIN: {correct_pin}")
-        return JSONResponse(content={
-            "pins": pin_options,
-            "session_id": session_id
-        })
+        body = dumps({"pins": pin_options, "session_id": session_id})
+        headers = {"ETag": '"' + hashlib.sha256(body).hexdigest()[:32] + '"',
+                   "Cache-Control": "private, no-cache"}
+        if etag_matches(request, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        logger.debug("Returning %s PIN options for session %s", len(pin_options), session_id)
+        return Response(body, media_type="application/json", headers=headers)
     except Exception as e:
-        logger.error(f'Error generating PIN options: {str(e)}')
+        logger.error('Error generating PIN options: %s', e)
         return JSONResponse(
             status_code=500,
             content={"error": "Failed to generate PIN options"}
         )
 
-@app.post("/generate-pin")
-async def generate_pin(request: Request):
+@app.post("/get-pin-options", response_model=PinOptionsResponse)
+async def get_pin_options(request: Request, body: UsernameRequest):
+    """Get PIN options for mobile device"""
+    return pin_options_response(request, body.username)
+
+@app.get("/get-pin-options", response_model=PinOptionsResponse)
+async def get_pin_options_conditional(request: Request, username: Username):
+    """As POST /get-pin-options, as a GET the browser can revalidate from its cache"""
+    return pin_options_response(request, username)
+
+@app.post("/generate-pin", response_model=GeneratedPinResponse)
+async def generate_pin(request: Request, body: GeneratePinRequest):
     """Generate a new PIN for a client"""
     try:
-        data = await request.json()
-        client_id = data.get('client_id')
-        if not client_id:
-            logger.error('No client_id provided')
-            return JSONResponse(
-                status_code=400,
-                content={"error": "No client_id provided"}
-            )
+        client_id = body.client_id
+        limited = throttle(request, "generate-pin", session_id=client_id)
+        if limited is not None:
+            return limited
             
-        # Generate a random 2-digit PIN
-        pin = str(random.randint(10, 99))
-        logger.info(f'Generated PIN {pin} for client {client_id}')
+        pin = challenges.pin()
+        logger.debug('Generated PIN for client %s', client_id)
         
         # Store the PIN with the client_id
-        pins[client_id] = pin
+        sessions.set_pin(client_id, pin)
         
         # Also update the current PIN for verification
         global CURRENT_PIN
         CURRENT_PIN = pin
         # Store this PIN for the step-up process
         step_up_id = str(uuid.uuid4())
-        step_up_pins[step_up_id] = pin
-        STEP_UP_TO_CLIENT[step_up_id] = client_id
+        sessions.add_step_up(client_id, step_up_id, pin)
         
-        return JSONResponse(content={
-            "pin": pin,
-            "client_id": client_id,
-            "step_up_id": step_up_id
-        })
+        return GeneratedPinResponse(pin=pin, client_id=client_id, step_up_id=step_up_id)
     except Exception as e:
-        logger.error(f'Error generating PIN: {str(e)}')
+        logger.error('Error generating PIN: %s', e)
         return JSONResponse(
             status_code=500,
             content={"error": str(e)}
@@ -629,39 +900,82 @@ async def get_cert_info():
             "public_info": public_info
         }
     except Exception as e:
-        logger.error(f"Error getting certificate info: {str(e)}")
+        logger.error("Error getting certificate info: %s", e)
         return JSONResponse(
             status_code=500,
             content={"error": "Failed to get certificate information"}
         )
 
-@app.post("/start-session")
-async def start_session(request: Request):
+def create_session(username):
+    """Create a session with a fresh PIN and wake the user's device; returns (session_id, pin)"""
+    session_id = str(uuid.uuid4())
+    pin = challenges.pin()
+    
+    # Store session information
+    sessions.create(session_id=session_id, username=username, pin=pin)
+    step_up_timer.start(session_id)
+    
+    # Wake the user's registered device so it doesn't have to poll for the step-up
+    if push_subscriptions.for_username(username):
+        asyncio.create_task(send_push_notification("Approve your sign-in request", username=username))
+    return session_id, pin
+
+@app.post("/start-session", response_model=SessionResponse)
+async def start_session(request: Request, body: UsernameRequest):
     """Start a new session for a username"""
     try:
-        data = await request.json()
-        username = data.get('username')
+        username = body.username
+        limited = throttle(request, "start-session", username=username)
+        if limited is not None:
+            return limited
+        
+        session_id, pin = create_session(username)
         
-        if not username:
+        return SessionResponse(session_id=session_id, pin=pin)
+    except Exception as e:
+        logger.error('Error starting session: %s', e)
+        return JSONResponse(
+            status_code=500,
+            content={"error": str(e)}
+        )
+
+@app.post("/api/step-ups")
+async def create_api_step_up(request: Request, body: StepUpRequest):
+    """
+    Server-to-server step-up: start a session for `username` and POST the
+    result to `callback_url` (signed, see webhooks.py) instead of having a
+    browser wait for it. The returned PIN is shown to the user as usual.
+    Needs an API key (STRONGHOLD_API_KEYS) as a bearer token.
+    """
+    try:
+        username = body.username
+        callback_url = body.callback_url
+        limited = throttle(request, "api-step-ups", username=username)
+        if limited is not None:
+            return limited
+        if not bearer_token_valid(request, API_KEYS):
+            return JSONResponse(
+                status_code=401,
+                content={"error": "Invalid or missing API key"},
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+        problem = await check_callback_url(callback_url)
+        if problem is not None:
             return JSONResponse(
                 status_code=400,
-                content={"error": "Username is required"}
+                content={"error": problem}
             )
         
-        # Generate session ID and PIN
-        session_id = str(uuid.uuid4())
-        pin = str(random.randint(10, 99))
-        
-        # Store session information
-        active_sessions[username] = session_id
-        session_pins[session_id] = pin
+        session_id, pin = create_session(username)
+        sessions.set_callback_url(session_id, callback_url)
+        logger.debug("Created API step-up %s with callback %s", session_id, callback_url)
         
         return JSONResponse(content={
             "session_id": session_id,
             "pin": pin
         })
     except Exception as e:
-        logger.error(f'Error starting session: {str(e)}')
+        logger.error('Error creating API step-up: %s', e)
         return JSONResponse(
             status_code=500,
             content={"error": str(e)}
@@ -671,41 +985,24 @@ async def start_session(request: Request):
 async def join_session(username: str):
     """Get session info for a username if one exists"""
     try:
-        logger.info(f"Checking for existing session for username: {username}")
+        logger.debug("Checking for existing session for username: %s", username)
         
         # Check if user has an active session
-        session_id = active_sessions.get(username)
+        session_id = sessions.session_for_username(username)
         if not session_id:
-            logger.error(f"No active session found for username: {username}")
+            logger.error("No active session found for username: %s", username)
             return JSONResponse(
                 status_code=404,
                 content={"error": "No active session found"}
             )
         
-        logger.info(f"Found active session: {session_id} for username: {username}")
+        logger.debug("Found active session: %s for username: %s", session_id, username)
         return JSONResponse(content={
             "session_id": session_id
         })
         
     except Exception as e:
-        logger.error(f'Error joining session: {str(e)}')
-        return JSONResponse(
-            status_code=500,
-            content={"error": str(e)}
-        )
-
-@app.get("/poll-updates/{session_id}")
-async def poll_updates(session_id: str):
-    """Poll for updates for a given session"""
-    try:
-        logger.info(f'Polling updates for session: {session_id}')
-        events = list(POLLING_EVENTS[session_id])
-        # Clear events after retrieving them
-        POLLING_EVENTS[session_id].clear()
-        logger.info(f'Returning events: {events}')
-        return JSONResponse(content={"events": events})
-    except Exception as e:
-        logger.error(f'Error polling updates: {str(e)}')
+        logger.error('Error joining session: %s', e)
         return JSONResponse(
             status_code=500,
             content={"error": str(e)}
@@ -715,28 +1012,14 @@ async def poll_updates(session_id: str):
 async def delete_session(session_id: str):
     """Delete a session and all its associated data"""
     try:
-        logger.info(f'Deleting session: {session_id}')
-        # Remove from session_pins
-        if session_id in session_pins:
-            del session_pins[session_id]
-        
-        # Remove from POLLING_EVENTS
-        if session_id in POLLING_EVENTS:
-            del POLLING_EVENTS[session_id]
-        
-        # Remove from WS_CONNECTIONS
-        if session_id in WS_CONNECTIONS:
-            del WS_CONNECTIONS[session_id]
+        logger.debug('Deleting session: %s', session_id)
+        # Removes the PIN, step-ups, polling queue, WebSocket and username mapping
+        sessions.delete(session_id)
         
-        # Remove from active_sessions
-        for username, sess_id in list(active_sessions.items()):
-            if sess_id == session_id:
-                del active_sessions[username]
-        
-        logger.info(f'Successfully deleted session {session_id}')
+        logger.info('Successfully deleted session %s', session_id)
         return JSONResponse(content={'status': 'success'})
     except Exception as e:
-        logger.error(f'Error deleting session: {str(e)}')
+        logger.error('Error deleting session: %s', e)
         return JSONResponse(
             status_code=500,
             content={'error': str(e)}
@@ -745,18 +1028,12 @@ async def delete_session(session_id: str):
 @app.get("/sample", response_class=HTMLResponse)
 async def sample(request: Request):
     """Serve sample integration page"""
-    return templates.TemplateResponse("sample-integration.html", {
-        "request": request,
-        "show_footer": False
-    })
+    return SAMPLE_PAGE.response(request)
 
 @app.get("/payment", response_class=HTMLResponse)
 async def payment(request: Request):
     """Serve payment page"""
-    return templates.TemplateResponse("payment.html", {
-        "request": request,
-        "show_footer": False
-    })
+    return PAYMENT_PAGE.response(request)
 
 @app.get("/manifest.json")
 async def manifest():
@@ -765,53 +1042,47 @@ async def manifest():
 @app.get("/dashboard", response_class=HTMLResponse)
 async def dashboard(request: Request):
     """Serve dashboard page"""
-    return templates.TemplateResponse("dashboard.html", {
-        "request": request,
-        "show_footer": False
-    })
+    return DASHBOARD_PAGE.response(request)
 
 @app.get("/pincode", response_class=HTMLResponse)
 async def pincode(request: Request):
     username = request.query_params.get('username')
-    return templates.TemplateResponse("pincode.html", {
-        "request": request,
-        "username": username
-    })
+    # One cached variant per username (bounded, least recently used out)
+    return pages.response(request, "pincode.html", username=username)
 
 @app.get("/admin", response_class=HTMLResponse)
 async def admin(request: Request):
     """Admin page showing active sessions"""
-    logger.info("Accessing admin page")
-    logger.info(f"Active sessions: {active_sessions}")
-    logger.info(f"Session PINs: {session_pins}")
-    logger.info(f"Client mappings: {STEP_UP_TO_CLIENT}")
+    logger.debug("Accessing admin page")
+    active_sessions = {}
+    session_pins = {}
+    step_up_to_client = {}
+    for username, record in sessions.active_sessions():
+        active_sessions[username] = record.session_id
+        session_pins[record.session_id] = record.pin
+        step_up_to_client[record.session_id] = sessions.session_for_step_up(record.session_id)
+    logger.debug("Active sessions: %s", active_sessions)
     
-    return templates.TemplateResponse("admin.html", {
-        "request": request,
-        "active_sessions": active_sessions,
-        "session_pins": session_pins,
-        "step_up_to_client": STEP_UP_TO_CLIENT
-    })
+    # Live data, so never served from the cache
+    return pages.response(request, "admin.html", cache=False,
+                          active_sessions=active_sessions,
+                          session_pins=session_pins,
+                          step_up_to_client=step_up_to_client)
 
-@app.post("/verify-pin-selection", response_class=JSONResponse)
-async def verify_pin_selection(request: Request):
+@app.post("/verify-pin-selection", response_model=VerificationResponse)
+async def verify_pin_selection(request: Request, body: PinGuess):
     """Verify selected PIN against session PIN"""
     try:
-        data = await request.json()
-        # Convert pin to string if it's a number
-        pin = str(data.get('pin'))
-        session_id = data.get('session_id')
+        pin = body.pin
+        session_id = body.session_id
+        limited = throttle(request, "verify-pin", session_id=session_id)
+        if limited is not None:
+            return limited
         
-        logger.info(f"Verifying PIN for session: {session_id}")
-        
-        if not session_id or not pin:
-            return JSONResponse(
-                status_code=400,
-                content={"error": "Missing pin or session_id"}
-            )
+        logger.debug("Verifying PIN for session: %s", session_id)
         
         # Get correct PIN for this session
-        correct_pin = session_pins.get(session_id)
+        correct_pin = sessions.pin(session_id)
         
         if not correct_pin:
             return JSONResponse(
@@ -821,27 +1092,20 @@ async def verify_pin_selection(request: Request):
         
         # Compare PINs
         success = pin == correct_pin
-        logger.info(f"PIN verification {'successful' if success else 'failed'}")
+        logger.info("PIN verification %s", 'successful' if success else 'failed')
         
-        # Send result via WebSocket
-        if session_id in WS_CONNECTIONS:
-            if success:
-                await WS_CONNECTIONS[session_id].send_json({
-                    "type": "auth_complete",
-                    "data": {}
-                })
-            else:
-                await WS_CONNECTIONS[session_id].send_json({
-                    "type": "auth_failed",
-                    "data": {}
-                })
+        # Send result to the browser
+        if success:
+            PIN_SUCCESS.inc()
+            publish_auth_complete(session_id)
+        else:
+            PIN_FAILURE.inc()
+            publish_auth_failed(session_id)
         
-        return JSONResponse(content={
-            "success": success
-        })
+        return VerificationResponse(success=success)
         
     except Exception as e:
-        logger.error(f'Error verifying PIN: {str(e)}')
+        logger.error('Error verifying PIN: %s', e)
         return JSONResponse(
             status_code=500,
             content={"error": "Failed to verify PIN"}
@@ -851,23 +1115,17 @@ async def verify_pin_selection(request: Request):
 async def auth_complete(session_id: str):
     """Handle auth completion from mobile"""
     try:
-        logger.info(f"Processing auth complete for session: {session_id}")
-        logger.info(f"Current WebSocket connections: {list(WS_CONNECTIONS.keys())}")
+        logger.debug("Processing auth complete for session: %s", session_id)
         
-        # Send via WebSocket if available
-        if session_id in WS_CONNECTIONS:
-            logger.info(f"Sending auth_complete via WebSocket to session: {session_id}")
-            await WS_CONNECTIONS[session_id].send_json({
-                "type": "auth_complete",
-                "data": {}
-            })
-            logger.info("WebSocket message sent successfully")
+        # Send to whichever channels the browser has open
+        if publish_auth_complete(session_id):
+            logger.debug("Sent auth_complete to session: %s", session_id)
         else:
-            logger.warning(f"No WebSocket connection found for session: {session_id}")
+            logger.warning("No connection found for session: %s", session_id)
             
         return JSONResponse(content={"status": "success"})
     except Exception as e:
-        logger.error(f"Error completing auth: {str(e)}")
+        logger.error("Error completing auth: %s", e)
         return JSONResponse(
             status_code=500,
             content={"error": str(e)}
@@ -875,4 +1133,4 @@ async def auth_complete(session_id: str):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
\ No newline at end of file
@@ -0,0 +1,288 @@
+"""
+Static asset pipeline.
+
+`build_assets()` copies every file under the static directory to a build
+directory under a content-hashed name (css/styles.css ->
+css/styles.1a2b3c4d.css), next to gzip (and, with the `brotli` package,
+brotli) variants of the compressible ones and, with Pillow, WebP/AVIF
+variants of the images. url() references in CSS are rewritten to the hashed
+names. The mapping is written to asset-manifest.json; templates resolve
+paths through `AssetManifest.url()` and sw.js gets it injected so its cache
+name changes whenever an asset does.
+
+Hashed files never change, so AssetFiles serves them as immutable for a
+year, picking the best variant the browser accepts. Anything else (the
+original names, sw.js) is served with `no-cache`.
+
+Building is idempotent and cheap once the outputs exist; app.py runs it at
+startup. It can also be run on its own as a deploy step:
+
+    python assets.py v2/static build/static
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import sys
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # optional: no WebP/AVIF variants
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "asset-manifest.json"
+
+# Served under their own names: the browser looks them up by a fixed URL
+UNHASHED = {"sw.js", "service-worker.js", "manifest.json"}
+SKIPPED = {".DS_Store"}
+
+COMPRESSIBLE = {".css", ".js", ".json", ".html", ".svg", ".txt", ".map"}
+# Don't bother with files this small
+MIN_COMPRESS_SIZE = 512
+
+IMAGE_VARIANTS = {".png": ("webp", "avif"), ".jpg": ("webp", "avif"), ".jpeg": ("webp", "avif")}
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# Content-Encoding -> file suffix, in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+CSS_URL = re.compile(r"""url\((['"]?)/static/([^'")]+)\1\)""")
+
+
+def _quality(header: str, token: str, wildcard: Optional[str] = None) -> float:
+    """
+    The q-value `header` (an Accept or Accept-Encoding value) gives `token`,
+    or 0 if it isn't listed. An explicit entry beats `wildcard` ("*" for
+    encodings; image types must be named, since browsers send */* for
+    everything).
+    """
+    quality = None
+    for item in header.split(","):
+        name, *params = item.split(";")
+        name = name.strip().lower()
+        if name != token and (wildcard is None or name != wildcard or quality is not None):
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name == token:
+            return q
+        quality = q
+    return quality or 0.0
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:8]
+
+
+def _write(path: str, data: bytes) -> None:
+    """Write atomically so concurrent workers never see half a file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _hashed_name(relative: str, data: bytes) -> str:
+    root, ext = os.path.splitext(relative)
+    return f"{root}.{_digest(data)}{ext}"
+
+
+def _compress(path: str, data: bytes) -> None:
+    if not os.path.exists(path + ".gz"):
+        _write(path + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None and not os.path.exists(path + ".br"):
+        _write(path + ".br", brotli.compress(data, quality=11))
+
+
+def _convert_image(source: str, path: str, fmt: str) -> Optional[str]:
+    target = f"{os.path.splitext(path)[0]}.{fmt}"
+    if os.path.exists(target):
+        return target
+    try:
+        with Image.open(source) as image:
+            tmp = f"{target}.{os.getpid()}.tmp"
+            image.save(tmp, format=fmt.upper(), quality=80)
+            os.replace(tmp, target)
+    except Exception as e:  # e.g. a Pillow without AVIF support
+        logger.debug("No %s variant for %s: %s", fmt, source, e)
+        return None
+    # Only worth serving if it's actually smaller
+    if os.path.getsize(target) >= os.path.getsize(source):
+        os.remove(target)
+        return None
+    return target
+
+
+class AssetManifest:
+    """Logical path -> hashed path, plus a version that changes with any asset"""
+
+    def __init__(self, files: Dict[str, str], prefix: str = "/static/"):
+        self.files = files
+        self.prefix = prefix
+        self.version = hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()[:12]
+
+    def url(self, path: str) -> str:
+        """URL for a static file, hashed when the pipeline knows it"""
+        path = path.lstrip("/")
+        return self.prefix + self.files.get(path, path)
+
+    def to_json(self) -> str:
+        return json.dumps({"version": self.version, "files": self.files}, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path: str, prefix: str = "/static/") -> "AssetManifest":
+        with open(path) as f:
+            return cls(json.load(f)["files"], prefix)
+
+
+def build_assets(source: str, output: str, prefix: str = "/static/") -> AssetManifest:
+    """Fingerprint, compress and convert everything under `source` into `output`"""
+    files: Dict[str, str] = {}
+    pending_css = []
+
+    for root, _, names in os.walk(source):
+        for name in sorted(names):
+            if name in SKIPPED:
+                continue
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, source).replace(os.sep, "/")
+            if name in UNHASHED:
+                continue
+            if relative.endswith(".css"):
+                pending_css.append((path, relative))  # after the files they reference
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            hashed = _hashed_name(relative, data)
+            target = os.path.join(output, hashed)
+            if not os.path.exists(target):
+                _write(target, data)
+            files[relative] = hashed
+            ext = os.path.splitext(name)[1].lower()
+            if ext in COMPRESSIBLE and len(data) >= MIN_COMPRESS_SIZE:
+                _compress(target, data)
+            if Image is not None:
+                for fmt in IMAGE_VARIANTS.get(ext, ()):
+                    _convert_image(path, target, fmt)
+
+    for path, relative in pending_css:
+        with open(path, "rb") as f:
+            text = f.read().decode()
+        text = CSS_URL.sub(lambda m: f"url({m.group(1)}{prefix}{files.get(m.group(2), m.group(2))}{m.group(1)})",
+                           text)
+        data = text.encode()
+        hashed = _hashed_name(relative, data)
+        target = os.path.join(output, hashed)
+        if not os.path.exists(target):
+            _write(target, data)
+        files[relative] = hashed
+        if len(data) >= MIN_COMPRESS_SIZE:
+            _compress(target, data)
+
+    manifest = AssetManifest(files, prefix)
+    _write(os.path.join(output, MANIFEST_NAME), manifest.to_json().encode())
+
+    # sw.js keeps its URL but carries the manifest, so every build that changes
+    # an asset is a new service worker with a new cache
+    sw_source = os.path.join(source, "sw.js")
+    if os.path.exists(sw_source):
+        with open(sw_source, "rb") as f:
+            script = f.read()
+        header = f"self.ASSET_MANIFEST = {json.dumps({'version': manifest.version, 'files': files})};\n"
+        _write(os.path.join(output, "sw.js"), header.encode() + script)
+    return manifest
+
+
+class AssetFiles(StaticFiles):
+    """
+    Serves the build directory first, then the original static directory.
+    Hashed files are immutable and negotiated by Accept-Encoding (and Accept,
+    for image variants); everything else must be revalidated.
+    """
+
+    def __init__(self, source: str, output: str, manifest: AssetManifest):
+        super().__init__(directory=output)
+        self.all_directories.append(source)
+        self.variants: Dict[str, list] = {}
+        for hashed in manifest.files.values():
+            full_path = os.path.realpath(os.path.join(output, hashed))
+            self.variants[full_path] = self._find_variants(full_path)
+
+    @staticmethod
+    def _find_variants(full_path: str) -> list:
+        """(header, token, path, stat, extra headers) for each pre-built variant, best first"""
+        variants = []
+        base = os.path.splitext(full_path)[0]
+        for fmt in ("avif", "webp"):
+            path = f"{base}.{fmt}"
+            if os.path.exists(path):
+                variants.append(("accept", f"image/{fmt}", path, os.stat(path),
+                                 {"content-type": f"image/{fmt}", "vary": "Accept"}))
+        media_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        for encoding, suffix in ENCODINGS:
+            path = full_path + suffix
+            if os.path.exists(path):
+                variants.append(("accept-encoding", encoding, path, os.stat(path),
+                                 {"content-type": media_type, "content-encoding": encoding,
+                                  "vary": "Accept-Encoding"}))
+        return variants
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        variants = self.variants.get(os.path.realpath(full_path))
+        if variants is None:
+            response = super().file_response(full_path, stat_result, scope, status_code)
+            response.headers["cache-control"] = REVALIDATE
+            return response
+
+        # The variant the client rates highest; ties go to the earlier (preferred) one
+        best, best_q = None, 0.0
+        for variant in variants:
+            header, token = variant[0], variant[1]
+            q = _quality(request_headers.get(header, ""), token, "*" if header == "accept-encoding" else None)
+            if q > best_q:
+                best, best_q = variant, q
+        response = None
+        if best is not None:
+            _, _, path, variant_stat, extra = best
+            response = FileResponse(path, status_code=status_code, stat_result=variant_stat)
+            response.headers.update(extra)
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+            if variants:
+                response.headers["vary"] = "Accept" if variants[0][0] == "accept" else "Accept-Encoding"
+        response.headers["cache-control"] = IMMUTABLE
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    source, output = (sys.argv[1:3] if len(sys.argv) > 2 else ("v2/static", "build/static"))
+    built = build_assets(source, output)
+    print(f"Built {len(built.files)} assets into {output} (version {built.version})")
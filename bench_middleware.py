@@ -0,0 +1,94 @@
+"""
+Compare request latency with the pure ASGI RequestLoggingMiddleware against
+the BaseHTTPMiddleware version it replaced.
+
+Runs in-process through httpx's ASGI transport, so the numbers measure the
+app and its middleware stack rather than the network:
+
+    python bench_middleware.py --requests 5000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+
+os.environ.setdefault("STRONGHOLD_LOG_LEVEL", "WARNING")
+
+import httpx
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+
+import app as stronghold
+from middleware import RequestLoggingMiddleware
+
+
+class BaseHTTPLoggingMiddleware(BaseHTTPMiddleware):
+    """The previous request logger, minus body logging"""
+
+    async def dispatch(self, request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+        stronghold.logger.debug("%s %s %s %.1fms", request.method, request.url.path,
+                                response.status_code, (time.perf_counter() - start) * 1000)
+        return response
+
+
+def use_middleware(cls) -> None:
+    """Swap the request logger in the app's middleware stack"""
+    app = stronghold.app
+    app.user_middleware = [
+        Middleware(cls) if m.cls in (RequestLoggingMiddleware, BaseHTTPLoggingMiddleware) else m
+        for m in app.user_middleware
+    ]
+    app.middleware_stack = None  # rebuilt on the next request
+
+
+def percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def measure(client: httpx.AsyncClient, make_request, total: int, concurrency: int):
+    latencies = []
+    remaining = iter(range(total))
+
+    async def worker():
+        for i in remaining:
+            start = time.perf_counter()
+            response = await make_request(client, i)
+            latencies.append((time.perf_counter() - start) * 1000)
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, total / (time.perf_counter() - started)
+
+
+async def run(total: int, concurrency: int) -> None:
+    transport = httpx.ASGITransport(app=stronghold.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        poll_ids = [(await client.get("/register-polling")).json()["client_id"] for _ in range(concurrency)]
+        endpoints = {
+            "/poll-updates": lambda c, i: c.get(f"/poll-updates/{poll_ids[i % len(poll_ids)]}"),
+            "/start-session": lambda c, i: c.post("/start-session", json={"username": f"bench-{random.random()}"}),
+        }
+        print(f"{'endpoint':<16}{'middleware':<20}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for path, make_request in endpoints.items():
+            for name, cls in (("BaseHTTPMiddleware", BaseHTTPLoggingMiddleware),
+                              ("pure ASGI", RequestLoggingMiddleware)):
+                use_middleware(cls)
+                await measure(client, make_request, min(total, 500), concurrency)  # warm up
+                latencies, rate = await measure(client, make_request, total, concurrency)
+                print(f"{path:<16}{name:<20}{rate:>10.0f}"
+                      f"{statistics.median(latencies):>10.2f}{percentile(latencies, 99):>10.2f}")
+    use_middleware(RequestLoggingMiddleware)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args.requests, args.concurrency))
@@ -0,0 +1,57 @@
+"""
+Micro-benchmark of the serialization layer: what a response body or an
+event costs to encode with the stdlib against serialization.dumps (orjson
+when installed), and what pre-encoded fixed events save per publish.
+
+    python bench_serialization.py --number 100000
+"""
+import argparse
+import json
+import timeit
+import uuid
+
+from starlette.responses import JSONResponse as StdlibJSONResponse
+
+import serialization
+from events import AUTH_COMPLETE, Event
+
+SESSION = {"session_id": str(uuid.uuid4()), "pin": "42"}
+PIN_OPTIONS = {"pins": ["42", "17", "88"], "session_id": str(uuid.uuid4())}
+WEBHOOK = {"id": uuid.uuid4().hex, "type": "auth_complete", "session_id": str(uuid.uuid4()),
+           "username": "gavin", "created": 1700000000}
+BATCH = {"events": [{"type": "mobile_message", "data": {"content": f"message {i}"}} for i in range(50)],
+         "cursor": 1234}
+
+
+def per_call(stmt, number: int) -> float:
+    """Best of three, in microseconds per call"""
+    return min(timeit.repeat(stmt, number=number, repeat=3)) / number * 1e6
+
+
+def run(number: int) -> None:
+    backend = "orjson" if serialization.orjson is not None else "stdlib json (orjson not installed)"
+    print(f"serialization.dumps backend: {backend}\n")
+    print(f"{'payload':<28}{'stdlib us':>12}{'fast us':>12}{'saved':>10}")
+    cases = {
+        "start-session response": SESSION,
+        "get-pin-options response": PIN_OPTIONS,
+        "webhook body": WEBHOOK,
+        "50-event poll batch": BATCH,
+    }
+    for name, payload in cases.items():
+        stdlib = per_call(lambda: StdlibJSONResponse(payload), number)
+        fast = per_call(lambda: serialization.JSONResponse(payload), number)
+        print(f"{name:<28}{stdlib:>12.2f}{fast:>12.2f}{1 - fast / stdlib:>10.0%}")
+
+    build = per_call(lambda: Event.build("auth_complete", {}), number)
+    stdlib_build = per_call(lambda: json.dumps({"type": "auth_complete", "data": {}}).encode(), number)
+    constant = per_call(lambda: AUTH_COMPLETE, number)
+    print(f"\n{'auth_complete event':<28}{'stdlib us':>12}{'built us':>12}{'constant us':>12}")
+    print(f"{'':<28}{stdlib_build:>12.2f}{build:>12.2f}{constant:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+    run(args.number)
@@ -0,0 +1,190 @@
+"""
+Event routing between worker processes.
+
+The EventBus hands every published event to a broker. The broker delivers
+it to this worker's channels straight away and, for cross-process brokers,
+makes it visible to every other worker so a browser connected to worker A
+still sees an `auth_complete` published by worker B.
+
+- InProcessBroker: single worker, delivery is a direct call.
+- SQLiteBroker: any number of workers/processes on one host sharing a WAL
+  mode SQLite file. Published events are written in batches by a background
+  task, and each worker tails the table for rows from other workers.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional, Tuple
+
+from events import Event
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[str, Event, int], int]
+
+
+class Broker:
+    """Base class: delivers locally only"""
+
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+
+    def bind(self, deliver: Deliver) -> None:
+        """Set the callback that hands an event to this worker's channels"""
+        self._deliver = deliver
+
+    def publish(self, session_id: str, event: Event, seq: int) -> int:
+        """Route an event and its sequence number; returns how many local channels it reached"""
+        return self._deliver(session_id, event, seq)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class InProcessBroker(Broker):
+    """Events never leave the process; the default for a single worker"""
+
+
+class SQLiteBroker(Broker):
+    """
+    Cross-process broker backed by a shared SQLite table.
+
+    Rows are tagged with the publishing worker's ID so a worker never
+    re-delivers its own events, and carry the event's sequence number so
+    every worker files it under the same one. Old rows are trimmed after `retention`
+    seconds.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS broker_events (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin     TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            type       TEXT NOT NULL,
+            payload    BLOB NOT NULL,
+            created    REAL NOT NULL,
+            seq        INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS broker_events_created ON broker_events (created);
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.02, retention: float = 60.0,
+                 batch_size: int = 1000):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.batch_size = batch_size
+        self.origin = uuid.uuid4().hex
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._outbox: List[Tuple[str, str, str, bytes, float, int]] = []
+        self._wakeup = asyncio.Event()
+        self._last_id = 0
+        self._last_trim = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> None:
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript(self.SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(broker_events)")}
+        if "seq" not in columns:
+            # Files from before events carried their sequence number
+            self._db.execute("ALTER TABLE broker_events ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+        # Only events published from now on are of interest
+        self._last_id = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM broker_events").fetchone()[0]
+
+    def publish(self, session_id, event, seq):
+        self._outbox.append((self.origin, session_id, event.type, event.payload, time.time(), seq))
+        self._wakeup.set()
+        return self._deliver(session_id, event, seq)
+
+    def _exchange(self, outgoing):
+        """Write our pending events and read everyone else's, in one worker thread hop"""
+        with self._db_lock:
+            return self._exchange_locked(self._db, outgoing)
+
+    def _exchange_locked(self, db, outgoing):
+        if outgoing:
+            db.execute("BEGIN")
+            try:
+                db.executemany(
+                    "INSERT INTO broker_events (origin, session_id, type, payload, created, seq) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", outgoing)
+                db.execute("COMMIT")
+            except Exception:
+                # Leave the connection usable for the retry on the next tick
+                db.execute("ROLLBACK")
+                raise
+            outgoing.clear()  # written; nothing left to retry
+        rows = db.execute(
+            "SELECT id, origin, session_id, type, payload, seq FROM broker_events "
+            "WHERE id > ? ORDER BY id LIMIT ?", (self._last_id, self.batch_size)).fetchall()
+        now = time.time()
+        if now - self._last_trim > self.retention:
+            self._last_trim = now
+            db.execute("DELETE FROM broker_events WHERE created < ?", (now - self.retention,))
+        return rows
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            outgoing, self._outbox = self._outbox, []
+            try:
+                rows = await asyncio.to_thread(self._exchange, outgoing)
+            except Exception as e:
+                logger.error("Broker exchange failed: %s", e)
+                self._outbox[:0] = outgoing  # retry unwritten events on the next tick
+                await asyncio.sleep(self.poll_interval)
+                continue
+            for row_id, origin, session_id, event_type, payload, seq in rows:
+                self._last_id = row_id
+                if origin != self.origin:
+                    self._deliver(session_id, Event(event_type, bytes(payload)), seq)
+
+    async def start(self) -> None:
+        if self._task is None:
+            await asyncio.to_thread(self._connect)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            # Flush anything published after the last tick
+            if self._outbox:
+                outgoing, self._outbox = self._outbox, []
+                await asyncio.to_thread(self._exchange, outgoing)
+            with self._db_lock:
+                self._db.close()
+
+
+def create_broker(url: Optional[str] = None) -> Broker:
+    """
+    Build a broker from a URL: "memory" (the default) or "sqlite:///path/to.db".
+    Falls back to the STRONGHOLD_BROKER environment variable.
+    """
+    url = url or os.environ.get("STRONGHOLD_BROKER", "memory")
+    if url == "memory":
+        return InProcessBroker()
+    if url.startswith("sqlite:///"):
+        return SQLiteBroker(url[len("sqlite:///"):])
+    raise ValueError(f"Unknown broker: {url}")
@@ -0,0 +1,85 @@
+"""
+PINs and PIN option sets from the OS CSPRNG.
+
+Entropy is read from os.urandom in blocks (4 KiB by default, 512 draws) and
+handed out as 64-bit integers, so a session start costs a list pop rather
+than a syscall. A value below n is a 64-bit draw mod n: the bias is at
+most n / 2**64, which is nothing for PIN-sized ranges, and unlike
+rejection sampling it never loops.
+
+Decoys are picked with Floyd's algorithm, which draws k distinct values in
+exactly k steps, from the PIN range with the correct PIN taken out, so
+there is no retry loop either; the options are then shuffled.
+"""
+import os
+from array import array
+from typing import List, Optional
+
+
+class EntropyPool:
+    """64-bit integers from os.urandom, read `block_size` bytes at a time"""
+    __slots__ = ("block_size", "_values")
+
+    def __init__(self, block_size: int = 4096):
+        if block_size < 8 or block_size % 8:
+            raise ValueError("block_size must be a positive multiple of 8")
+        self.block_size = block_size
+        self._values = array("Q")
+
+    def draw(self) -> int:
+        try:
+            return self._values.pop()
+        except IndexError:
+            self._values = array("Q", os.urandom(self.block_size))
+            return self._values.pop()
+
+    def below(self, n: int) -> int:
+        """A value in [0, n)"""
+        return self.draw() % n
+
+
+class ChallengeGenerator:
+    """
+    PINs of `pin_length` digits (no leading zero, as people read them out)
+    and sets of `options` distinct PINs for the mobile picker.
+    """
+
+    def __init__(self, pin_length: int = 2, options: int = 3, pool: Optional[EntropyPool] = None):
+        if pin_length < 1:
+            raise ValueError("pin_length must be at least 1")
+        if options < 1:
+            raise ValueError("options must be at least 1")
+        self.pin_length = pin_length
+        self.options = options
+        self.pool = pool or EntropyPool()
+
+    @staticmethod
+    def _range(length: int):
+        low = 10 ** (length - 1) if length > 1 else 0
+        return low, 10 ** length - low
+
+    def pin(self, length: Optional[int] = None) -> str:
+        low, size = self._range(length or self.pin_length)
+        return str(low + self.pool.below(size))
+
+    def option_set(self, correct: str, count: Optional[int] = None) -> List[str]:
+        """`correct` plus distinct decoys of the same length, in random order"""
+        low, size = self._range(len(correct))
+        index = int(correct) - low if correct.isdigit() else -1
+        if not 0 <= index < size:
+            index = None
+        # The decoy universe is the PIN range with the correct PIN removed
+        universe = size - (index is not None)
+        decoys = min((count or self.options) - 1, universe)
+        below = self.pool.below
+        chosen = set()
+        for j in range(universe - decoys, universe):
+            t = below(j + 1)
+            chosen.add(j if t in chosen else t)
+        options = [str(low + v + (index is not None and v >= index)) for v in chosen]
+        options.append(correct)
+        # Fisher-Yates: Floyd's picks come out in a biased order
+        for i in range(len(options) - 1, 0, -1):
+            j = below(i + 1)
+            options[i], options[j] = options[j], options[i]
+        return options
@@ -0,0 +1,142 @@
+"""
+Graceful draining of SSE and WebSocket connections.
+
+Without it, shutting a worker down cancels every stream at once and all its
+clients reconnect in the same instant. Draining instead:
+
+1. stops accepting new streams (register_sse answers 503, WebSockets are
+   closed with 1012 "service restart"), so a load balancer moves new
+   connections elsewhere;
+2. closes every open channel, so each client is sent what is still queued
+   for it followed by a `reconnect` event carrying a randomized retry hint
+   (the SSE `retry` field, or the message's "retry" in milliseconds), which
+   spreads the reconnects over a window instead of a spike;
+3. waits until every channel is gone or the deadline passes.
+
+A drain starts when the server begins shutting down (SIGTERM under uvicorn,
+noticed by `watch()`), from POST /admin/drain for deploy tooling that drains
+before stopping the process, and at the latest in the lifespan shutdown. A
+drain that wasn't followed by a shutdown (an aborted deploy) is undone with
+DELETE /admin/drain, which calls `resume()`.
+"""
+import asyncio
+import logging
+import random
+import signal
+from typing import Optional, Set
+
+from sse_starlette.sse import AppStatus
+
+from events import Channel
+
+logger = logging.getLogger(__name__)
+
+
+def _uvicorn_server():
+    """The running uvicorn Server, found through its SIGTERM handler (None if there isn't one)"""
+    handler = signal.getsignal(signal.SIGTERM)
+    server = getattr(handler, "__self__", None)
+    return server if hasattr(server, "should_exit") else None
+
+
+def shutdown_requested() -> bool:
+    if AppStatus.should_exit:
+        return True
+    server = _uvicorn_server()
+    return server is not None and bool(server.should_exit)
+
+
+class Drainer:
+    """Tracks open channels and drains them on request"""
+
+    def __init__(self, timeout: float = 10, retry_min: int = 1000, retry_max: int = 10000,
+                 poll_interval: float = 0.1):
+        self.timeout = timeout
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.poll_interval = poll_interval
+        self.draining = False
+        self._channels: Set[Channel] = set()
+        self._empty = asyncio.Event()
+        self._drain: Optional[asyncio.Task] = None
+        self._watcher: Optional[asyncio.Task] = None
+
+    def track(self, channel: Channel) -> None:
+        self._channels.add(channel)
+        self._empty.clear()
+
+    def untrack(self, channel: Channel) -> None:
+        self._channels.discard(channel)
+        if not self._channels:
+            self._empty.set()
+
+    def retry_hint(self) -> int:
+        """Milliseconds a client should wait before reconnecting"""
+        return random.randint(self.retry_min, self.retry_max)
+
+    async def _run(self, timeout: float) -> int:
+        channels = list(self._channels)
+        logger.info("🚰 Draining %s connections", len(channels))
+        for channel in channels:
+            # Consumers send what's queued, then the reconnect event, then finish
+            channel.reconnect_after = self.retry_hint()
+            channel.close()
+        if self._channels:
+            self._empty.clear()
+            try:
+                await asyncio.wait_for(self._empty.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        remaining = len(self._channels)
+        if remaining:
+            logger.warning("Drain deadline passed with %s connections still open", remaining)
+        else:
+            logger.info("✅ All connections drained")
+        return remaining
+
+    def drain(self, timeout: Optional[float] = None) -> asyncio.Task:
+        """Start draining (once); the task's result is how many connections were left open"""
+        self.draining = True
+        if self._drain is None:
+            self._drain = asyncio.ensure_future(self._run(self.timeout if timeout is None else timeout))
+        return self._drain
+
+    def resume(self) -> bool:
+        """Accept connections again after a drain; False if the server is shutting down anyway"""
+        if shutdown_requested():
+            return False
+        if self._drain is not None and not self._drain.done():
+            self._drain.cancel()
+        self._drain = None
+        self.draining = False
+        logger.info("🚰 Drain cancelled; accepting connections again")
+        return True
+
+    async def watch(self) -> None:
+        while not shutdown_requested():
+            await asyncio.sleep(self.poll_interval)
+        await self.drain()
+
+    def start(self) -> None:
+        # A new loop (and a fresh start) after a previous run, e.g. in tests
+        self._empty = asyncio.Event()
+        if not self._channels:
+            self._empty.set()
+        self.draining = False
+        self._drain = None
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self.watch())
+
+    async def stop(self) -> None:
+        """Drain whatever is still connected, then stop watching"""
+        await self.drain()
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+
+    def __len__(self) -> int:
+        return len(self._channels)
@@ -0,0 +1,251 @@
+"""
+Event fan-out for browser channels.
+
+Producers call `bus.publish(session_id, {"type": ..., "data": ...})`. The
+event is serialized once and the same bytes are handed to every channel
+attached to the session (SSE streams, WebSockets) and to its polling queue.
+Each channel has its own bounded buffer, so a slow consumer never blocks
+the producer or other channels: it either drops its own oldest events or,
+with the "disconnect" overflow policy, is closed and detached.
+"""
+import asyncio
+import logging
+import os
+from typing import Iterable, Optional, Tuple
+
+from sse_starlette.sse import EventSourceResponse, SendTimeoutError
+
+from metrics import Counter
+import wire
+from serialization import dumps, loads
+from session_store import next_sequence
+
+logger = logging.getLogger(__name__)
+
+# Per-channel buffer size
+CHANNEL_BUFFER_SIZE = int(os.environ.get("STRONGHOLD_CHANNEL_BUFFER_SIZE", 64))
+
+# What to do when a channel's buffer is full
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+CHANNEL_OVERFLOW = os.environ.get("STRONGHOLD_CHANNEL_OVERFLOW", DROP_OLDEST)
+
+CHANNEL_OVERFLOWS = Counter(
+    "stronghold_channel_overflows_total",
+    "Events that found a channel's buffer full, by what was done about it",
+    labelnames=("action",),
+)
+_DROPPED = CHANNEL_OVERFLOWS.labels("dropped")
+_DISCONNECTED = CHANNEL_OVERFLOWS.labels("disconnected")
+
+
+class Event:
+    """An event serialized once for every channel"""
+    __slots__ = ("type", "payload", "_text", "_packed")
+
+    def __init__(self, type: str, payload: bytes):
+        self.type = type
+        self.payload = payload
+        self._text = None
+        self._packed = None
+
+    @classmethod
+    def build(cls, type: str, data=None) -> "Event":
+        return cls(type, dumps({"type": type, "data": data}))
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.payload.decode()
+        return self._text
+
+    @property
+    def packed(self) -> bytes:
+        """The binary frame for WebSocket clients that negotiated MessagePack (see wire.py)"""
+        if self._packed is None:
+            self._packed = wire.encode_event(self.type, loads(self.payload).get("data"))
+        return self._packed
+
+    def __repr__(self):
+        return f"Event({self.type!r})"
+
+
+# Fixed events, encoded once and shared by every publish
+AUTH_COMPLETE = Event.build("auth_complete", {})
+AUTH_FAILED = Event.build("auth_failed", {})
+CLEANUP_SESSION = Event.build("cleanup_session", {})
+
+
+def encode_batch(payloads: Iterable[bytes], cursor: Optional[int] = None) -> bytes:
+    """JSON body for a list of already-encoded events (and the cursor to resume from)"""
+    body = b'{"events":[' + b",".join(payloads) + b"]"
+    if cursor is not None:
+        body += b',"cursor":%d' % cursor
+    return body + b"}"
+
+
+def encode_sessions(batches: Iterable[Tuple[str, bytes]]) -> bytes:
+    """JSON body for a batched poll: {"sessions": {id: <encode_batch body>, ...}}"""
+    return b'{"sessions":{' + b",".join(dumps(session_id) + b":" + body
+                                       for session_id, body in batches) + b"}}"
+
+
+class Channel:
+    """Bounded buffer between the bus and one connected client"""
+
+    def __init__(self, maxsize: int = CHANNEL_BUFFER_SIZE, overflow: str = CHANNEL_OVERFLOW):
+        if overflow not in (DROP_OLDEST, DISCONNECT):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.overflow = overflow
+        self.dropped = 0
+        self.closed = False
+        self.overflowed = False
+        # Set (in milliseconds) when the server drains: tell the client to come back later
+        self.reconnect_after: Optional[int] = None
+
+    def deliver(self, event: Event, seq: int = 0) -> bool:
+        """Buffer an event and its sequence number; False once the channel is closed"""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait((seq, event))
+        except asyncio.QueueFull:
+            if self.overflow == DISCONNECT:
+                # The consumer is stuck or gone; make it reconnect
+                _DISCONNECTED.inc()
+                self.overflowed = True
+                self.close()
+                return False
+            # Drop the oldest event so the newest state always gets through
+            self.queue.get_nowait()
+            self.dropped += 1
+            _DROPPED.inc()
+            self.queue.put_nowait((seq, event))
+        return True
+
+    async def get(self) -> Optional[Tuple[int, Event]]:
+        """Next (seq, event), or None once the channel is closed"""
+        if self.closed and self.queue.empty():
+            return None
+        return await self.queue.get()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        # Wake a consumer blocked in get(); one that still has events to read
+        # gets None from get() once they run out
+        if self.queue.empty():
+            self.queue.put_nowait(None)
+
+
+class SSEChannel(Channel):
+    """Channel feeding an EventSourceResponse generator"""
+
+
+class SSEResponse(EventSourceResponse):
+    """
+    EventSourceResponse that treats a send timeout as a dead client.
+
+    Heartbeat pings keep proxies from idling the stream out, and a peer that
+    has stopped reading makes a ping or event write stall; after
+    `send_timeout` the response ends quietly (the generator's cleanup runs)
+    instead of surfacing as a server error.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        except SendTimeoutError:
+            logger.debug("SSE client stopped reading; closing the stream")
+
+
+class WebSocketChannel(Channel):
+    """Channel drained into a WebSocket by `pump`"""
+
+    def __init__(self, websocket, maxsize: int = CHANNEL_BUFFER_SIZE, overflow: str = CHANNEL_OVERFLOW,
+                 encoding: str = wire.JSON):
+        super().__init__(maxsize, overflow)
+        self.websocket = websocket
+        self.encoding = encoding
+
+    async def send(self, event: Event) -> None:
+        if self.encoding == wire.MSGPACK:
+            await self.websocket.send_bytes(event.packed)
+        else:
+            await self.websocket.send_text(event.text)
+
+    async def pump(self) -> None:
+        try:
+            while True:
+                entry = await self.get()
+                if entry is None:
+                    break
+                await self.send(entry[1])
+            if self.overflowed:
+                # 1013: try again later
+                await self.websocket.close(code=1013)
+            elif self.reconnect_after is not None:
+                # 1012: service restart, with a hint for when to come back
+                await self.send(Event.build("reconnect", {"retry": self.reconnect_after}))
+                await self.websocket.close(code=1012)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error("Error writing to WebSocket: %s", e)
+            self.closed = True
+
+
+class EventBus:
+    """
+    Publishes events to whatever channels a session has attached.
+
+    Events go through a broker (see broker.py) so that, with a cross-process
+    broker, channels attached in other workers receive them too.
+    """
+
+    def __init__(self, store, broker=None):
+        self.store = store
+        if broker is None:
+            from broker import InProcessBroker
+            broker = InProcessBroker()
+        self.broker = broker
+        broker.bind(self.deliver)
+
+    def publish(self, session_id: str, event) -> int:
+        """
+        Publish `event` (a {"type", "data"} dict or a prebuilt Event) to the
+        session. Returns how many local channels and queues it reached.
+        """
+        if not isinstance(event, Event):
+            event = Event.build(event["type"], event.get("data"))
+        # Numbered here, once, so every worker resumes cursors from the same numbers
+        return self.broker.publish(session_id, event, next_sequence())
+
+    def deliver(self, session_id: str, event: Event, seq: int) -> int:
+        """Hand an event to this worker's polling queue (the replay log) and channels"""
+        delivered = 0
+        queue = self.store.events(session_id, create=session_id in self.store)
+        if queue is not None:
+            queue.append(event.payload, seq)
+            delivered += 1
+        closed = None
+        for channel in self.store.subscribers(session_id):
+            if channel.deliver(event, seq):
+                delivered += 1
+            else:
+                closed = (closed or []) + [channel]
+        # Release closed channels now rather than when their consumer notices
+        for channel in closed or ():
+            self.store.detach(session_id, channel)
+        return delivered
+
+    def has_subscribers(self, session_id: str) -> bool:
+        return bool(self.store.subscribers(session_id))
+
+    def close(self, session_id: str, kind: type = Channel) -> None:
+        """Close the session's channels of the given kind"""
+        for channel in self.store.subscribers(session_id):
+            if isinstance(channel, kind):
+                channel.close()
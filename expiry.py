@@ -0,0 +1,126 @@
+"""
+TTL bookkeeping and a single background reaper.
+
+Deadlines sit in a min-heap, so each reaper pass only looks at entries that
+have actually expired instead of scanning every dict. Re-scheduling a key
+pushes a fresh heap entry and leaves the old one to be skipped when popped.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTLS = {
+    "session": float(os.environ.get("STRONGHOLD_SESSION_TTL", 30 * 60)),
+    "step_up": float(os.environ.get("STRONGHOLD_STEP_UP_TTL", 10 * 60)),
+    "polling": float(os.environ.get("STRONGHOLD_POLLING_TTL", 5 * 60)),
+}
+
+EVICTIONS = Counter(
+    "stronghold_reaper_evictions_total",
+    "Records evicted by the TTL reaper",
+    labelnames=("kind",),
+)
+
+
+class ExpiryReaper:
+    """
+    Tracks a deadline per (kind, key) and evicts expired keys in batches.
+
+    An evictor returns False to keep a key alive (e.g. a session with a live
+    WebSocket); the key is then re-armed with its full TTL.
+    """
+
+    def __init__(self, ttls: Optional[Dict[str, float]] = None, batch_size: int = 500,
+                 interval: float = 1.0, clock: Callable[[], float] = time.monotonic):
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        for kind in self.ttls:
+            EVICTIONS.inc(0, kind)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.clock = clock
+        self._heap: List[Tuple[float, str, str]] = []
+        self._deadlines: Dict[Tuple[str, str], float] = {}
+        self._evictors: Dict[str, Callable[[str], Optional[bool]]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, kind: str, evictor: Callable[[str], Optional[bool]]) -> None:
+        self._evictors[kind] = evictor
+
+    def schedule(self, kind: str, key: str, ttl: Optional[float] = None) -> None:
+        """(Re)arm the deadline for a key"""
+        deadline = self.clock() + (self.ttls[kind] if ttl is None else ttl)
+        self._deadlines[(kind, key)] = deadline
+        heapq.heappush(self._heap, (deadline, kind, key))
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._compact()
+
+    def cancel(self, kind: str, key: str) -> None:
+        self._deadlines.pop((kind, key), None)
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def _compact(self) -> None:
+        """Drop heap entries superseded by a later schedule or a cancel"""
+        self._heap = [(d, k, key) for (k, key), d in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def reap(self, limit: Optional[int] = None) -> int:
+        """Evict up to `limit` expired keys; returns how many were evicted"""
+        now = self.clock()
+        limit = self.batch_size if limit is None else limit
+        evicted = 0
+        heap = self._heap
+        while heap and heap[0][0] <= now and evicted < limit:
+            deadline, kind, key = heapq.heappop(heap)
+            if self._deadlines.get((kind, key)) != deadline:
+                continue  # stale entry
+            del self._deadlines[(kind, key)]
+            evictor = self._evictors.get(kind)
+            try:
+                keep = evictor is not None and evictor(key) is False
+            except Exception as e:
+                logger.error("Error evicting %s %s: %s", kind, key, e)
+                continue
+            if keep:
+                self.schedule(kind, key)
+                continue
+            EVICTIONS.inc(1, kind)
+            evicted += 1
+        return evicted
+
+    def _has_expired(self) -> bool:
+        return bool(self._heap) and self._heap[0][0] <= self.clock()
+
+    async def run(self) -> None:
+        while True:
+            while self._has_expired():
+                self.reap()
+                await asyncio.sleep(0)  # let request handlers in between batches
+            if self._heap:
+                delay = min(self.interval, max(self._heap[0][0] - self.clock(), 0))
+            else:
+                delay = self.interval
+            await asyncio.sleep(delay)
+
+    def start(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
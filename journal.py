@@ -0,0 +1,181 @@
+"""
+Append-only journal with snapshots, for keeping in-memory state across restarts.
+
+Mutations are appended as JSON lines to journal-<generation>.log by a writer
+thread. Whatever accumulates while the previous batch is being written and
+fsynced goes out as one write and one fsync (group commit), so a burst of
+step-ups costs a handful of disk flushes rather than one each, and the event
+loop never waits on the disk.
+
+Every `snapshot_every` entries the owner's full state is written to
+snapshot.json (atomically) and a new journal generation starts; older
+generations are deleted. On boot `load()` returns the snapshot plus every
+entry journaled after it, read in bulk. A torn last line from a crash
+mid-write is ignored.
+"""
+import glob
+import logging
+import os
+import threading
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_NAME = "snapshot.json"
+
+
+class _Snapshot:
+    """Queue marker: write this state, then start a new generation"""
+    __slots__ = ("state",)
+
+    def __init__(self, state: dict):
+        self.state = state
+
+
+class Journal:
+    def __init__(self, directory: str, state: Callable[[], dict], snapshot_every: int = 10000,
+                 fsync: bool = True):
+        self.directory = directory
+        self.state = state
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self.generation = 0
+        self._since_snapshot = 0
+        self._queue: list = []
+        self._appended = 0
+        self._durable = 0
+        self._cond = threading.Condition()
+        self._closing = False
+        self._file = None
+        self._thread: Optional[threading.Thread] = None
+
+    # -- reading ---------------------------------------------------------
+
+    def _path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"journal-{generation:08d}.log")
+
+    def _generations(self) -> List[int]:
+        paths = glob.glob(os.path.join(self.directory, "journal-*.log"))
+        return sorted(int(os.path.basename(p)[8:-4]) for p in paths)
+
+    def load(self) -> Tuple[Optional[dict], List[list]]:
+        """The last snapshot (or None) and the entries journaled after it, oldest first"""
+        snapshot = None
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                snapshot = loads(f.read())
+            self.generation = snapshot["generation"]
+        entries = []
+        for generation in self._generations():
+            if generation <= self.generation:
+                continue
+            entries.extend(self._read(self._path(generation)))
+            self.generation = generation
+        return snapshot, entries
+
+    @staticmethod
+    def _read(path: str) -> Iterator[list]:
+        with open(path, "rb") as f:
+            data = f.read()
+        lines = data.split(b"\n")
+        for number, line in enumerate(lines):
+            if not line:
+                continue
+            try:
+                yield loads(line)
+            except ValueError:
+                if number < len(lines) - 1:
+                    raise
+                logger.warning("Ignoring torn last entry in %s", path)
+
+    # -- writing ---------------------------------------------------------
+
+    def start(self) -> None:
+        """Compact what `load()` returned into a fresh snapshot and start the writer"""
+        self._write_snapshot(self.state())
+        self._thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self._thread.start()
+
+    def append(self, entry: list) -> None:
+        line = dumps(entry) + b"\n"
+        with self._cond:
+            self._queue.append(line)
+            self._appended += 1
+            self._since_snapshot += 1
+            if self._since_snapshot >= self.snapshot_every:
+                # Taken on the caller's thread so it matches the entries queued before it
+                self._queue.append(_Snapshot(self.state()))
+                self._since_snapshot = 0
+            self._cond.notify()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything appended so far is on disk"""
+        with self._cond:
+            target = self._appended
+            return self._cond.wait_for(lambda: self._durable >= target or self._thread is None, timeout)
+
+    def _write_snapshot(self, state: dict) -> None:
+        generation = self.generation + 1
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(dumps(dict(state, generation=self.generation)))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self._path(generation), "ab")
+        self.generation = generation
+        for old in self._generations():
+            if old < generation:
+                os.remove(self._path(old))
+
+    def _commit(self, lines: List[bytes]) -> None:
+        self._file.write(b"".join(lines))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._closing)
+                batch, self._queue = self._queue, []
+                closing = self._closing
+            lines = []
+            try:
+                for item in batch:
+                    if isinstance(item, _Snapshot):
+                        if lines:
+                            self._commit(lines)
+                            lines = []
+                        self._write_snapshot(item.state)
+                    else:
+                        lines.append(item)
+                if lines:
+                    self._commit(lines)
+            except OSError as e:
+                logger.error("Journal write failed: %s", e)
+            with self._cond:
+                self._durable += sum(1 for item in batch if not isinstance(item, _Snapshot))
+                self._cond.notify_all()
+            if closing and not batch:
+                return
+
+    def close(self) -> None:
+        """Write out everything queued and stop the writer"""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        self._file = None
@@ -0,0 +1,397 @@
+"""
+Load test for the full step-up flow.
+
+Each virtual user plays both sides of a step-up:
+
+    browser: POST /start-session, then listens for events over the transport
+    mobile:  POST /get-pin-options, POST /verify-pin-selection with the PIN
+    browser: receives auth_complete
+
+Transports:
+- websocket: /ws/{session_id}
+- sse:       /register-sse?session_id=...
+- polling:   long-polls /poll-updates/{session_id}?wait=...
+
+All users connect before any of them approves, so the server holds every
+session and connection at once; its resident memory is sampled at that
+point. Step-up latency runs from the mobile's /get-pin-options request to
+the browser receiving auth_complete.
+
+By default a fresh uvicorn is launched per transport on a free local port;
+pass --url to target a server that is already running (memory is then not
+reported).
+
+    python loadtest.py --users 2000 --processes 4 --transports websocket sse polling
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+import websockets
+
+TRANSPORTS = ("websocket", "sse", "polling")
+
+
+def _raise_fd_limit() -> None:
+    """Thousands of connections need more than the usual 1024 descriptors"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident set size of a process (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class LocalServer:
+    """uvicorn serving app:app in a child process"""
+
+    def __init__(self, port: Optional[int] = None, env: Optional[Dict[str, str]] = None):
+        self.port = port or _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        # Every virtual user comes from 127.0.0.1, which per-IP rate limits would throttle
+        self.env = {**os.environ, "STRONGHOLD_LOG_LEVEL": "WARNING", "STRONGHOLD_RATE_LIMITS": "off",
+                    **(env or {})}
+        self.process: Optional[subprocess.Popen] = None
+
+    async def __aenter__(self) -> "LocalServer":
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1",
+             "--port", str(self.port), "--log-level", "warning", "--backlog", "4096"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=self.env)
+        async with httpx.AsyncClient(base_url=self.url) as client:
+            for _ in range(200):
+                try:
+                    await client.get("/vapid-public-key")
+                    return self
+                except httpx.TransportError:
+                    await asyncio.sleep(0.05)
+        raise RuntimeError("uvicorn did not start")
+
+    async def __aexit__(self, *exc) -> None:
+        self.process.terminate()
+        self.process.wait(10)
+
+    def rss(self) -> Optional[int]:
+        return rss_bytes(self.process.pid)
+
+
+class VirtualUser:
+    def __init__(self, transport: str, base_url: str, http: httpx.AsyncClient,
+                 streams: httpx.AsyncClient, timeout: float):
+        self.transport = transport
+        self.base_url = base_url
+        self.http = http
+        self.streams = streams
+        self.timeout = timeout
+        self.username = f"loadtest-{uuid.uuid4().hex}"
+        self.connect_latency: Optional[float] = None
+        self.step_up_latency: Optional[float] = None
+        self.error: Optional[str] = None
+
+    async def run(self, connected: "Barrier", approve: asyncio.Event) -> None:
+        try:
+            started = time.perf_counter()
+            response = await asyncio.wait_for(
+                self.http.post("/start-session", json={"username": self.username}), self.timeout)
+            response.raise_for_status()
+            session = response.json()
+            listen = getattr(self, f"_listen_{self.transport}")(session["session_id"])
+            events = await asyncio.wait_for(listen.__aenter__(), self.timeout)
+            try:
+                self.connect_latency = time.perf_counter() - started
+                connected.arrive()
+                await approve.wait()
+                await asyncio.wait_for(self._approve(session, events), self.timeout)
+            finally:
+                await listen.__aexit__(None, None, None)
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+        finally:
+            connected.arrive()  # never leave the others waiting on a failed user
+
+    async def _approve(self, session: dict, events) -> None:
+        """The mobile side: fetch the options, pick the right PIN, wait for the browser to hear"""
+        approved = time.perf_counter()
+        options = (await self.http.post("/get-pin-options", json={"username": self.username})).json()
+        if session["pin"] not in options["pins"]:
+            raise AssertionError("correct PIN missing from options")
+        result = await self.http.post("/verify-pin-selection",
+                                      json={"pin": session["pin"], "session_id": session["session_id"]})
+        if result.json() != {"success": True}:
+            raise AssertionError(f"verification failed: {result.text}")
+        async for event in events:
+            if event == "auth_complete":
+                self.step_up_latency = time.perf_counter() - approved
+                return
+        raise AssertionError("stream ended before auth_complete")
+
+    def _listen_websocket(self, session_id: str):
+        user = self
+
+        class Listener:
+            async def __aenter__(self):
+                url = user.base_url.replace("http", "ws", 1) + f"/ws/{session_id}"
+                self.ws = await websockets.connect(url, open_timeout=user.timeout)
+                return self.events()
+
+            async def events(self):
+                async for message in self.ws:
+                    yield json.loads(message)["type"]
+
+            async def __aexit__(self, *exc):
+                await self.ws.close()
+
+        return Listener()
+
+    def _listen_sse(self, session_id: str):
+        user = self
+
+        class Listener:
+            async def __aenter__(self):
+                self.stream = user.streams.stream("GET", "/register-sse", params={"session_id": session_id})
+                self.response = await self.stream.__aenter__()
+                self.lines = self.response.aiter_lines()
+                # The first message (the client ID) means the channel is attached
+                async for line in self.lines:
+                    if line.startswith("data:"):
+                        break
+                return self.events()
+
+            async def events(self):
+                async for line in self.lines:
+                    if line.startswith("event:"):
+                        yield line[6:].strip()
+
+            async def __aexit__(self, *exc):
+                await self.stream.__aexit__(None, None, None)
+
+        return Listener()
+
+    def _listen_polling(self, session_id: str):
+        user = self
+
+        class Listener:
+            async def __aenter__(self):
+                # The session's queue collects events from here on
+                await user.streams.get(f"/poll-updates/{session_id}")
+                return self.events()
+
+            async def events(self):
+                while True:
+                    response = await user.streams.get(f"/poll-updates/{session_id}", params={"wait": 25})
+                    for event in response.json()["events"]:
+                        yield event["type"]
+
+            async def __aexit__(self, *exc):
+                pass
+
+        return Listener()
+
+
+class Barrier:
+    """Set once `parties` users have connected (or failed)"""
+
+    def __init__(self, parties: int):
+        self.remaining = parties
+        self.done = asyncio.Event()
+        self._arrived = set()
+
+    def arrive(self) -> None:
+        task = asyncio.current_task()
+        if task in self._arrived:
+            return
+        self._arrived.add(task)
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.done.set()
+
+
+async def drive(transport: str, users: int, base_url: str, timeout: float,
+                on_connected: Callable[[], Awaitable[None]]) -> dict:
+    """
+    Run `users` virtual users in this process. `on_connected` is awaited once
+    they have all connected, before any of them approves.
+    """
+    unlimited = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout,
+                                 limits=httpx.Limits(max_connections=200)) as http, \
+            httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=unlimited) as streams:
+        connected = Barrier(users)
+        approve = asyncio.Event()
+        vus = [VirtualUser(transport, base_url, http, streams, timeout) for _ in range(users)]
+        tasks = [asyncio.create_task(vu.run(connected, approve)) for vu in vus]
+        await connected.done.wait()
+        await on_connected()
+        approved = time.time()
+        approve.set()
+        await asyncio.gather(*tasks)
+    return {
+        "approved": approved,
+        "finished": time.time(),
+        "connects": [vu.connect_latency for vu in vus if vu.connect_latency is not None],
+        "step_ups": [vu.step_up_latency for vu in vus if vu.step_up_latency is not None],
+        "errors": [vu.error for vu in vus if vu.error],
+    }
+
+
+def _drive_in_child(transport, users, base_url, timeout, connected, approve, results) -> None:
+    """Client process body for --processes: syncs with the parent at both barriers"""
+    async def on_connected():
+        await asyncio.to_thread(connected.wait)
+        await asyncio.to_thread(approve.wait)
+
+    _raise_fd_limit()
+    results.put(asyncio.run(drive(transport, users, base_url, timeout, on_connected)))
+
+
+async def run_transport(transport: str, users: int, base_url: Optional[str] = None,
+                        timeout: float = 60.0, processes: int = 1,
+                        server_env: Optional[Dict[str, str]] = None) -> dict:
+    """
+    Drive `users` concurrent step-ups over one transport and summarize them.
+    With `processes` > 1 the users are split over that many client processes,
+    so the load generator itself doesn't become the bottleneck.
+    """
+    if base_url is None:
+        async with LocalServer(env=server_env) as server:
+            return await _run(transport, users, server.url, timeout, processes, server.rss)
+    return await _run(transport, users, base_url, timeout, processes, lambda: None)
+
+
+async def _run(transport, users, base_url, timeout, processes, rss) -> dict:
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        await client.post("/start-session", json={"username": "loadtest-warmup"})
+    baseline = rss()
+    held = None
+    started = time.time()
+
+    if processes <= 1:
+        async def on_connected():
+            nonlocal held
+            held = rss()
+
+        runs = [await drive(transport, users, base_url, timeout, on_connected)]
+    else:
+        context = multiprocessing.get_context("spawn")
+        connected = context.Barrier(processes + 1)
+        approve = context.Barrier(processes + 1)
+        results = context.Queue()
+        shares = [users // processes + (i < users % processes) for i in range(processes)]
+        children = [context.Process(target=_drive_in_child,
+                                    args=(transport, share, base_url, timeout, connected, approve, results))
+                    for share in shares]
+        for child in children:
+            child.start()
+        await asyncio.to_thread(connected.wait)
+        held = rss()
+        await asyncio.to_thread(approve.wait)
+        runs = [await asyncio.to_thread(results.get) for _ in children]
+        for child in children:
+            await asyncio.to_thread(child.join)
+
+    connects = [t * 1000 for run in runs for t in run["connects"]]
+    step_ups = [t * 1000 for run in runs for t in run["step_ups"]]
+    errors = [e for run in runs for e in run["errors"]]
+    approved = min(run["approved"] for run in runs)
+    finished = max(run["finished"] for run in runs)
+    return {
+        "transport": transport,
+        "users": users,
+        "completed": len(step_ups),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "duration_s": finished - started,
+        "throughput": len(step_ups) / (finished - approved) if step_ups else 0.0,
+        "connect_p50_ms": statistics.median(connects) if connects else None,
+        "connect_p99_ms": percentile(connects, 99) if connects else None,
+        "step_up_p50_ms": statistics.median(step_ups) if step_ups else None,
+        "step_up_p95_ms": percentile(step_ups, 95) if step_ups else None,
+        "step_up_p99_ms": percentile(step_ups, 99) if step_ups else None,
+        "step_up_max_ms": max(step_ups) if step_ups else None,
+        "memory_per_session_kb": ((held - baseline) / users / 1024
+                                  if baseline is not None and held is not None else None),
+    }
+
+
+def format_results(results: List[dict]) -> str:
+    columns = [
+        ("transport", "transport", "{}"),
+        ("completed", "ok", "{}"),
+        ("errors", "errors", "{}"),
+        ("throughput", "step-ups/s", "{:.0f}"),
+        ("connect_p50_ms", "connect p50", "{:.1f}"),
+        ("step_up_p50_ms", "p50 ms", "{:.1f}"),
+        ("step_up_p95_ms", "p95 ms", "{:.1f}"),
+        ("step_up_p99_ms", "p99 ms", "{:.1f}"),
+        ("step_up_max_ms", "max ms", "{:.1f}"),
+        ("memory_per_session_kb", "KiB/session", "{:.1f}"),
+    ]
+    lines = ["".join(f"{title:>12}" for _, title, _ in columns)]
+    for result in results:
+        cells = []
+        for key, _, fmt in columns:
+            value = result[key]
+            cells.append(f"{'-' if value is None else fmt.format(value):>12}")
+        lines.append("".join(cells))
+    for result in results:
+        if result["first_error"]:
+            lines.append(f"{result['transport']}: first error: {result['first_error']}")
+    return "\n".join(lines)
+
+
+async def main(args) -> int:
+    results = []
+    for transport in args.transports:
+        results.append(await run_transport(transport, args.users, args.url, args.timeout, args.processes))
+    print(format_results(results))
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+    return 1 if any(r["errors"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the step-up flow")
+    parser.add_argument("--users", type=int, default=1000, help="concurrent virtual users per transport")
+    parser.add_argument("--transports", nargs="+", choices=TRANSPORTS, default=list(TRANSPORTS))
+    parser.add_argument("--url", help="target an already running server instead of launching one")
+    parser.add_argument("--timeout", type=float, default=60.0,
+                        help="per-user timeout in seconds, for connecting and for approving")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="split the users over this many client processes")
+    parser.add_argument("--json", help="also write the results to this file")
+    _raise_fd_limit()
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,133 @@
+"""
+Logging setup that keeps log I/O off the request path.
+
+Handlers on the event loop only enqueue the LogRecord; formatting, PIN
+redaction and the actual write happen on a QueueListener thread. Records
+are enqueued unformatted, so a message below the configured level costs
+nothing beyond the level check.
+
+Environment:
+- STRONGHOLD_LOG_LEVEL: root level (default INFO)
+- STRONGHOLD_LOG_MODE: "plain" (default) or "structured" for one JSON
+  object per line
+- STRONGHOLD_REQUEST_LOG_SAMPLE: fraction of successful requests logged at
+  INFO (default 1.0); the rest are logged at DEBUG. Errors are always logged.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+from typing import Optional
+
+PLAIN_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+REQUEST_LOG_SAMPLE = float(os.environ.get("STRONGHOLD_REQUEST_LOG_SAMPLE", 1.0))
+
+# "pin": "42", pin=42, PIN 1234, correct_pin: 12345 ... but not URL paths like /generate-pin.
+# A safety net: PIN values shouldn't be logged in the first place.
+PIN_PATTERN = re.compile(r"""(?i)((?<![-/])pin\b["']?\s*[:=]?\s*["']?)\d+""")
+
+# Attributes every LogRecord has; anything else was passed via `extra=`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# Correlation ID of the request being handled, set by RequestLoggingMiddleware
+request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+
+def redact(text: str) -> str:
+    """Mask anything that looks like a PIN"""
+    return PIN_PATTERN.sub(r"\1****", text)
+
+
+class RedactingFilter(logging.Filter):
+    """Resolves the message once and strips PINs from it"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = redact(record.getMessage())
+        record.args = None
+        return True
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamps records with the current request's correlation ID"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        current = request_id.get()
+        if current is not None:
+            record.request_id = current
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    """One JSON object per record, including any `extra=` fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records as-is. The stock QueueHandler formats the message in
+    the calling thread; here that is left to the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure_logging(level: Optional[str] = None, mode: Optional[str] = None,
+                      stream=None) -> logging.handlers.QueueListener:
+    """Route the root logger through a background writer thread (idempotent)"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    level = (level or os.environ.get("STRONGHOLD_LOG_LEVEL", "INFO")).upper()
+    mode = mode or os.environ.get("STRONGHOLD_LOG_MODE", "plain")
+
+    output = logging.StreamHandler(stream)
+    output.addFilter(RedactingFilter())
+    if mode == "structured":
+        output.setFormatter(StructuredFormatter())
+    else:
+        output.setFormatter(logging.Formatter(PLAIN_FORMAT))
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    # Read the request ID on the caller's side, before the record crosses threads
+    enqueue = DeferredQueueHandler(records)
+    enqueue.addFilter(RequestIdFilter())
+    root.addHandler(enqueue)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging() -> None:
+    """Flush queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,259 @@
+"""
+In-process metrics rendered in the Prometheus text exposition format.
+
+Everything is updated from the event loop, so there are no locks: a labelled
+child is allocated once (`metric.labels(...)`) and the hot path only bumps a
+float or a bucket slot. Gauges can also be backed by a function that is only
+evaluated when /metrics is scraped.
+"""
+import asyncio
+import bisect
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+# Seconds; suits both request handling and step-up round trips
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+
+
+def _format_value(value: float) -> str:
+    """Full precision: whole numbers as integers, anything else as repr(float)"""
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Value:
+    """A single pre-allocated sample"""
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 registry: "Registry" = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], _Value] = {}
+        if not self.labelnames:
+            self.labels()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *labelvalues: str) -> _Value:
+        """The sample for these label values; keep it around on hot paths"""
+        child = self._children.get(labelvalues)
+        if child is None:
+            child = self._children[labelvalues] = _Value()
+        return child
+
+    def inc(self, amount: float = 1, *labelvalues: str) -> None:
+        self.labels(*labelvalues).inc(amount)
+
+    def value(self, *labelvalues: str) -> float:
+        child = self._children.get(labelvalues)
+        return child.value if child else 0
+
+    def samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        return [(self.name, tuple(zip(self.labelnames, labels)), child.value)
+                for labels, child in self._children.items()]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, or is read from `function` at scrape time"""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 registry: "Registry" = None, function: Optional[Callable[[], float]] = None):
+        self.function = function
+        super().__init__(name, documentation, labelnames, registry)
+
+    def dec(self, amount: float = 1, *labelvalues: str) -> None:
+        self.labels(*labelvalues).dec(amount)
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        self.labels(*labelvalues).set(value)
+
+    def value(self, *labelvalues: str) -> float:
+        if self.function is not None:
+            return self.function()
+        return super().value(*labelvalues)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, (), self.function())]
+        return super().samples()
+
+
+class _HistogramChild:
+    __slots__ = ("upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+class Histogram(Counter):
+    """Fixed-bucket histogram; buckets are allocated with the labelled child"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 registry: "Registry" = None, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def labels(self, *labelvalues: str) -> _HistogramChild:
+        child = self._children.get(labelvalues)
+        if child is None:
+            child = self._children[labelvalues] = _HistogramChild(self.buckets)
+        return child
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        self.labels(*labelvalues).observe(value)
+
+    def value(self, *labelvalues: str) -> int:
+        """Number of observations"""
+        child = self._children.get(labelvalues)
+        return child.count if child else 0
+
+    def samples(self):
+        samples = []
+        for labelvalues, child in self._children.items():
+            labels = tuple(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                samples.append((f"{self.name}_bucket", labels + (("le", le),), cumulative))
+            samples.append((f"{self.name}_sum", labels, child.sum))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric) -> None:
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    lines.append(f"{name}{{{_format_labels(labels)}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class LatencyTracker:
+    """
+    Times operations that start in one request and finish in another, such as
+    a step-up and its auth_complete. At most `max_pending` starts are kept;
+    the oldest are forgotten first.
+    """
+
+    def __init__(self, histogram: Histogram, max_pending: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        self._observe = histogram.labels().observe
+        self.max_pending = max_pending
+        self.clock = clock
+        self._started: "OrderedDict[Hashable, float]" = OrderedDict()
+
+    def start(self, key: Hashable) -> None:
+        self._started[key] = self.clock()
+        self._started.move_to_end(key)
+        if len(self._started) > self.max_pending:
+            self._started.popitem(last=False)
+
+    def stop(self, key: Hashable) -> Optional[float]:
+        started = self._started.pop(key, None)
+        if started is None:
+            return None
+        elapsed = self.clock() - started
+        self._observe(elapsed)
+        return elapsed
+
+    def __len__(self) -> int:
+        return len(self._started)
+
+
+LOOP_LAG = Histogram(
+    "stronghold_event_loop_lag_seconds",
+    "How late the event loop woke a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+
+class LoopLagMonitor:
+    """Sleeps for `interval` in a loop and records how late it wakes up"""
+
+    def __init__(self, interval: float = 0.5, histogram: Histogram = LOOP_LAG):
+        self.interval = interval
+        self._observe = histogram.labels().observe
+        self._task: Optional[asyncio.Task] = None
+
+    async def run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self._observe(max(time.perf_counter() - started - self.interval, 0))
+
+    def start(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,92 @@
+"""
+Request logging, timing and correlation IDs as plain ASGI middleware.
+
+Unlike BaseHTTPMiddleware, nothing here wraps the response in another task
+or stream: `send` is intercepted only to read the status and add the
+X-Request-ID header, so streaming responses such as the SSE endpoint pass
+through unbuffered. WebSocket and lifespan scopes are not touched at all.
+"""
+import logging
+import random
+import time
+import uuid
+
+from logging_config import REQUEST_LOG_SAMPLE, request_id
+from metrics import Histogram
+
+logger = logging.getLogger("app")
+
+REQUEST_ID_HEADER = b"x-request-id"
+
+REQUEST_LATENCY = Histogram(
+    "stronghold_request_duration_seconds",
+    "HTTP request latency by route",
+    labelnames=("method", "route"),
+)
+
+
+class RequestLoggingMiddleware:
+    def __init__(self, app, sample_rate: float = REQUEST_LOG_SAMPLE):
+        self.app = app
+        self.sample_rate = sample_rate
+        # Histogram child per (method, route), so timing a request is a dict hit
+        self._latency = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        correlation_id = None
+        for name, value in scope["headers"]:
+            if name == REQUEST_ID_HEADER:
+                correlation_id = value.decode("latin-1")[:64]
+                break
+        if not correlation_id:
+            correlation_id = uuid.uuid4().hex
+        token = request_id.set(correlation_id)
+        header = (REQUEST_ID_HEADER, correlation_id.encode("latin-1"))
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", ()), header]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id.reset(token)
+            duration = time.perf_counter() - start
+            self._observe(scope, duration)
+            self._log(scope, status, duration, correlation_id)
+
+    def _observe(self, scope, duration: float) -> None:
+        # The router records the matched route in the scope; label by its
+        # template so IDs in the path don't each get their own series
+        route = scope.get("route")
+        key = (scope["method"], id(route))  # routes define __eq__ but aren't hashable
+        child = self._latency.get(key)
+        if child is None:
+            path = getattr(route, "path", None) or "unmatched"
+            child = self._latency[key] = REQUEST_LATENCY.labels(scope["method"], path)
+        child.observe(duration)
+
+    def _log(self, scope, status: int, duration: float, correlation_id: str) -> None:
+        # Bodies are never logged: they carry PINs and would have to be read twice
+        if status >= 500:
+            level = logging.ERROR
+        elif status >= 400:
+            level = logging.WARNING
+        elif random.random() < self.sample_rate:
+            level = logging.INFO
+        else:
+            level = logging.DEBUG
+        if logger.isEnabledFor(level):
+            duration_ms = duration * 1000
+            logger.log(level, "%s %s %s %.1fms", scope["method"], scope["path"], status, duration_ms,
+                       extra={"method": scope["method"], "path": scope["path"], "status": status,
+                              "duration_ms": round(duration_ms, 1), "request_id": correlation_id})
@@ -0,0 +1,119 @@
+"""
+Request and response models for the JSON endpoints.
+
+FastAPI validates each body against its model (in pydantic-core's compiled
+validators) before the handler runs, so a malformed request is rejected
+with a 400 before any rate-limit bucket or session is touched, and handlers
+only ever see typed, present fields. The same models document the
+responses in the OpenAPI schema.
+"""
+from typing import Annotated, Any, Dict, List, Optional, Union
+
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field, StrictInt, StrictStr, StringConstraints
+
+
+def _digits(value: str) -> str:
+    if not value.isdigit():
+        raise ValueError("PIN must be digits")
+    return value
+
+
+Identifier = Annotated[StrictStr, StringConstraints(min_length=1, max_length=128)]
+Url = Annotated[StrictStr, StringConstraints(min_length=1, max_length=2048)]
+Username = Annotated[StrictStr, StringConstraints(strip_whitespace=True, min_length=1, max_length=256)]
+# Mobile clients send the PIN they were shown, as a string or a number
+Pin = Annotated[Union[StrictStr, StrictInt], AfterValidator(str), AfterValidator(_digits)]
+
+
+class RequestModel(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+
+class UsernameRequest(RequestModel):
+    """Body of /start-session and /get-pin-options"""
+    username: Username
+
+
+class GeneratePinRequest(RequestModel):
+    client_id: Identifier
+
+
+class PinGuess(RequestModel):
+    """Body of /verify-pin and /verify-pin-selection"""
+    pin: Pin
+    session_id: Identifier
+
+
+class PinUpdate(RequestModel):
+    pin: Optional[Pin] = None
+
+
+class StepUpRequest(RequestModel):
+    """Body of /api/step-ups"""
+    username: Username
+    callback_url: Url
+
+
+class MobileMessage(RequestModel):
+    """Body of /send-message/{step_up_id}; `content` is passed to the browser as is"""
+    content: Any
+
+
+class BatchPollRequest(RequestModel):
+    """Body of POST /poll-updates: session IDs (with the cursor to resume from) and how long to wait"""
+    sessions: Union[Dict[Identifier, Optional[StrictInt]], List[Identifier]]
+    wait: float = Field(default=0, ge=0)
+
+
+class PushSubscription(RequestModel):
+    """A browser PushSubscription as serialized by toJSON()"""
+    model_config = ConfigDict(frozen=True, extra="allow")
+    endpoint: Url
+    keys: Dict[str, StrictStr] = {}
+
+
+class PushRegistration(RequestModel):
+    """Body of /register-push: the PushSubscription itself, or one wrapped with who it belongs to"""
+    model_config = ConfigDict(frozen=True, extra="allow")
+    subscription: Optional[PushSubscription] = None
+    username: Optional[Username] = None
+    session_id: Optional[Identifier] = None
+
+    def subscription_info(self) -> dict:
+        if self.subscription is not None:
+            return self.subscription.model_dump()
+        return self.model_dump(exclude={"subscription", "username", "session_id"})
+
+
+class SessionResponse(BaseModel):
+    session_id: str
+    pin: str
+
+
+class PinOptionsResponse(BaseModel):
+    pins: List[str]
+    session_id: str
+
+
+class GeneratedPinResponse(BaseModel):
+    pin: str
+    client_id: str
+    step_up_id: str
+
+
+class VerifiedResponse(BaseModel):
+    session_id: str
+
+
+class VerificationResponse(BaseModel):
+    success: bool
+
+
+def describe_errors(errors) -> str:
+    """One line for a validation error list: "username: Field required; ..." """
+    parts = []
+    for error in errors:
+        # Drop the leading "body" FastAPI puts on body fields
+        loc = [str(part) for part in error.get("loc", ()) if part != "body"]
+        parts.append(f"{'.'.join(loc) or 'body'}: {error.get('msg')}")
+    return "; ".join(parts)
@@ -0,0 +1,224 @@
+"""
+Web Push delivery off the event loop.
+
+`pywebpush.webpush` is synchronous, so deliveries run on a bounded thread
+pool. Each push service origin gets its own pooled requests.Session and a
+concurrency cap, transient failures (429/5xx/network) are retried with
+jittered exponential backoff, and subscriptions the push service reports as
+gone (404/410) are handed to an `on_gone` callback for pruning.
+
+SubscriptionRegistry keeps the browser push subscriptions, indexed by
+username and session so a step-up can find the right device directly.
+"""
+import asyncio
+import logging
+import random
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from py_vapid import Vapid, Vapid01
+from pywebpush import WebPushException, webpush
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+PUSH_RESULTS = Counter(
+    "stronghold_push_deliveries_total",
+    "Web Push delivery attempts by outcome",
+    labelnames=("result",),
+)
+for _result in ("sent", "retried", "gone", "failed"):
+    PUSH_RESULTS.inc(0, _result)
+
+# Statuses that mean the subscription no longer exists
+GONE_STATUSES = {404, 410}
+# Statuses worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class PushSubscription:
+    """A browser push subscription and who it belongs to"""
+    __slots__ = ("endpoint", "info", "username", "session_id")
+
+    def __init__(self, info: dict, username: Optional[str] = None, session_id: Optional[str] = None):
+        self.endpoint = info["endpoint"]
+        # Only what webpush needs
+        self.info = {"endpoint": info["endpoint"], "keys": info.get("keys", {})}
+        self.username = username
+        self.session_id = session_id
+
+
+class SubscriptionRegistry:
+    """
+    Push subscriptions deduplicated by endpoint and indexed by username and
+    session. Bounded overall and per username; the least recently
+    registered subscription is dropped first.
+    """
+
+    def __init__(self, max_size: int = 10000, per_username: int = 5):
+        self.max_size = max_size
+        self.per_username = per_username
+        self._by_endpoint: "OrderedDict[str, PushSubscription]" = OrderedDict()
+        self._by_username: Dict[str, "OrderedDict[str, None]"] = {}
+        self._by_session: Dict[str, "OrderedDict[str, None]"] = {}
+
+    @staticmethod
+    def _index_add(index, key, endpoint):
+        if key is not None:
+            index.setdefault(key, OrderedDict())[endpoint] = None
+
+    @staticmethod
+    def _index_remove(index, key, endpoint):
+        endpoints = index.get(key)
+        if endpoints is not None:
+            endpoints.pop(endpoint, None)
+            if not endpoints:
+                del index[key]
+
+    def add(self, info: dict, username: Optional[str] = None,
+            session_id: Optional[str] = None) -> PushSubscription:
+        """Register (or re-register) a subscription"""
+        subscription = PushSubscription(info, username, session_id)
+        self.remove(subscription.endpoint)
+        self._by_endpoint[subscription.endpoint] = subscription
+        self._index_add(self._by_username, username, subscription.endpoint)
+        self._index_add(self._by_session, session_id, subscription.endpoint)
+
+        if username is not None:
+            endpoints = self._by_username[username]
+            while len(endpoints) > self.per_username:
+                self.remove(next(iter(endpoints)))
+        while len(self._by_endpoint) > self.max_size:
+            self.remove(next(iter(self._by_endpoint)))
+        return subscription
+
+    def remove(self, endpoint: str) -> Optional[PushSubscription]:
+        subscription = self._by_endpoint.pop(endpoint, None)
+        if subscription is not None:
+            self._index_remove(self._by_username, subscription.username, endpoint)
+            self._index_remove(self._by_session, subscription.session_id, endpoint)
+        return subscription
+
+    def for_username(self, username: str) -> List[dict]:
+        return [self._by_endpoint[e].info for e in self._by_username.get(username, ())]
+
+    def for_session(self, session_id: str) -> List[dict]:
+        return [self._by_endpoint[e].info for e in self._by_session.get(session_id, ())]
+
+    def all(self) -> List[dict]:
+        return [subscription.info for subscription in self._by_endpoint.values()]
+
+    def __len__(self) -> int:
+        return len(self._by_endpoint)
+
+
+class PushDispatcher:
+    """Delivers Web Push messages concurrently without blocking the event loop"""
+
+    def __init__(self, vapid_private_key, vapid_claims: Dict[str, str],
+                 max_workers: int = 16, per_origin_limit: int = 8, retries: int = 3,
+                 backoff: float = 0.5, timeout: float = 10,
+                 on_gone: Optional[Callable[[dict], None]] = None, send: Callable = webpush):
+        self.vapid_private_key = vapid_private_key
+        self.vapid_claims = vapid_claims
+        self.max_workers = max_workers
+        self.per_origin_limit = per_origin_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.on_gone = on_gone
+        self._send = send
+        self._vapid = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._sessions: Dict[str, requests.Session] = {}
+        self._limits: Dict[str, asyncio.Semaphore] = {}
+        self._global_limit = asyncio.Semaphore(max_workers)
+
+    def _signer(self):
+        """Parse the VAPID key once rather than on every delivery"""
+        if self._vapid is None:
+            key = self.vapid_private_key
+            self._vapid = key if isinstance(key, Vapid01) else Vapid.from_string(private_key=key)
+        return self._vapid
+
+    def _origin(self, subscription: dict) -> str:
+        url = urlparse(subscription.get("endpoint", ""))
+        return f"{url.scheme}://{url.netloc}"
+
+    def _session_for(self, origin: str) -> requests.Session:
+        session = self._sessions.get(origin)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.per_origin_limit)
+            session.mount(origin, adapter)
+            self._sessions[origin] = session
+        return session
+
+    def _deliver_sync(self, subscription: dict, message: str, origin: str):
+        return self._send(
+            subscription_info=subscription,
+            data=message,
+            vapid_private_key=self._signer(),
+            # webpush writes "aud"/"exp" into the claims, so each call gets its own copy
+            vapid_claims=dict(self.vapid_claims),
+            timeout=self.timeout,
+            requests_session=self._session_for(origin),
+        )
+
+    async def send(self, subscription: dict, message: str) -> bool:
+        """Deliver one message, retrying transient failures; True if it was accepted"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="webpush")
+        origin = self._origin(subscription)
+        limit = self._limits.get(origin)
+        if limit is None:
+            limit = self._limits[origin] = asyncio.Semaphore(self.per_origin_limit)
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(self.retries + 1):
+            status = None
+            try:
+                async with self._global_limit, limit:
+                    await loop.run_in_executor(
+                        self._executor, self._deliver_sync, subscription, message, origin)
+                PUSH_RESULTS.inc(1, "sent")
+                return True
+            except WebPushException as e:
+                status = e.response.status_code if e.response is not None else None
+                if status in GONE_STATUSES:
+                    PUSH_RESULTS.inc(1, "gone")
+                    logger.info("Push subscription gone (%s), pruning: %s", status, subscription.get("endpoint"))
+                    if self.on_gone is not None:
+                        self.on_gone(subscription)
+                    return False
+                if status not in RETRY_STATUSES:
+                    logger.error("Push notification failed: %s", e)
+                    break
+            except requests.RequestException:
+                pass  # network error, retry
+            except Exception as e:
+                logger.error("Push notification failed: %s", e)
+                break
+            if attempt < self.retries:
+                PUSH_RESULTS.inc(1, "retried")
+                # Full jitter keeps retries from many deliveries from lining up
+                await asyncio.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+        PUSH_RESULTS.inc(1, "failed")
+        logger.error("Push notification failed for %s", subscription.get("endpoint"))
+        return False
+
+    async def send_many(self, subscriptions: Iterable[dict], message: str) -> List[bool]:
+        """Deliver to several subscriptions concurrently"""
+        return await asyncio.gather(*(self.send(sub, message) for sub in subscriptions))
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
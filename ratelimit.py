@@ -0,0 +1,125 @@
+"""
+In-memory token-bucket rate limiting.
+
+A bucket is two floats (tokens left, when it was last touched) and is only
+refilled when it is next used, so there is no timer per key. Buckets are
+kept in least-recently-used order; a bucket untouched for long enough to
+have refilled completely is indistinguishable from a new one, so each call
+drops those from the front. Memory stays proportional to the keys active in
+the last refill period, and a check is a dict lookup and some arithmetic.
+"""
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+
+from metrics import Counter
+
+RATE_LIMITED = Counter(
+    "stronghold_rate_limited_total",
+    "Requests and WebSocket messages rejected by rate limiting",
+    labelnames=("scope",),
+)
+
+
+def parse_limit(value: str) -> Optional[Tuple[float, float]]:
+    """
+    "RATE/BURST" (per second) as a (rate, burst) pair; "RATE" alone allows a
+    burst of RATE, and "0" or "off" means no limit (None).
+    """
+    value = value.strip()
+    if value.lower() in ("0", "off"):
+        return None
+    rate, _, burst = value.partition("/")
+    rate, burst = float(rate), float(burst or rate)
+    if not (rate > 0 and burst >= 1) or math.isinf(rate) or math.isinf(burst):
+        raise ValueError(f"Invalid rate limit {value!r}: expected RATE/BURST with RATE > 0 and BURST >= 1")
+    return rate, burst
+
+
+def limit_from_env(name: str, default: str) -> Optional[Tuple[float, float]]:
+    return parse_limit(os.environ.get(name, default))
+
+
+def limiter_from_env(name: str, default: str, scope: str) -> Optional["RateLimiter"]:
+    """A RateLimiter configured by `name` ("RATE/BURST"), or None if it's turned off"""
+    limit = limit_from_env(name, default)
+    return RateLimiter(*limit, scope=scope) if limit is not None else None
+
+
+class RateLimiter:
+    """Token buckets of `burst` tokens refilled at `rate` per second, one per key"""
+    __slots__ = ("rate", "burst", "scope", "clock", "max_keys", "_buckets", "_idle", "_rejected")
+
+    def __init__(self, rate: float, burst: float, scope: str = "default",
+                 clock: Callable[[], float] = time.monotonic, max_keys: int = 100000):
+        if not rate > 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst
+        self.scope = scope
+        self.clock = clock
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, list]" = OrderedDict()  # key -> [tokens, stamp]
+        # A bucket idle this long is full again
+        self._idle = burst / rate
+        self._rejected = RATE_LIMITED.labels(scope)
+
+    def _expire(self, now: float) -> None:
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket[1] < self._idle and len(buckets) <= self.max_keys:
+                break
+            del buckets[key]
+
+    def acquire(self, key: Hashable, cost: float = 1) -> float:
+        """
+        Take `cost` tokens for `key`. Returns 0 if allowed, otherwise how many
+        seconds until there would be enough.
+        """
+        now = self.clock()
+        self._expire(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = self.burst
+            bucket = self._buckets[key] = [tokens, now]
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            self._buckets.move_to_end(key)
+        bucket[1] = now
+        if tokens < cost:
+            bucket[0] = tokens
+            self._rejected.inc()
+            return (cost - tokens) / self.rate
+        bucket[0] = tokens - cost
+        return 0
+
+    def allow(self, key: Hashable, cost: float = 1) -> bool:
+        return self.acquire(key, cost) == 0
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+def retry_after(*limits: Tuple[Optional[RateLimiter], Hashable]) -> float:
+    """
+    Check several (limiter, key) pairs, e.g. per IP and per username; returns
+    0 if every one allows the request, else the longest wait. Stops at the
+    first refusal so a rejected request doesn't use up the other buckets.
+    """
+    for limiter, key in limits:
+        if limiter is None or key is None:
+            continue
+        wait = limiter.acquire(key)
+        if wait:
+            return wait
+    return 0
+
+
+def retry_after_header(wait: float) -> str:
+    return str(max(math.ceil(wait), 1))
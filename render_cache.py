@@ -0,0 +1,136 @@
+"""
+Rendered-page cache for the HTML entry points.
+
+The landing pages are Jinja2 templates whose context is constant (or comes
+from a small set of values), so each variant is rendered once and the bytes
+are kept together with a strong ETag. Requests carrying a matching
+If-None-Match get a bodyless 304.
+
+With auto_reload (STRONGHOLD_TEMPLATE_AUTO_RELOAD=1, for development) pages
+are re-rendered on every request so template edits show up immediately.
+"""
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from jinja2 import Environment, FileSystemLoader, TemplateNotFound
+from starlette.requests import Request
+from starlette.responses import Response
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_AUTO_RELOAD = os.environ.get("STRONGHOLD_TEMPLATE_AUTO_RELOAD", "").lower() in ("1", "true", "yes")
+
+# Pages are re-validated on every load, which costs a 304 at most
+CACHE_CONTROL = "no-cache"
+
+
+class RenderedPage:
+    __slots__ = ("body", "etag")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match covers `etag`"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class Page:
+    """A template with a fixed context, declared once and served from the cache"""
+
+    def __init__(self, cache: "TemplateCache", name: str, context: Dict[str, Hashable]):
+        self.cache = cache
+        self.name = name
+        self.context = context
+
+    def response(self, request: Request, **extra) -> Response:
+        return self.cache.response(request, self.name, **self.context, **extra)
+
+
+class TemplateCache:
+    """
+    Renders templates to bytes, keyed by template name and context. Context
+    values must be hashable to be cached. Declared pages are kept for good;
+    other variants (e.g. one per ?username=) share at most `max_entries`
+    slots, least recently used first out, so they can never push the
+    declared pages out.
+    """
+
+    def __init__(self, directory: str, auto_reload: bool = TEMPLATE_AUTO_RELOAD, max_entries: int = 256):
+        # Same autoescaping as Starlette's Jinja2Templates
+        self.env = Environment(loader=FileSystemLoader(directory), autoescape=True, auto_reload=auto_reload)
+        self.auto_reload = auto_reload
+        self.max_entries = max_entries
+        self._pages: List[Page] = []
+        self._pinned: Dict[Tuple, Optional[RenderedPage]] = {}  # declared pages
+        self._rendered: "OrderedDict[Tuple, RenderedPage]" = OrderedDict()
+
+    @staticmethod
+    def _key(name: str, context: dict) -> Tuple:
+        return name, tuple(sorted(context.items()))
+
+    def page(self, name: str, **context) -> Page:
+        """Declare a page so `warm()` renders it ahead of the first request"""
+        page = Page(self, name, context)
+        self._pages.append(page)
+        self._pinned[self._key(name, context)] = None
+        return page
+
+    def warm(self) -> int:
+        """Pre-render every declared page; returns how many were rendered"""
+        rendered = 0
+        for page in self._pages:
+            try:
+                self.render(page.name, **page.context)
+                rendered += 1
+            except TemplateNotFound:
+                logger.warning("Template not found: %s", page.name)
+        return rendered
+
+    def _render(self, name: str, context: dict) -> RenderedPage:
+        return RenderedPage(self.env.get_template(name).render(context).encode())
+
+    def render(self, name: str, cache: bool = True, **context) -> RenderedPage:
+        if not cache or self.auto_reload:
+            return self._render(name, context)
+        key = self._key(name, context)
+        if key in self._pinned:
+            page = self._pinned[key]
+            if page is None:
+                page = self._pinned[key] = self._render(name, context)
+            return page
+        page = self._rendered.get(key)
+        if page is None:
+            page = self._rendered[key] = self._render(name, context)
+            if len(self._rendered) > self.max_entries:
+                self._rendered.popitem(last=False)
+        else:
+            self._rendered.move_to_end(key)
+        return page
+
+    def response(self, request: Request, name: str, cache: bool = True, **context) -> Response:
+        """The rendered page, or a 304 if the browser already has it"""
+        page = self.render(name, cache, **context)
+        headers = {"ETag": page.etag, "Cache-Control": CACHE_CONTROL}
+        if etag_matches(request, page.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(page.body, media_type="text/html", headers=headers)
+
+    def clear(self) -> None:
+        self._pinned = dict.fromkeys(self._pinned)
+        self._rendered.clear()
+
+    def __len__(self) -> int:
+        return len(self._rendered) + sum(page is not None for page in self._pinned.values())
@@ -0,0 +1,51 @@
+"""
+JSON encoding for responses, events and journals.
+
+Uses orjson when it is installed (several times faster than the standard
+library, and it produces bytes directly) and falls back to a compact
+`json.dumps` otherwise. Both produce the same compact output for the plain
+dicts, lists, strings and numbers this app sends.
+
+`JSONResponse` is a drop-in for Starlette's and is the app's default
+response class, so handlers keep returning dicts or JSONResponse(...) and
+get the fast encoder either way.
+"""
+import json
+from typing import Any
+
+from starlette.responses import JSONResponse as _JSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional: stdlib json
+    orjson = None
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any) -> bytes:
+        """Compact JSON as UTF-8 bytes"""
+        try:
+            return orjson.dumps(obj, option=_OPTIONS)
+        except TypeError:
+            # e.g. integers wider than 64 bits, which the stdlib handles
+            return _stdlib_dumps(obj)
+
+    loads = orjson.loads
+else:
+    def dumps(obj: Any) -> bytes:
+        """Compact JSON as UTF-8 bytes"""
+        return _stdlib_dumps(obj)
+
+    loads = json.loads
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class JSONResponse(_JSONResponse):
+    """JSONResponse encoded with `dumps`"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
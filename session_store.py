@@ -0,0 +1,783 @@
+"""
+Session state for the step-up flow.
+
+Every session (a browser session, an SSE/polling client or a mobile PIN
+step-up) is one record holding its username, PIN, the PIN options shown to
+the mobile and step-up IDs. The store
+keeps reverse indexes (username -> session, step-up -> session) in sync with
+the records so lookups and teardown never scan other sessions.
+
+Channel handles (attached SSE/WebSocket channels and the polling queue) are
+live objects, so they always stay in process memory whichever backend persists
+the record itself.
+
+When given an ExpiryReaper, the store arms a TTL for every session, step-up
+and polling queue it creates and re-arms it on activity.
+"""
+import asyncio
+import itertools
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from journal import Journal
+
+# Events kept per session for polling and replay
+POLLING_QUEUE_SIZE = 100
+
+_last_sequence = 0
+
+
+def _now() -> int:
+    return time.time_ns() // 1000
+
+
+def next_sequence() -> int:
+    """
+    Sequence number for a new event: microseconds since the epoch, bumped if
+    need be to keep increasing. The publishing worker assigns it and it
+    travels with the event through the broker, so every worker files the
+    event under the same number, and numbers keep growing across restarts
+    and from one worker to the next (they share the host's clock).
+    """
+    global _last_sequence
+    _last_sequence = max(_last_sequence + 1, _now())
+    return _last_sequence
+
+
+def resume_point(cursor: Optional[int]) -> int:
+    """
+    Sanitize a client's cursor. One from the future (not a number any
+    worker could have issued) would hide every new event, so it replays the
+    log from the start instead.
+    """
+    if cursor is None or cursor < 0 or cursor > max(_last_sequence, _now()):
+        return 0
+    return cursor
+
+
+class PollingQueue:
+    """
+    Ring buffer of a session's most recent events, tagged with sequence numbers.
+
+    Reading doesn't consume events. A client that passes the last sequence
+    number it saw gets only what came after it, so a poll or SSE stream that
+    fails mid-flight can pick up where it left off. Clients without a cursor
+    use `drain()`, which keeps one on their behalf.
+    """
+    __slots__ = ("_entries", "_ready", "cursor")
+
+    def __init__(self, maxlen: int = POLLING_QUEUE_SIZE):
+        self._entries: deque = deque(maxlen=maxlen)  # (seq, event)
+        self._ready = asyncio.Event()
+        self.cursor = 0  # highest sequence number handed out so far
+
+    def append(self, event, seq: Optional[int] = None) -> int:
+        """Record an event; returns its sequence number"""
+        if seq is None:
+            seq = next_sequence()
+        entries = self._entries
+        if entries and entries[-1][0] > seq:
+            # From another worker, published before our latest: keep the log in order
+            position = len(entries) - 1
+            while position and entries[position - 1][0] > seq:
+                position -= 1
+            if len(entries) == entries.maxlen:
+                if not position:
+                    return seq  # older than everything the ring still holds
+                entries.popleft()
+                position -= 1
+            entries.insert(position, (seq, event))
+        else:
+            entries.append((seq, event))
+        self._ready.set()
+        return seq
+
+    def since(self, cursor: int) -> List[Tuple[int, object]]:
+        """(seq, event) pairs newer than `cursor`, oldest first"""
+        entries = self._entries
+        start = len(entries)
+        # The tail is what clients are usually missing, so walk back from it
+        while start and entries[start - 1][0] > cursor:
+            start -= 1
+        return list(itertools.islice(entries, start, None))
+
+    def read(self, cursor: Optional[int] = None) -> Tuple[list, int]:
+        """Events after `cursor` (default: the server-side one) and the cursor to resume from"""
+        if cursor is None:
+            cursor = self.cursor
+        entries = self.since(cursor)
+        if entries:
+            cursor = entries[-1][0]
+            if cursor > self.cursor:
+                self.cursor = cursor
+        return [event for _, event in entries], cursor
+
+    def drain(self) -> list:
+        """Every event not handed out yet"""
+        self._ready.clear()
+        return self.read()[0]
+
+    async def wait(self, timeout: float, cursor: Optional[int] = None) -> bool:
+        """Wait up to `timeout` seconds for an event after `cursor`; True if there is one"""
+        if cursor is None:
+            cursor = self.cursor
+        if self.since(cursor):
+            return True
+        self._ready.clear()
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return bool(self.since(cursor))
+
+    def __len__(self) -> int:
+        """Events not handed out yet"""
+        return len(self.since(self.cursor))
+
+
+async def wait_any(queues: List[Tuple[PollingQueue, Optional[int]]], timeout: float) -> bool:
+    """
+    Wait up to `timeout` seconds until any of the (queue, cursor) pairs has an
+    event after its cursor; True if one does. Used by batched long-polls.
+    """
+    def ready():
+        return any(queue.since(queue.cursor if cursor is None else cursor) for queue, cursor in queues)
+
+    if not queues or ready():
+        return bool(queues)
+    for queue, _ in queues:
+        queue._ready.clear()
+    waiters = [asyncio.ensure_future(queue._ready.wait()) for queue, _ in queues]
+    try:
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+    return ready()
+
+
+class SessionChannels:
+    """Process-local delivery handles for a session"""
+    __slots__ = ("subscribers", "events")
+
+    def __init__(self):
+        self.subscribers: list = []  # events.Channel instances
+        self.events: Optional[PollingQueue] = None
+
+
+class SessionRecord:
+    """Durable state for one session"""
+    __slots__ = ("session_id", "username", "pin", "pin_options", "callback_url", "step_ups")
+
+    def __init__(self, session_id: str, username: Optional[str] = None, pin: Optional[str] = None,
+                 pin_options: Optional[List[str]] = None, callback_url: Optional[str] = None):
+        self.session_id = session_id
+        self.username = username
+        self.pin = pin
+        # Chosen once per PIN, so repeated requests can't be compared to find it
+        self.pin_options = pin_options
+        # Where to POST the result, for step-ups created through the API
+        self.callback_url = callback_url
+        self.step_ups: Dict[str, Optional[str]] = {}  # step_up_id -> PIN
+
+    def __repr__(self):
+        return f"SessionRecord({self.session_id!r}, username={self.username!r})"
+
+
+class SessionStore:
+    """
+    Base class for session backends.
+
+    Subclasses implement the durable record operations; channel handles are
+    managed here since they can never leave the process.
+    """
+
+    def __init__(self, reaper=None):
+        self._channels: Dict[str, SessionChannels] = {}
+        self.reaper = reaper
+        if reaper is not None:
+            reaper.register("session", self._expire_session)
+            reaper.register("step_up", self._expire_step_up)
+            reaper.register("polling", self._expire_events)
+
+    # -- expiry ----------------------------------------------------------
+
+    def _expires(self, kind: str, key: str) -> None:
+        if self.reaper is not None:
+            self.reaper.schedule(kind, key)
+
+    def _cancel_expiry(self, record: Optional[SessionRecord], session_id: str) -> None:
+        if self.reaper is None:
+            return
+        self.reaper.cancel("session", session_id)
+        self.reaper.cancel("polling", session_id)
+        if record is not None:
+            for step_up_id in record.step_ups:
+                self.reaper.cancel("step_up", step_up_id)
+
+    def _expire_session(self, session_id: str) -> bool:
+        if self.subscribers(session_id):
+            return False  # still connected, check again after another TTL
+        self.delete(session_id)
+        return True
+
+    def _expire_step_up(self, step_up_id: str) -> None:
+        self.remove_step_up(step_up_id)
+
+    def _expire_events(self, session_id: str) -> None:
+        channels = self._channels.get(session_id)
+        if channels is not None:
+            channels.events = None
+            self._release_channels(session_id, channels)
+
+    # -- records ---------------------------------------------------------
+
+    def create(self, session_id: Optional[str] = None, username: Optional[str] = None,
+               pin: Optional[str] = None) -> SessionRecord:
+        """Create (or replace) a session and point `username` at it"""
+        raise NotImplementedError
+
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        raise NotImplementedError
+
+    def ensure(self, session_id: str) -> SessionRecord:
+        """Return the session, creating an empty record if it doesn't exist"""
+        record = self.get(session_id)
+        if record is None:
+            record = self.create(session_id=session_id)
+        return record
+
+    def set_pin(self, session_id: str, pin: Optional[str]) -> None:
+        """Set the session's PIN; any option set chosen for the old one is dropped"""
+        raise NotImplementedError
+
+    def set_pin_options(self, session_id: str, options: List[str]) -> None:
+        raise NotImplementedError
+
+    def set_callback_url(self, session_id: str, url: Optional[str]) -> None:
+        """Set (or with None, clear) the webhook URL for an existing session"""
+        raise NotImplementedError
+
+    def add_step_up(self, session_id: str, step_up_id: str, pin: Optional[str] = None) -> None:
+        """Attach a step-up (and optionally its PIN) to a session"""
+        raise NotImplementedError
+
+    def remove_step_up(self, step_up_id: str) -> None:
+        raise NotImplementedError
+
+    def session_for_username(self, username: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def session_for_step_up(self, step_up_id: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def step_up_pin(self, step_up_id: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def step_up_pins(self) -> Iterator[tuple]:
+        """Iterate (step_up_id, pin) pairs for step-ups that have a PIN"""
+        raise NotImplementedError
+
+    def active_sessions(self) -> Iterator[tuple]:
+        """Iterate (username, record) for every session a username points at"""
+        raise NotImplementedError
+
+    def _delete_record(self, session_id: str) -> Optional[SessionRecord]:
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> Optional[SessionRecord]:
+        """Remove a session together with its indexes and channels"""
+        self._channels.pop(session_id, None)
+        record = self._delete_record(session_id)
+        self._cancel_expiry(record, session_id)
+        return record
+
+    def pin(self, session_id: str) -> Optional[str]:
+        record = self.get(session_id)
+        return record.pin if record else None
+
+    def pin_options(self, session_id: str) -> Optional[List[str]]:
+        record = self.get(session_id)
+        return record.pin_options if record else None
+
+    def callback_url(self, session_id: str) -> Optional[str]:
+        record = self.get(session_id)
+        return record.callback_url if record else None
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    # -- channels --------------------------------------------------------
+
+    def channels(self, session_id: str, create: bool = True) -> Optional[SessionChannels]:
+        channels = self._channels.get(session_id)
+        if channels is None and create:
+            channels = self._channels[session_id] = SessionChannels()
+        return channels
+
+    def _release_channels(self, session_id: str, channels: SessionChannels) -> None:
+        if not channels.subscribers and channels.events is None:
+            self._channels.pop(session_id, None)
+
+    def attach(self, session_id: str, channel) -> None:
+        """Attach an SSE/WebSocket channel to receive the session's events"""
+        self.channels(session_id).subscribers.append(channel)
+
+    def detach(self, session_id: str, channel) -> None:
+        channels = self._channels.get(session_id)
+        if channels is not None and channel in channels.subscribers:
+            channels.subscribers.remove(channel)
+            self._release_channels(session_id, channels)
+
+    def subscribers(self, session_id: str) -> list:
+        channels = self._channels.get(session_id)
+        return channels.subscribers if channels else []
+
+    def events(self, session_id: str, create: bool = True) -> Optional[PollingQueue]:
+        """Polling queue for a session; any access counts as activity for its TTL"""
+        channels = self.channels(session_id, create)
+        if channels is None:
+            return None
+        if channels.events is None:
+            if not create:
+                return None
+            channels.events = PollingQueue()
+        self._expires("polling", session_id)
+        return channels.events
+
+    def queued_events(self) -> int:
+        """Events waiting in all polling queues"""
+        return sum(len(c.events) for c in self._channels.values() if c.events is not None)
+
+    def reset_events(self, session_id: str) -> PollingQueue:
+        """Replace the session's polling queue with an empty one"""
+        channels = self.channels(session_id)
+        channels.events = PollingQueue()
+        self._expires("polling", session_id)
+        return channels.events
+
+    def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """Dict-backed store; state lives for the life of the process"""
+
+    def __init__(self, reaper=None):
+        super().__init__(reaper)
+        self._records: Dict[str, SessionRecord] = {}
+        self._by_username: Dict[str, str] = {}
+        self._by_step_up: Dict[str, str] = {}
+
+    def create(self, session_id=None, username=None, pin=None):
+        session_id = session_id or str(uuid.uuid4())
+        self._cancel_expiry(self._delete_record(session_id), session_id)
+        record = self._records[session_id] = SessionRecord(session_id, username, pin)
+        if username is not None:
+            self._by_username[username] = session_id
+        self._expires("session", session_id)
+        return record
+
+    def get(self, session_id):
+        return self._records.get(session_id)
+
+    def set_pin(self, session_id, pin):
+        record = self.ensure(session_id)
+        record.pin = pin
+        record.pin_options = None
+        self._expires("session", session_id)
+
+    def set_pin_options(self, session_id, options):
+        record = self._records.get(session_id)
+        if record is not None:
+            record.pin_options = list(options)
+
+    def set_callback_url(self, session_id, url):
+        record = self._records.get(session_id)
+        if record is not None:
+            record.callback_url = url
+
+    def add_step_up(self, session_id, step_up_id, pin=None):
+        previous = self._by_step_up.get(step_up_id)
+        if previous is not None and previous != session_id:
+            self._records[previous].step_ups.pop(step_up_id, None)
+        self.ensure(session_id).step_ups[step_up_id] = pin
+        self._by_step_up[step_up_id] = session_id
+        self._expires("session", session_id)
+        self._expires("step_up", step_up_id)
+
+    def remove_step_up(self, step_up_id):
+        session_id = self._by_step_up.pop(step_up_id, None)
+        if session_id is not None:
+            self._records[session_id].step_ups.pop(step_up_id, None)
+        if self.reaper is not None:
+            self.reaper.cancel("step_up", step_up_id)
+
+    def session_for_username(self, username):
+        return self._by_username.get(username)
+
+    def session_for_step_up(self, step_up_id):
+        return self._by_step_up.get(step_up_id)
+
+    def step_up_pin(self, step_up_id):
+        session_id = self._by_step_up.get(step_up_id)
+        if session_id is None:
+            return None
+        return self._records[session_id].step_ups.get(step_up_id)
+
+    def step_up_pins(self):
+        for step_up_id, session_id in list(self._by_step_up.items()):
+            pin = self._records[session_id].step_ups.get(step_up_id)
+            if pin is not None:
+                yield step_up_id, pin
+
+    def active_sessions(self):
+        for username, session_id in list(self._by_username.items()):
+            yield username, self._records[session_id]
+
+    def _delete_record(self, session_id):
+        record = self._records.pop(session_id, None)
+        if record is None:
+            return None
+        if record.username is not None and self._by_username.get(record.username) == session_id:
+            del self._by_username[record.username]
+        for step_up_id in record.step_ups:
+            if self._by_step_up.get(step_up_id) == session_id:
+                del self._by_step_up[step_up_id]
+        return record
+
+    def __len__(self):
+        return len(self._records)
+
+
+class JournaledSessionStore(MemorySessionStore):
+    """
+    Dict-backed store whose mutations are journaled to `directory` (see
+    journal.py), so sessions, PINs and step-ups survive a restart. Reads cost
+    the same as MemorySessionStore; writes add one queued line.
+    """
+
+    def __init__(self, directory: str, reaper=None, snapshot_every: int = 10000, fsync: bool = True):
+        super().__init__(reaper)
+        self._replaying = True
+        self.journal = Journal(directory, self._snapshot, snapshot_every, fsync)
+        snapshot, entries = self.journal.load()
+        if snapshot is not None:
+            self._restore(snapshot)
+        for entry in entries:
+            self._apply(entry)
+        self._replaying = False
+        self.journal.start()
+        if reaper is not None:
+            # Records from a previous run get a fresh TTL from now
+            for session_id, record in self._records.items():
+                reaper.schedule("session", session_id)
+                for step_up_id in record.step_ups:
+                    reaper.schedule("step_up", step_up_id)
+
+    def _snapshot(self) -> dict:
+        # Copied, since the journal thread serializes it while we carry on mutating
+        return {
+            "sessions": [[r.session_id, r.username, r.pin, dict(r.step_ups), r.pin_options, r.callback_url]
+                         for r in self._records.values()],
+            "usernames": dict(self._by_username),
+        }
+
+    def _restore(self, snapshot: dict) -> None:
+        """Load a snapshot straight into the indexes"""
+        for session_id, username, pin, step_ups, *rest in snapshot["sessions"]:
+            record = self._records[session_id] = SessionRecord(session_id, username, pin, *rest)
+            record.step_ups = step_ups
+            for step_up_id in step_ups:
+                self._by_step_up[step_up_id] = session_id
+        self._by_username = dict(snapshot["usernames"])
+
+    def _apply(self, entry: list) -> None:
+        op, args = entry[0], entry[1:]
+        if op == "c":
+            self.create(*args)
+        elif op == "p":
+            self.set_pin(*args)
+        elif op == "o":
+            self.set_pin_options(*args)
+        elif op == "w":
+            self.set_callback_url(*args)
+        elif op == "s":
+            self.add_step_up(*args)
+        elif op == "r":
+            self.remove_step_up(*args)
+        elif op == "d":
+            self.delete(*args)
+
+    def _log(self, *entry) -> None:
+        if not self._replaying:
+            self.journal.append(list(entry))
+
+    def create(self, session_id=None, username=None, pin=None):
+        record = super().create(session_id, username, pin)
+        self._log("c", record.session_id, username, pin)
+        return record
+
+    def set_pin(self, session_id, pin):
+        super().set_pin(session_id, pin)
+        self._log("p", session_id, pin)
+
+    def set_pin_options(self, session_id, options):
+        if session_id in self._records:
+            super().set_pin_options(session_id, options)
+            self._log("o", session_id, list(options))
+
+    def set_callback_url(self, session_id, url):
+        if session_id in self._records:
+            super().set_callback_url(session_id, url)
+            self._log("w", session_id, url)
+
+    def add_step_up(self, session_id, step_up_id, pin=None):
+        super().add_step_up(session_id, step_up_id, pin)
+        self._log("s", session_id, step_up_id, pin)
+
+    def remove_step_up(self, step_up_id):
+        known = step_up_id in self._by_step_up
+        super().remove_step_up(step_up_id)
+        if known:
+            self._log("r", step_up_id)
+
+    def delete(self, session_id):
+        record = super().delete(session_id)
+        if record is not None:
+            self._log("d", session_id)
+        return record
+
+    def close(self):
+        self.journal.close()
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLite-backed store for a local file (or ":memory:").
+
+    The username and step-up indexes are primary keys, so every lookup is a
+    single keyed read. Records survive restarts; channel handles don't.
+
+    Several workers can share the file, and each only sees its own requests
+    and connections, so every write stamps the record's `last_seen` and a
+    worker that has the session connected keeps stamping it. A worker's
+    reaper only deletes a session nobody has touched for a whole TTL.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            username    TEXT,
+            pin         TEXT,
+            pin_options TEXT,
+            callback_url TEXT,
+            last_seen   REAL
+        );
+        CREATE TABLE IF NOT EXISTS usernames (
+            username   TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS step_ups (
+            step_up_id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            pin        TEXT
+        );
+        CREATE INDEX IF NOT EXISTS step_ups_session ON step_ups (session_id);
+    """
+
+    def __init__(self, path: str, reaper=None):
+        super().__init__(reaper)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        # Columns added since the first version of the schema
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(sessions)")}
+        for column, kind in (("pin_options", "TEXT"), ("last_seen", "REAL"), ("callback_url", "TEXT")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE sessions ADD COLUMN {column} {kind}")
+        if reaper is not None:
+            # Records from a previous run get a fresh TTL from now
+            for (session_id,) in self._read("SELECT session_id FROM sessions"):
+                reaper.schedule("session", session_id)
+            for (step_up_id,) in self._read("SELECT step_up_id FROM step_ups"):
+                reaper.schedule("step_up", step_up_id)
+
+    def _write(self, *statements):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    self._db.execute(sql, params)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _read(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _expire_session(self, session_id):
+        if self.subscribers(session_id):
+            # Connected here: tell the other workers it's still in use
+            self._write(self._touch(session_id))
+            return False
+        rows = self._read("SELECT last_seen FROM sessions WHERE session_id = ?", (session_id,))
+        if rows and rows[0][0] is not None and time.time() - rows[0][0] < self.reaper.ttls["session"]:
+            return False  # used on another worker since; check again after another TTL
+        self.delete(session_id)
+        return True
+
+    @staticmethod
+    def _touch(session_id):
+        return ("UPDATE sessions SET last_seen = ? WHERE session_id = ?", (time.time(), session_id))
+
+    def attach(self, session_id, channel):
+        super().attach(session_id, channel)
+        # This worker's reaper now keeps the shared record alive while the channel is open
+        self._write(self._touch(session_id))
+        self._expires("session", session_id)
+
+    def _delete_statements(self, session_id):
+        return [
+            ("DELETE FROM usernames WHERE session_id = ?", (session_id,)),
+            ("DELETE FROM step_ups WHERE session_id = ?", (session_id,)),
+            ("DELETE FROM sessions WHERE session_id = ?", (session_id,)),
+        ]
+
+    def create(self, session_id=None, username=None, pin=None):
+        session_id = session_id or str(uuid.uuid4())
+        if self.reaper is not None:
+            self._cancel_expiry(self.get(session_id), session_id)
+        statements = self._delete_statements(session_id)
+        statements.append(("INSERT INTO sessions (session_id, username, pin, last_seen) VALUES (?, ?, ?, ?)",
+                           (session_id, username, pin, time.time())))
+        if username is not None:
+            statements.append(("INSERT OR REPLACE INTO usernames (username, session_id) VALUES (?, ?)",
+                               (username, session_id)))
+        self._write(*statements)
+        self._expires("session", session_id)
+        return SessionRecord(session_id, username, pin)
+
+    def get(self, session_id):
+        rows = self._read("SELECT username, pin, pin_options, callback_url FROM sessions WHERE session_id = ?",
+                          (session_id,))
+        if not rows:
+            return None
+        username, pin, options, callback_url = rows[0]
+        record = SessionRecord(session_id, username, pin, self._options(options), callback_url)
+        for step_up_id, pin in self._read(
+                "SELECT step_up_id, pin FROM step_ups WHERE session_id = ?", (session_id,)):
+            record.step_ups[step_up_id] = pin
+        return record
+
+    def pin(self, session_id):
+        rows = self._read("SELECT pin FROM sessions WHERE session_id = ?", (session_id,))
+        return rows[0][0] if rows else None
+
+    @staticmethod
+    def _options(value):
+        # PINs are digits, so a comma-separated column holds them
+        return value.split(",") if value is not None else None
+
+    def pin_options(self, session_id):
+        rows = self._read("SELECT pin_options FROM sessions WHERE session_id = ?", (session_id,))
+        return self._options(rows[0][0]) if rows else None
+
+    def set_pin(self, session_id, pin):
+        self._write(
+            ("INSERT OR IGNORE INTO sessions (session_id) VALUES (?)", (session_id,)),
+            ("UPDATE sessions SET pin = ?, pin_options = NULL WHERE session_id = ?", (pin, session_id)),
+            self._touch(session_id),
+        )
+        self._expires("session", session_id)
+
+    def set_pin_options(self, session_id, options):
+        self._write(("UPDATE sessions SET pin_options = ? WHERE session_id = ?", (",".join(options), session_id)))
+
+    def callback_url(self, session_id):
+        rows = self._read("SELECT callback_url FROM sessions WHERE session_id = ?", (session_id,))
+        return rows[0][0] if rows else None
+
+    def set_callback_url(self, session_id, url):
+        self._write(("UPDATE sessions SET callback_url = ? WHERE session_id = ?", (url, session_id)),
+                    self._touch(session_id))
+
+    def add_step_up(self, session_id, step_up_id, pin=None):
+        self._write(
+            ("INSERT OR IGNORE INTO sessions (session_id) VALUES (?)", (session_id,)),
+            ("INSERT OR REPLACE INTO step_ups (step_up_id, session_id, pin) VALUES (?, ?, ?)",
+             (step_up_id, session_id, pin)),
+            self._touch(session_id),
+        )
+        self._expires("session", session_id)
+        self._expires("step_up", step_up_id)
+
+    def remove_step_up(self, step_up_id):
+        self._write(("DELETE FROM step_ups WHERE step_up_id = ?", (step_up_id,)))
+        if self.reaper is not None:
+            self.reaper.cancel("step_up", step_up_id)
+
+    def session_for_username(self, username):
+        rows = self._read("SELECT session_id FROM usernames WHERE username = ?", (username,))
+        return rows[0][0] if rows else None
+
+    def session_for_step_up(self, step_up_id):
+        rows = self._read("SELECT session_id FROM step_ups WHERE step_up_id = ?", (step_up_id,))
+        return rows[0][0] if rows else None
+
+    def step_up_pin(self, step_up_id):
+        rows = self._read("SELECT pin FROM step_ups WHERE step_up_id = ?", (step_up_id,))
+        return rows[0][0] if rows else None
+
+    def step_up_pins(self):
+        yield from self._read("SELECT step_up_id, pin FROM step_ups WHERE pin IS NOT NULL")
+
+    def active_sessions(self):
+        rows = self._read(
+            "SELECT u.username, s.session_id, s.username, s.pin FROM usernames u "
+            "JOIN sessions s ON s.session_id = u.session_id")
+        for username, session_id, record_username, pin in rows:
+            yield username, SessionRecord(session_id, record_username, pin)
+
+    def _delete_record(self, session_id):
+        record = self.get(session_id)
+        if record is not None:
+            self._write(*self._delete_statements(session_id))
+        return record
+
+    def __len__(self):
+        return self._read("SELECT COUNT(*) FROM sessions")[0][0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def create_session_store(url: Optional[str] = None, reaper=None) -> SessionStore:
+    """
+    Build a store from a URL: "memory" (the default), "journal:///path/to/dir"
+    or "sqlite:///path/to.db". Falls back to the STRONGHOLD_SESSION_STORE
+    environment variable.
+    """
+    url = url or os.environ.get("STRONGHOLD_SESSION_STORE", "memory")
+    if url == "memory":
+        return MemorySessionStore(reaper)
+    if url.startswith("journal:///"):
+        return JournaledSessionStore(url[len("journal:///"):], reaper)
+    if url.startswith("sqlite:///"):
+        return SQLiteSessionStore(url[len("sqlite:///"):] or ":memory:", reaper)
+    raise ValueError(f"Unknown session store: {url}")
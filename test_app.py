@@ -0,0 +1,341 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as stronghold
+import wire
+
+
+@pytest.fixture
+def client():
+    with TestClient(stronghold.app) as client:
+        yield client
+
+
+def test_step_up_over_websocket(client):
+    session = client.post("/start-session", json={"username": "gavin"}).json()
+    options = client.post("/get-pin-options", json={"username": "gavin"}).json()
+    assert session["pin"] in options["pins"]
+
+    with client.websocket_connect(f"/ws/{session['session_id']}") as ws:
+        result = client.post("/verify-pin-selection",
+                             json={"pin": session["pin"], "session_id": session["session_id"]})
+        assert result.json() == {"success": True}
+        assert ws.receive_json() == {"type": "auth_complete", "data": {}}
+
+
+def test_websocket_negotiates_binary_frames(client):
+    session = client.post("/start-session", json={"username": "gavin"}).json()
+    with client.websocket_connect(f"/ws/{session['session_id']}", subprotocols=["stronghold.msgpack"]) as ws:
+        assert ws.accepted_subprotocol == "stronghold.msgpack"
+        client.post("/verify-pin-selection", json={"pin": session["pin"], "session_id": session["session_id"]})
+        assert wire.decode_message(ws.receive_bytes()) == {"type": "auth_complete", "data": {}}
+
+    # Binary frames from the phone are understood too
+    client_id = client.get("/register-polling").json()["client_id"]
+    step_up_id = client.post(f"/initiate-step-up/{client_id}").json()["step_up_id"]
+    with client.websocket_connect(f"/ws/{step_up_id}?encoding=msgpack") as ws:
+        ws.send_bytes(wire.encode_event("auth_complete", {}))
+        events = client.get(f"/poll-updates/{client_id}?wait=5").json()["events"]
+    assert {"type": "auth_complete", "data": {}} in events
+
+
+def test_malformed_bodies_are_rejected_before_any_lookup(client):
+    for path, body in [("/start-session", ["x"]), ("/start-session", {"username": ""}),
+                       ("/get-pin-options", {"username": 5}), ("/generate-pin", {}),
+                       ("/verify-pin", {"pin": None, "session_id": "nope"}),
+                       ("/verify-pin-selection", {"pin": "12", "session_id": ["a"]}),
+                       ("/verify-pin-selection", {"pin": True, "session_id": "a"}),
+                       ("/send-message/x", {}), ("/api/step-ups", {"username": "u"}),
+                       ("/poll-updates", {"sessions": [5]}), ("/poll-updates", {"sessions": [["a"]]}),
+                       ("/register-push", ["x"])]:
+        response = client.post(path, json=body)
+        assert response.status_code == 400, (path, body)
+        assert "error" in response.json()
+    assert client.post("/verify-pin", json={"pin": 12, "session_id": "nope"}).status_code == 404
+
+
+def test_pin_options_are_stable_and_revalidate(client):
+    session = client.post("/start-session", json={"username": "options"}).json()
+    first = client.post("/get-pin-options", json={"username": "options"})
+    again = client.get("/get-pin-options", params={"username": "options"})
+    # The same set every time, so responses can't be intersected to find the PIN
+    assert first.json() == again.json()
+    assert session["pin"] in first.json()["pins"]
+    assert first.headers["ETag"] == again.headers["ETag"]
+
+    etag = first.headers["ETag"]
+    cached = client.get("/get-pin-options", params={"username": "options"}, headers={"If-None-Match": etag})
+    assert cached.status_code == 304 and cached.content == b""
+
+    # A new session means a new PIN and a new set
+    client.post("/start-session", json={"username": "options"})
+    fresh = client.get("/get-pin-options", params={"username": "options"}, headers={"If-None-Match": etag})
+    assert fresh.status_code == 200 and fresh.headers["ETag"] != etag
+
+
+def test_polling_client_receives_messages(client):
+    client_id = client.get("/register-polling").json()["client_id"]
+    step_up_id = client.post(f"/initiate-step-up/{client_id}").json()["step_up_id"]
+    client.post(f"/send-message/{step_up_id}", json={"content": "hello"})
+
+    events = client.get(f"/poll-updates/{client_id}").json()["events"]
+    assert [e["type"] for e in events] == ["step_up_initiated", "mobile_message"]
+    assert client.get("/poll-updates/unknown-client").json() == {"events": []}
+
+
+@pytest.fixture
+def api_client(client, monkeypatch):
+    """The test client with an API key configured and the local receiver allowed"""
+    import webhooks
+    monkeypatch.setattr(stronghold, "API_KEYS", [b"test-key"])
+    monkeypatch.setattr(webhooks, "ALLOWED_HOSTS", frozenset({"127.0.0.1"}))
+    client.headers["Authorization"] = "Bearer test-key"
+    yield client
+    del client.headers["Authorization"]
+
+
+def test_api_step_up_queues_signed_callback(api_client):
+    client = api_client
+    created = client.post("/api/step-ups", json={"username": "merchant-user",
+                                                  "callback_url": "http://127.0.0.1:1/hook"}).json()
+    delivered = []
+    enqueue = stronghold.webhook_dispatcher.enqueue
+    stronghold.webhook_dispatcher.enqueue = lambda url, payload: delivered.append((url, payload))
+    try:
+        client.post("/verify-pin-selection", json={"pin": created["pin"], "session_id": created["session_id"]})
+    finally:
+        stronghold.webhook_dispatcher.enqueue = enqueue
+
+    [(url, payload)] = delivered
+    assert url == "http://127.0.0.1:1/hook"
+    assert payload["type"] == "auth_complete" and payload["session_id"] == created["session_id"]
+    assert payload["username"] == "merchant-user"
+    # Sent once: the URL is cleared from the session record
+    assert stronghold.sessions.callback_url(created["session_id"]) is None
+
+    # A wrong PIN on /verify-pin reports auth_failed to the callback too
+    failing = client.post("/api/step-ups", json={"username": "other-user",
+                                                  "callback_url": "http://127.0.0.1:1/hook"}).json()
+    wrong = "1" + failing["pin"]
+    delivered.clear()
+    stronghold.webhook_dispatcher.enqueue = lambda url, payload: delivered.append((url, payload))
+    try:
+        assert client.post("/verify-pin", json={"pin": wrong, "session_id": failing["session_id"]}).status_code == 400
+    finally:
+        stronghold.webhook_dispatcher.enqueue = enqueue
+    assert [payload["type"] for _, payload in delivered] == ["auth_failed"]
+
+
+def test_api_step_ups_need_a_key_and_a_public_callback(api_client):
+    client = api_client
+    body = {"username": "api-user", "callback_url": "http://127.0.0.1:1/hook"}
+    for authorization in ("", "Bearer wrong-key", "Basic test-key"):
+        response = client.post("/api/step-ups", json=body, headers={"Authorization": authorization})
+        assert response.status_code == 401 and response.headers["www-authenticate"] == "Bearer"
+
+    # Nothing on the server's own network, however it's spelled
+    for url in ("ftp://x", "http://10.0.0.5/hook", "http://169.254.169.254/latest", "http://[::1]/hook",
+                "http://localhost:8000/hook", "http://[::ffff:192.168.0.1]/hook", "http://0.0.0.0/hook"):
+        response = client.post("/api/step-ups", json={"username": f"api-user-{url}", "callback_url": url})
+        assert response.status_code == 400, url
+        assert "callback_url" in response.json()["error"]
+
+
+def test_pin_guesses_are_rate_limited(client):
+    session = client.post("/start-session", json={"username": "guesser"}).json()
+    wrong = "00" if session["pin"] != "00" else "01"
+    guess = {"pin": wrong, "session_id": session["session_id"]}
+    statuses = [client.post("/verify-pin-selection", json=guess).status_code
+                for _ in range(int(stronghold.session_limiter.burst) + 1)]
+    assert statuses[:-1] == [200] * int(stronghold.session_limiter.burst)
+    assert statuses[-1] == 429
+    limited = client.post("/verify-pin", json={"pin": session["pin"], "session_id": session["session_id"]})
+    assert limited.status_code == 429 and int(limited.headers["retry-after"]) >= 1
+
+
+def test_mobile_pin_step_ups_are_rate_limited_per_ip(client, monkeypatch):
+    from ratelimit import RateLimiter
+    monkeypatch.setattr(stronghold, "ip_limiter", RateLimiter(rate=0.1, burst=2, scope="ip"))
+    statuses = [client.post("/initiate-step-up/mobile-pin").status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    # A limit set to "off" is no limiter at all
+    monkeypatch.setattr(stronghold, "ip_limiter", None)
+    assert client.post("/initiate-step-up/mobile-pin").status_code == 200
+
+def test_register_push_links_subscription(client):
+    subscription = {"endpoint": "https://push.example/abc", "keys": {"p256dh": "k", "auth": "a"}}
+    response = client.post("/register-push", json={"subscription": subscription, "username": "gavin"})
+    assert response.json() == {"status": "success"}
+    assert stronghold.push_subscriptions.for_username("gavin") == [subscription]
+
+    assert client.post("/register-push", json={"keys": {}}).status_code == 400
+    stronghold.push_subscriptions.remove(subscription["endpoint"])
+
+
+def test_request_id_header(client):
+    response = client.get("/register-polling")
+    assert len(response.headers["x-request-id"]) == 32
+    response = client.get("/register-polling", headers={"X-Request-ID": "trace-123"})
+    assert response.headers["x-request-id"] == "trace-123"
+
+
+def test_metrics_cover_step_up(client):
+    session = client.post("/start-session", json={"username": "metrics"}).json()
+    with client.websocket_connect(f"/ws/{session['session_id']}") as ws:
+        assert stronghold.WS_CONNECTIONS.value() == 1
+        wrong = "0" * (len(session["pin"]) + 1)
+        client.post("/verify-pin-selection", json={"pin": wrong, "session_id": session["session_id"]})
+        client.post("/verify-pin-selection", json={"pin": session["pin"], "session_id": session["session_id"]})
+        ws.receive_json()
+        ws.receive_json()
+
+    text = client.get("/metrics").text
+    assert 'stronghold_pin_verifications_total{result="failure"}' in text
+    assert "stronghold_step_up_duration_seconds_count" in text
+    assert 'stronghold_request_duration_seconds_count{method="POST",route="/verify-pin-selection"}' in text
+    assert "stronghold_active_sessions" in text
+    assert "stronghold_event_loop_lag_seconds" in text
+
+
+def test_polling_cursor_survives_lost_responses(client):
+    client_id = client.get("/register-polling").json()["client_id"]
+    step_up_id = client.post(f"/initiate-step-up/{client_id}").json()["step_up_id"]
+    first = client.get(f"/poll-updates/{client_id}", params={"cursor": 0}).json()
+    client.post(f"/send-message/{step_up_id}", json={"content": "hello"})
+
+    # The previous response is treated as lost: asking from its cursor again
+    # returns just the newer event, twice over
+    for _ in range(2):
+        again = client.get(f"/poll-updates/{client_id}", params={"cursor": first["cursor"]}).json()
+        assert [e["type"] for e in again["events"]] == ["mobile_message"]
+        assert again["cursor"] > first["cursor"]
+
+
+def test_batched_poll_returns_every_session(client):
+    first, second = (client.get("/register-polling").json()["client_id"] for _ in range(2))
+    step_up_id = client.post(f"/initiate-step-up/{first}").json()["step_up_id"]
+    client.post(f"/send-message/{step_up_id}", json={"content": "hello"})
+
+    body = client.post("/poll-updates", json={"sessions": {first: 0, second: None, "unknown": None}}).json()
+    batches = body["sessions"]
+    assert [e["type"] for e in batches[first]["events"]] == ["step_up_initiated", "mobile_message"]
+    assert batches[second]["events"] == [] and batches["unknown"] == {"events": []}
+
+    # Resuming from the returned cursor gives nothing new
+    again = client.post("/poll-updates", json={"sessions": {first: batches[first]["cursor"]}}).json()
+    assert again["sessions"][first]["events"] == []
+    assert client.post("/poll-updates", json={"sessions": {first: "x"}}).status_code == 400
+
+    # The list form takes IDs only; anything unhashable or non-string is a 400, not a 500
+    listed = client.post("/poll-updates", json={"sessions": [first, second]}).json()["sessions"]
+    assert set(listed) == {first, second}
+    for bad in ([5], [["a"]], [{"a": 1}], [None], [first, 7]):
+        response = client.post("/poll-updates", json={"sessions": bad})
+        assert response.status_code == 400 and "sessions" in response.json()["error"]
+
+
+def test_sse_replays_after_last_event_id():
+    import httpx
+    import loadtest
+
+    async def scenario():
+        async with loadtest.LocalServer() as server, httpx.AsyncClient(base_url=server.url) as http:
+            async def read_event(lines):
+                fields = {}
+                async for line in lines:
+                    if not line:
+                        if "event" in fields:
+                            return fields
+                        fields = {}
+                    elif not line.startswith(":"):
+                        key, _, value = line.partition(": ")
+                        fields[key] = value
+
+            async with http.stream("GET", "/register-sse") as response:
+                lines = response.aiter_lines()
+                client_id = json.loads((await anext(lines))[len("data: "):])["client_id"]
+                step_up_id = (await http.post(f"/initiate-step-up/{client_id}")).json()["step_up_id"]
+                seen = await read_event(lines)
+
+            await http.post(f"/send-message/{step_up_id}", json={"content": "while away"})
+
+            async with http.stream("GET", "/register-sse", headers={"Last-Event-ID": seen["id"]}) as response:
+                lines = response.aiter_lines()
+                assert json.loads((await anext(lines))[len("data: "):])["client_id"] == client_id
+                return seen, await read_event(lines)
+
+    seen, replayed = asyncio.run(asyncio.wait_for(scenario(), 20))
+    assert seen["event"] == "step_up_initiated"
+    assert replayed["event"] == "mobile_message"
+    assert json.loads(replayed["data"])["data"] == "while away"
+
+
+def test_websocket_negotiates_permessage_deflate():
+    import loadtest
+    from websockets.asyncio.client import connect
+
+    async def scenario():
+        async with loadtest.LocalServer() as server:
+            url = server.url.replace("http", "ws") + "/ws/nobody"
+            async with connect(url, subprotocols=["stronghold.msgpack"]) as ws:
+                return ws.subprotocol, ws.response.headers.get("Sec-WebSocket-Extensions", "")
+
+    subprotocol, extensions = asyncio.run(asyncio.wait_for(scenario(), 20))
+    assert subprotocol == "stronghold.msgpack"
+    assert extensions.startswith("permessage-deflate")
+
+
+def test_admin_drain_needs_the_token_and_can_be_undone(client, monkeypatch):
+    # No token configured: only loopback clients (the test client isn't one)
+    assert client.post("/admin/drain").status_code == 403
+    monkeypatch.setattr(stronghold, "ADMIN_TOKEN", b"admin-secret")
+    assert client.post("/admin/drain", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    assert not stronghold.drainer.draining
+
+    admin = {"Authorization": "Bearer admin-secret"}
+    assert client.post("/admin/drain", headers=admin).json() == {"status": "drained", "remaining": 0}
+    assert stronghold.drainer.draining
+    assert client.delete("/admin/drain").status_code == 403
+    assert client.delete("/admin/drain", headers=admin).json() == {"status": "accepting"}
+    assert not stronghold.drainer.draining
+
+
+def test_shutdown_drains_sse_with_reconnect_hint():
+    import httpx
+    import loadtest
+
+    async def scenario():
+        async with loadtest.LocalServer() as server, httpx.AsyncClient(base_url=server.url) as http:
+            async with http.stream("GET", "/register-sse") as response:
+                lines = response.aiter_lines()
+                client_id = json.loads((await anext(lines))[len("data: "):])["client_id"]
+                await http.post(f"/initiate-step-up/{client_id}")
+                # SIGTERM, as in a rolling deploy
+                server.process.terminate()
+                events = []
+                fields = {}
+                async for line in lines:
+                    if not line:
+                        if "event" in fields:
+                            events.append(fields)
+                        fields = {}
+                    elif not line.startswith(":"):
+                        key, _, value = line.partition(": ")
+                        fields[key] = value
+                return events
+
+    events = asyncio.run(asyncio.wait_for(scenario(), 20))
+    # What was queued still arrives, then the stream ends with a spread-out retry hint
+    assert [e["event"] for e in events] == ["step_up_initiated", "reconnect"]
+    retry = int(events[-1]["retry"])
+    assert stronghold.RECONNECT_MIN <= retry <= stronghold.RECONNECT_MAX
+    assert json.loads(events[-1]["data"]) == {"type": "reconnect", "data": {"retry": retry}}
+
+def test_landing_page_supports_conditional_get(client):
+    page = client.get("/")
+    assert page.status_code == 200 and b"<html" in page.content
+    again = client.get("/", headers={"If-None-Match": page.headers["etag"]})
+    assert again.status_code == 304
@@ -0,0 +1,78 @@
+import gzip
+import json
+import os
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from assets import IMMUTABLE, MANIFEST_NAME, AssetFiles, build_assets
+
+STYLES = "body { background: url('/static/images/bg.png'); }\n" + "/* padding */\n" * 64
+
+
+def make_static(tmp_path):
+    source = tmp_path / "static"
+    (source / "css").mkdir(parents=True)
+    (source / "images").mkdir()
+    (source / "css" / "styles.css").write_text(STYLES)
+    (source / "images" / "bg.png").write_bytes(b"\x89PNG fake image")
+    (source / "sw.js").write_text("const ASSET_MANIFEST = self.ASSET_MANIFEST;\n")
+    (source / ".DS_Store").write_bytes(b"junk")
+    return source
+
+
+def test_build_hashes_files_and_rewrites_css(tmp_path):
+    source, output = make_static(tmp_path), tmp_path / "build"
+    manifest = build_assets(str(source), str(output))
+
+    image = manifest.files["images/bg.png"]
+    assert image.startswith("images/bg.") and image.endswith(".png")
+    assert manifest.url("images/bg.png") == "/static/" + image
+    assert manifest.url("sw.js") == "/static/sw.js"
+    assert ".DS_Store" not in manifest.files
+
+    css = (output / manifest.files["css/styles.css"]).read_text()
+    assert f"url('/static/{image}')" in css
+    assert gzip.decompress((output / (manifest.files["css/styles.css"] + ".gz")).read_bytes()).decode() == css
+
+    assert json.loads((output / MANIFEST_NAME).read_text())["version"] == manifest.version
+    assert (output / "sw.js").read_text().startswith("self.ASSET_MANIFEST = ")
+
+    # Rebuilding unchanged sources gives the same names; editing one renames it
+    assert build_assets(str(source), str(output)).files == manifest.files
+    (source / "images" / "bg.png").write_bytes(b"\x89PNG new image")
+    rebuilt = build_assets(str(source), str(output))
+    assert rebuilt.files["images/bg.png"] != image
+    assert rebuilt.files["css/styles.css"] != manifest.files["css/styles.css"]
+    assert rebuilt.version != manifest.version
+
+
+def test_asset_files_negotiate_encoding_and_caching(tmp_path):
+    source, output = make_static(tmp_path), tmp_path / "build"
+    manifest = build_assets(str(source), str(output))
+    app = FastAPI()
+    app.mount("/static", AssetFiles(str(source), str(output), manifest))
+    client = TestClient(app)
+
+    url = manifest.url("css/styles.css")
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"] == IMMUTABLE
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.headers["content-type"].startswith("text/css")
+    assert "/static/images/bg." in response.text
+
+    plain = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert plain.content == (output / manifest.files["css/styles.css"]).read_bytes()
+
+    # q-values count: q=0 refuses an encoding, and "*" covers unnamed ones
+    refused = client.get(url, headers={"Accept-Encoding": "gzip;q=0, identity"})
+    assert "content-encoding" not in refused.headers
+    assert client.get(url, headers={"Accept-Encoding": "*"}).headers["content-encoding"] == "gzip"
+    assert "content-encoding" not in client.get(url, headers={"Accept-Encoding": "*;q=0"}).headers
+
+    # Unhashed names still work but must be revalidated
+    original = client.get("/static/css/styles.css")
+    assert original.status_code == 200 and original.headers["cache-control"] == "no-cache"
+    assert client.get("/static/sw.js").text.startswith("self.ASSET_MANIFEST")
@@ -0,0 +1,43 @@
+from collections import Counter
+
+import pytest
+
+from challenges import ChallengeGenerator, EntropyPool
+
+
+def test_pins_have_the_configured_length():
+    generator = ChallengeGenerator(pin_length=4)
+    pins = [generator.pin() for _ in range(2000)]
+    assert all(len(pin) == 4 and pin.isdigit() and pin[0] != "0" for pin in pins)
+    assert len(generator.pin(6)) == 6
+    # Spread across the whole range, not stuck on a few values
+    assert len(set(pins)) > 1500
+
+
+def test_option_sets_are_distinct_and_include_the_pin():
+    generator = ChallengeGenerator(pin_length=2, options=5)
+    positions = Counter()
+    for _ in range(2000):
+        options = generator.option_set("42")
+        assert len(options) == len(set(options)) == 5
+        assert all(len(option) == 2 and 10 <= int(option) <= 99 for option in options)
+        positions[options.index("42")] += 1
+    # The correct PIN lands in every position
+    assert set(positions) == set(range(5))
+
+
+def test_option_set_is_capped_by_the_pin_range():
+    options = ChallengeGenerator(pin_length=1, options=20).option_set("7")
+    assert sorted(options) == [str(d) for d in range(10)]
+
+
+def test_pool_reads_entropy_in_blocks(monkeypatch):
+    calls = []
+    real = __import__("os").urandom
+    monkeypatch.setattr("challenges.os.urandom", lambda n: calls.append(n) or real(n))
+    pool = EntropyPool(block_size=64)
+    values = [pool.draw() for _ in range(20)]
+    assert calls == [64, 64, 64]
+    assert all(0 <= v < 2 ** 64 for v in values)
+    with pytest.raises(ValueError):
+        EntropyPool(block_size=10)
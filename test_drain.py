@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+from drain import Drainer
+from events import Event, WebSocketChannel
+from test_events import FakeWebSocket
+
+
+def test_drain_flushes_then_sends_reconnect():
+    async def scenario():
+        drainer = Drainer(timeout=1, retry_min=100, retry_max=200)
+        drainer.start()
+        websocket = FakeWebSocket()
+        channel = WebSocketChannel(websocket)
+        drainer.track(channel)
+        channel.deliver(Event.build("mobile_message", "queued"))
+
+        async def handler():
+            await channel.pump()
+            drainer.untrack(channel)
+
+        task = asyncio.create_task(handler())
+        remaining = await drainer.drain()
+        await task
+        await drainer.stop()
+        return remaining, drainer.draining, websocket
+
+    remaining, draining, websocket = asyncio.run(scenario())
+    assert remaining == 0 and draining
+    queued, reconnect = (json.loads(text) for text in websocket.sent)
+    assert queued["data"] == "queued"
+    assert reconnect["type"] == "reconnect" and 100 <= reconnect["data"]["retry"] <= 200
+    assert websocket.close_code == 1012
+
+
+def test_drain_gives_up_at_deadline():
+    async def scenario():
+        drainer = Drainer(timeout=0.05)
+        drainer.start()
+        drainer.track(WebSocketChannel(FakeWebSocket()))  # never goes away
+        remaining = await drainer.drain()
+        await drainer.stop()
+        return remaining
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_resume_accepts_connections_again():
+    async def scenario():
+        drainer = Drainer(timeout=5)
+        drainer.start()
+        drainer.track(WebSocketChannel(FakeWebSocket()))  # never goes away
+        drain = drainer.drain()
+        await asyncio.sleep(0)
+        assert drainer.draining
+        resumed = drainer.resume()
+        await asyncio.gather(drain, return_exceptions=True)
+        draining, cancelled = drainer.draining, drain.cancelled()
+        # A later drain starts afresh
+        again = await drainer.drain(timeout=0.01)
+        await drainer.stop()
+        return resumed, draining, cancelled, again
+
+    assert asyncio.run(scenario()) == (True, False, True, 1)
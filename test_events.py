@@ -0,0 +1,95 @@
+import asyncio
+import json
+
+from events import DISCONNECT, Event, EventBus, SSEChannel, WebSocketChannel, encode_batch
+from session_store import MemorySessionStore
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+def test_publish_serializes_once_for_every_channel():
+    async def scenario():
+        store = MemorySessionStore()
+        store.create(session_id="s1")
+        bus = EventBus(store)
+        sse, ws = SSEChannel(), WebSocketChannel(FakeWebSocket())
+        store.attach("s1", sse)
+        store.attach("s1", ws)
+
+        assert bus.publish("s1", {"type": "auth_complete", "data": {}}) == 3
+        seq, event = await sse.get()
+        assert (seq, event) == await ws.get()
+        return event, store.events("s1").drain()
+
+    event, polled = asyncio.run(scenario())
+    assert json.loads(event.payload) == {"type": "auth_complete", "data": {}}
+    assert polled == [event.payload]
+    assert json.loads(encode_batch(polled)) == {"events": [{"type": "auth_complete", "data": {}}]}
+
+
+def test_unknown_sessions_get_no_polling_queue():
+    store = MemorySessionStore()
+    assert EventBus(store).publish("nobody", {"type": "auth_complete"}) == 0
+    assert store.events("nobody", create=False) is None
+
+
+def test_full_channel_drops_oldest():
+    async def scenario():
+        channel = SSEChannel(maxsize=2)
+        for i in range(3):
+            channel.deliver(Event.build("mobile_message", i))
+        return channel.dropped, [json.loads((await channel.get())[1].payload)["data"] for _ in range(2)]
+
+    assert asyncio.run(scenario()) == (1, [1, 2])
+
+
+def test_websocket_pump_stops_on_close():
+    async def scenario():
+        websocket = FakeWebSocket()
+        channel = WebSocketChannel(websocket)
+        pump = asyncio.create_task(channel.pump())
+        channel.deliver(Event.build("auth_failed", {}))
+        channel.close()
+        await asyncio.wait_for(pump, 1)
+        return websocket.sent
+
+    assert asyncio.run(scenario()) == ['{"type":"auth_failed","data":{}}']
+
+
+def test_stuck_channel_is_disconnected_and_released():
+    async def scenario():
+        store = MemorySessionStore()
+        bus = EventBus(store)
+        slow = SSEChannel(maxsize=1, overflow=DISCONNECT)
+        store.attach("s1", slow)
+        bus.publish("s1", {"type": "mobile_message", "data": 1})
+        bus.publish("s1", {"type": "mobile_message", "data": 2})
+        _, first = await slow.get()
+        return slow.closed, store.subscribers("s1"), json.loads(first.payload)["data"], await slow.get()
+
+    closed, subscribers, first, end = asyncio.run(scenario())
+    assert closed and subscribers == []
+    # The consumer drains what it had, then sees the close
+    assert first == 1 and end is None
+
+
+def test_overflowed_websocket_is_closed():
+    async def scenario():
+        websocket = FakeWebSocket()
+        channel = WebSocketChannel(websocket, maxsize=1, overflow=DISCONNECT)
+        channel.deliver(Event.build("mobile_message", 1))
+        channel.deliver(Event.build("mobile_message", 2))
+        await asyncio.wait_for(channel.pump(), 1)
+        return websocket.close_code
+
+    assert asyncio.run(scenario()) == 1013
@@ -0,0 +1,92 @@
+import asyncio
+
+from expiry import EVICTIONS, ExpiryReaper
+from session_store import MemorySessionStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_store(**ttls):
+    clock = FakeClock()
+    reaper = ExpiryReaper(ttls={"session": 60, "step_up": 30, "polling": 10, **ttls}, clock=clock)
+    return MemorySessionStore(reaper), reaper, clock
+
+
+def test_expired_records_are_evicted():
+    store, reaper, clock = make_store()
+    store.create(session_id="s1", username="gavin", pin="42")
+    store.add_step_up("s1", "up1", "12345")
+    store.events("s1").append({"type": "auth_complete"})
+    before = EVICTIONS.value("session")
+
+    clock.now = 15
+    reaper.reap()
+    assert store.events("s1", create=False) is None
+    assert store.session_for_step_up("up1") == "s1"
+
+    clock.now = 45
+    reaper.reap()
+    assert store.session_for_step_up("up1") is None
+    assert store.session_for_username("gavin") == "s1"
+
+    clock.now = 61
+    reaper.reap()
+    assert store.get("s1") is None
+    assert store.session_for_username("gavin") is None
+    assert EVICTIONS.value("session") == before + 1
+    assert len(reaper) == 0
+
+
+def test_activity_rearms_the_deadline():
+    store, reaper, clock = make_store()
+    store.events("c1").append({"type": "step_up_initiated"})
+    clock.now = 8
+    store.events("c1", create=False)
+    clock.now = 12
+    reaper.reap()
+    assert store.events("c1", create=False) is not None
+
+
+def test_connected_sessions_are_kept():
+    store, reaper, clock = make_store()
+    store.create(session_id="s1")
+    store.attach("s1", object())
+    clock.now = 61
+    reaper.reap()
+    assert store.get("s1") is not None
+
+
+def test_deleted_sessions_leave_no_deadlines():
+    store, reaper, clock = make_store()
+    store.create(session_id="s1")
+    store.add_step_up("s1", "up1")
+    store.delete("s1")
+    assert len(reaper) == 0
+
+
+def test_reap_is_batched():
+    store, reaper, clock = make_store()
+    for i in range(10):
+        store.create(session_id=f"s{i}")
+    clock.now = 61
+    assert reaper.reap(limit=4) == 4
+    assert len(store) == 6
+
+
+def test_background_task_reaps():
+    async def scenario():
+        reaper = ExpiryReaper(ttls={"session": 0.01}, interval=0.01)
+        store = MemorySessionStore(reaper)
+        store.create(session_id="s1")
+        reaper.start()
+        await asyncio.sleep(0.05)
+        await reaper.stop()
+        return store
+
+    assert len(asyncio.run(scenario())) == 0
@@ -0,0 +1,67 @@
+import os
+
+from journal import Journal
+from session_store import JournaledSessionStore, create_session_store
+
+
+def test_journal_replays_after_snapshot(tmp_path):
+    state = {"items": []}
+    journal = Journal(str(tmp_path), lambda: {"items": list(state["items"])}, snapshot_every=3, fsync=False)
+    assert journal.load() == (None, [])
+    journal.start()
+    for i in range(5):
+        state["items"].append(i)
+        journal.append(["add", i])
+    journal.close()
+
+    reopened = Journal(str(tmp_path), dict, fsync=False)
+    snapshot, entries = reopened.load()
+    # Three entries were compacted into the snapshot; the rest are replayed
+    assert snapshot["items"] == [0, 1, 2]
+    assert entries == [["add", 3], ["add", 4]]
+    assert len([name for name in os.listdir(tmp_path) if name.startswith("journal-")]) == 1
+
+
+def test_torn_last_entry_is_ignored(tmp_path):
+    journal = Journal(str(tmp_path), dict, fsync=False)
+    journal.load()
+    journal.start()
+    journal.append(["add", 1])
+    journal.close()
+    with open(journal._path(journal.generation), "ab") as f:
+        f.write(b'["add", 2')
+
+    assert Journal(str(tmp_path), dict).load()[1] == [["add", 1]]
+
+
+def test_journaled_store_survives_restart(tmp_path):
+    store = create_session_store(f"journal:///{tmp_path}")
+    store.create(session_id="s1", username="gavin", pin="12")
+    store.create(session_id="s2", username="gavin", pin="34")
+    store.add_step_up("s2", "up-1", "99")
+    store.set_pin_options("s2", ["34", "71", "12"])
+    store.set_callback_url("s2", "https://rp.example/hook")
+    store.add_step_up("s2", "up-2")
+    store.remove_step_up("up-2")
+    store.create(session_id="gone")
+    store.delete("gone")
+    store.journal.flush(5)
+
+    # A crash without close(): only what was flushed is there, and it's enough
+    restarted = JournaledSessionStore(str(tmp_path), snapshot_every=2, fsync=False)
+    assert restarted.session_for_username("gavin") == "s2"
+    assert restarted.pin("s1") == "12"
+    assert restarted.pin_options("s2") == ["34", "71", "12"]
+    assert restarted.callback_url("s2") == "https://rp.example/hook"
+    assert restarted.step_up_pin("up-1") == "99"
+    assert restarted.session_for_step_up("up-2") is None
+    assert "gone" not in restarted and len(restarted) == 2
+
+    restarted.set_pin("s1", "56")
+    restarted.close()
+    reopened = JournaledSessionStore(str(tmp_path))
+    assert reopened.pin("s1") == "56"
+    # Restored from the snapshot this time
+    assert reopened.pin_options("s2") == ["34", "71", "12"]
+    assert reopened.callback_url("s2") == "https://rp.example/hook"
+    reopened.close()
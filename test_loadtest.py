@@ -0,0 +1,22 @@
+import asyncio
+
+import pytest
+
+import loadtest
+
+
+@pytest.mark.parametrize("transport", loadtest.TRANSPORTS)
+def test_step_up_flow_under_load(transport):
+    result = asyncio.run(loadtest.run_transport(transport, users=20, timeout=20))
+    assert result["errors"] == 0, result["first_error"]
+    assert result["completed"] == 20
+    assert result["step_up_p99_ms"] is not None
+
+
+def test_format_results_handles_missing_values():
+    table = loadtest.format_results([{
+        "transport": "sse", "completed": 0, "errors": 1, "throughput": 0.0, "first_error": "boom",
+        "connect_p50_ms": None, "step_up_p50_ms": None, "step_up_p95_ms": None,
+        "step_up_p99_ms": None, "step_up_max_ms": None, "memory_per_session_kb": None,
+    }])
+    assert "sse: first error: boom" in table
@@ -0,0 +1,50 @@
+import io
+import json
+import logging
+
+from logging_config import (DeferredQueueHandler, RedactingFilter, StructuredFormatter,
+                            redact)
+
+
+def test_redact_masks_pins():
+    assert redact('{"pin": "1234"}') == '{"pin": "****"}'
+    assert redact("Generated PIN 482913 for step_up_id abc") == "Generated PIN **** for step_up_id abc"
+    # This app's PINs are two digits
+    assert redact("correct_pin=55") == "correct_pin=****"
+    assert redact('{"pin": "42"}') == '{"pin": "****"}'
+    assert redact("Generated PIN 42 for client abc") == "Generated PIN **** for client abc"
+    assert redact("PIN verification failed for session 12345") == "PIN verification failed for session 12345"
+
+
+def test_queue_handler_defers_formatting():
+    class Lazy:
+        calls = 0
+
+        def __str__(self):
+            Lazy.calls += 1
+            return "lazy"
+
+    record = logging.makeLogRecord({"msg": "value %s", "args": (Lazy(),)})
+    prepared = DeferredQueueHandler(None).prepare(record)
+    assert prepared is record
+    assert Lazy.calls == 0
+
+
+def test_structured_output_is_redacted_json():
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.addFilter(RedactingFilter())
+    handler.setFormatter(StructuredFormatter())
+    record = logging.makeLogRecord({
+        "name": "app", "levelno": logging.INFO, "levelname": "INFO",
+        "msg": "user entered pin %s", "args": ("9876",), "path": "/verify-pin",
+    })
+    handler.handle(record)
+    entry = json.loads(stream.getvalue())
+    assert entry["message"] == "user entered pin ****"
+    assert entry["level"] == "INFO"
+    assert entry["path"] == "/verify-pin"
+
+
+def test_redact_leaves_paths_alone():
+    assert redact("POST /generate-pin 200 5.3ms") == "POST /generate-pin 200 5.3ms"
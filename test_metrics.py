@@ -0,0 +1,76 @@
+import asyncio
+
+from metrics import Counter, Gauge, Histogram, LatencyTracker, LoopLagMonitor, Registry
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    latency = Histogram("latency_seconds", "Latency", labelnames=("route",),
+                        registry=registry, buckets=(0.1, 1))
+    route = latency.labels("/a")
+    route.observe(0.05)
+    route.observe(0.5)
+    route.observe(5)
+    text = registry.render()
+    assert '# TYPE latency_seconds histogram' in text
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{route="/a",le="1"} 2' in text
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 3' in text
+    assert 'latency_seconds_count{route="/a"} 3' in text
+    assert latency.value("/a") == 3
+
+
+def test_gauges_and_counters():
+    registry = Registry()
+    connections = Gauge("connections", "Open connections", registry=registry)
+    connections.inc()
+    connections.inc()
+    connections.dec()
+    depth = Gauge("depth", "Queue depth", registry=registry, function=lambda: 7)
+    results = Counter("results_total", "Results", labelnames=("result",), registry=registry)
+    success = results.labels("success")
+    success.inc()
+    success.inc()
+    assert connections.value() == 1
+    assert depth.value() == 7
+    assert results.value("success") == 2
+    text = registry.render()
+    assert "depth 7" in text
+    assert 'results_total{result="success"} 2' in text
+
+
+def test_values_keep_full_precision_and_labels_are_escaped():
+    registry = Registry()
+    requests = Counter("requests_total", "Requests", labelnames=("path",), registry=registry)
+    requests.inc(1234567, 'a"b\\c\nd')
+    Gauge("ratio", "Ratio", registry=registry).set(0.1234567891)
+    text = registry.render()
+    assert 'requests_total{path="a\\"b\\\\c\\nd"} 1234567\n' in text
+    assert "ratio 0.1234567891\n" in text
+
+
+def test_latency_tracker_is_bounded():
+    now = [0.0]
+    histogram = Histogram("tracked_seconds", "Tracked", registry=Registry())
+    tracker = LatencyTracker(histogram, max_pending=2, clock=lambda: now[0])
+    for key in ("a", "b", "c"):
+        tracker.start(key)
+    assert len(tracker) == 2
+    now[0] = 1.5
+    assert tracker.stop("a") is None  # forgotten
+    assert tracker.stop("c") == 1.5
+    assert tracker.stop("c") is None
+    assert histogram.value() == 1
+
+
+def test_loop_lag_monitor_records_wakeups():
+    histogram = Histogram("lag_seconds", "Lag", registry=Registry())
+
+    async def run():
+        monitor = LoopLagMonitor(interval=0.01, histogram=histogram)
+        monitor.start()
+        await asyncio.sleep(0.05)
+        await monitor.stop()
+
+    asyncio.run(run())
+    assert histogram.value() >= 1
@@ -0,0 +1,101 @@
+import asyncio
+import base64
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from py_vapid import Vapid
+
+from push import PushDispatcher
+
+
+class StubPushService(BaseHTTPRequestHandler):
+    """Answers each endpoint path with a scripted list of statuses"""
+    scripts = {}
+    hits = {}
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        statuses = self.scripts.get(self.path, [201])
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def push_service():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubPushService)
+    StubPushService.scripts, StubPushService.hits = {}, {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", StubPushService
+    server.shutdown()
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def subscription(base_url, path):
+    key = ec.generate_private_key(ec.SECP256R1()).public_key()
+    p256dh = key.public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+    return {"endpoint": base_url + path, "keys": {"p256dh": b64(p256dh), "auth": b64(os.urandom(16))}}
+
+
+def make_dispatcher(**kwargs):
+    vapid = Vapid()
+    vapid.generate_keys()
+    return PushDispatcher(vapid, {"sub": "mailto:test@example.com"}, backoff=0.01, **kwargs)
+
+
+def test_delivers_retries_and_prunes(push_service):
+    base_url, service = push_service
+    service.scripts = {"/ok": [201], "/flaky": [503, 201], "/gone": [410], "/bad": [400]}
+    gone = []
+    dispatcher = make_dispatcher(on_gone=gone.append)
+
+    subs = [subscription(base_url, path) for path in ("/ok", "/flaky", "/gone", "/bad")]
+    results = asyncio.run(dispatcher.send_many(subs, "hello"))
+    dispatcher.close()
+
+    assert results == [True, True, False, False]
+    assert service.hits == {"/ok": 1, "/flaky": 2, "/gone": 1, "/bad": 1}
+    assert [sub["endpoint"] for sub in gone] == [base_url + "/gone"]
+
+
+def test_gives_up_after_retries(push_service):
+    base_url, service = push_service
+    service.scripts = {"/down": [500]}
+    dispatcher = make_dispatcher(retries=2)
+    assert asyncio.run(dispatcher.send(subscription(base_url, "/down"), "hello")) is False
+    dispatcher.close()
+    assert service.hits["/down"] == 3
+
+
+def test_registry_indexes_and_bounds():
+    from push import SubscriptionRegistry
+
+    registry = SubscriptionRegistry(max_size=3, per_username=2)
+    registry.add({"endpoint": "https://push/1", "keys": {}}, "gavin", "s1")
+    registry.add({"endpoint": "https://push/2", "keys": {}}, "gavin", "s2")
+    # Re-registering an endpoint moves it rather than duplicating it
+    registry.add({"endpoint": "https://push/1", "keys": {"auth": "x"}}, "gavin", "s3")
+    assert len(registry) == 2
+    assert registry.for_session("s1") == []
+    assert registry.for_session("s3") == [{"endpoint": "https://push/1", "keys": {"auth": "x"}}]
+
+    # A third device for the same user pushes out the oldest
+    registry.add({"endpoint": "https://push/3", "keys": {}}, "gavin")
+    assert [s["endpoint"] for s in registry.for_username("gavin")] == ["https://push/1", "https://push/3"]
+
+    registry.add({"endpoint": "https://push/4", "keys": {}}, "alice")
+    registry.add({"endpoint": "https://push/5", "keys": {}}, "bob")
+    assert len(registry) == 3
+    assert registry.for_username("gavin") == [{"endpoint": "https://push/3", "keys": {}}]
@@ -0,0 +1,57 @@
+import pytest
+
+from ratelimit import RateLimiter, parse_limit, retry_after
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_burst_then_refills():
+    clock = Clock()
+    limiter = RateLimiter(rate=2, burst=3, clock=clock)
+    assert [limiter.allow("a") for _ in range(4)] == [True, True, True, False]
+    assert limiter.acquire("a") == 0.5
+    assert limiter.allow("b")  # other keys are unaffected
+
+    clock.now = 0.5
+    assert limiter.allow("a") and not limiter.allow("a")
+
+
+def test_idle_buckets_expire():
+    clock = Clock()
+    limiter = RateLimiter(rate=1, burst=2, clock=clock)
+    for key in range(100):
+        limiter.allow(key)
+    assert len(limiter) == 100
+    clock.now = 2
+    limiter.allow("fresh")
+    assert len(limiter) == 1
+
+    capped = RateLimiter(rate=1, burst=2, clock=clock, max_keys=10)
+    for key in range(50):
+        capped.allow(key)
+    assert len(capped) <= 11
+
+
+def test_retry_after_stops_at_first_refusal():
+    clock = Clock()
+    ip = RateLimiter(rate=1, burst=1, clock=clock)
+    user = RateLimiter(rate=1, burst=5, clock=clock)
+    assert retry_after((ip, "1.2.3.4"), (user, "gavin"), (None, "x"), (user, None)) == 0
+    assert retry_after((ip, "1.2.3.4"), (user, "gavin")) == 1
+    # The refused request didn't cost the username bucket anything
+    assert user.acquire("gavin", cost=4) == 0
+
+
+def test_parse_limit():
+    assert parse_limit("0.2/5") == (0.2, 5)
+    assert parse_limit("10") == (10, 10)
+    assert parse_limit("0") is None and parse_limit("off") is None
+    for bad in ("0/5", "-1/5", "1/0", "nan/5", "inf", "x"):
+        with pytest.raises(ValueError):
+            parse_limit(bad)
@@ -0,0 +1,56 @@
+from starlette.requests import Request
+
+from render_cache import TemplateCache
+
+
+def make_request(if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+def test_pages_are_rendered_once_and_revalidated(tmp_path):
+    (tmp_path / "page.html").write_text("<p>{{ greeting }}</p>")
+    cache = TemplateCache(str(tmp_path))
+    page = cache.page("page.html", greeting="<hi>")
+    assert cache.warm() == 1
+
+    (tmp_path / "page.html").write_text("changed")
+    response = page.response(make_request())
+    assert response.body == b"<p>&lt;hi&gt;</p>"  # still the pre-rendered, escaped bytes
+    etag = response.headers["etag"]
+
+    not_modified = page.response(make_request(f'"other", W/{etag}'))
+    assert not_modified.status_code == 304 and not_modified.body == b""
+    assert not_modified.headers["etag"] == etag
+
+
+def test_auto_reload_and_uncached_pages_render_every_time(tmp_path):
+    (tmp_path / "page.html").write_text("one")
+    cache = TemplateCache(str(tmp_path), auto_reload=True)
+    assert cache.render("page.html").body == b"one"
+    (tmp_path / "page.html").write_text("two")
+    assert cache.render("page.html").body == b"two"
+    assert len(cache) == 0
+
+
+def test_variants_are_bounded(tmp_path):
+    (tmp_path / "page.html").write_text("{{ username }}")
+    cache = TemplateCache(str(tmp_path), max_entries=2)
+    for username in ("a", "b", "c"):
+        cache.render("page.html", username=username)
+    assert len(cache) == 2
+    assert cache.render("page.html", cache=False, username={"not": "hashable"}).body
+
+
+def test_declared_pages_survive_variant_churn(tmp_path):
+    (tmp_path / "page.html").write_text("{{ username }}")
+    cache = TemplateCache(str(tmp_path), max_entries=2)
+    home = cache.page("page.html", username="home")
+    cache.warm()
+    pinned = home.response(make_request()).body
+    (tmp_path / "page.html").write_text("re-rendered {{ username }}")
+    for username in ("a", "b", "c", "d"):
+        cache.render("page.html", username=username)
+    # Still the pre-rendered bytes: the variants never evicted it
+    assert home.response(make_request()).body == pinned
+    assert len(cache) == 3
@@ -0,0 +1,22 @@
+import json
+
+from events import AUTH_COMPLETE, AUTH_FAILED
+from serialization import JSONResponse, dumps, loads
+
+
+def test_dumps_matches_compact_stdlib_output():
+    payload = {"session_id": "abc", "pins": ["12", "34"], "data": {"n": 1, "ok": True, "none": None}, "é": "ü"}
+    assert dumps(payload) == json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+    assert loads(dumps(payload)) == payload
+
+
+def test_dumps_falls_back_for_what_orjson_rejects():
+    assert dumps({"big": 2 ** 70}) == b'{"big":1180591620717411303424}'
+
+
+def test_response_and_fixed_events():
+    response = JSONResponse({"success": True}, status_code=201)
+    assert response.body == b'{"success":true}' and response.status_code == 201
+    assert response.headers["content-type"] == "application/json"
+    assert AUTH_COMPLETE.payload == b'{"type":"auth_complete","data":{}}'
+    assert loads(AUTH_FAILED.payload) == {"type": "auth_failed", "data": {}}
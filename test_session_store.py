@@ -0,0 +1,187 @@
+import asyncio
+
+import pytest
+
+from expiry import ExpiryReaper
+
+from session_store import (MemorySessionStore, PollingQueue, SQLiteSessionStore, create_session_store,
+                           next_sequence, resume_point, wait_any)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        store = MemorySessionStore()
+    else:
+        store = SQLiteSessionStore(str(tmp_path / "sessions.db"))
+    yield store
+    store.close()
+
+
+def test_indexes_follow_records(store):
+    store.create(session_id="s1", username="gavin", pin="42")
+    store.add_step_up("s1", "up1", "12345")
+
+    assert store.session_for_username("gavin") == "s1"
+    assert store.session_for_step_up("up1") == "s1"
+    assert store.pin("s1") == "42"
+    assert store.step_up_pin("up1") == "12345"
+    assert dict(store.step_up_pins()) == {"up1": "12345"}
+
+    store.delete("s1")
+    assert store.get("s1") is None
+    assert store.session_for_username("gavin") is None
+    assert store.session_for_step_up("up1") is None
+    assert len(store) == 0
+
+
+def test_new_session_takes_over_username(store):
+    store.create(session_id="old", username="gavin", pin="11")
+    store.create(session_id="new", username="gavin", pin="22")
+    assert store.session_for_username("gavin") == "new"
+
+    # Deleting the superseded session must not drop the live mapping
+    store.delete("old")
+    assert store.session_for_username("gavin") == "new"
+    assert [(u, r.session_id) for u, r in store.active_sessions()] == [("gavin", "new")]
+
+
+def test_pin_options_are_kept_until_the_pin_changes(store):
+    store.create(session_id="s1", username="gavin", pin="42")
+    assert store.pin_options("s1") is None
+    store.set_pin_options("s1", ["17", "42", "80"])
+    assert store.pin_options("s1") == ["17", "42", "80"]
+    assert store.get("s1").pin_options == ["17", "42", "80"]
+
+    store.set_pin("s1", "55")
+    assert store.pin_options("s1") is None
+    store.delete("s1")
+    assert store.pin_options("s1") is None
+
+
+def test_callback_url_lives_on_the_record(store):
+    store.create(session_id="s1", username="gavin", pin="42")
+    assert store.callback_url("s1") is None
+    store.set_callback_url("s1", "https://rp.example/hook")
+    assert store.callback_url("s1") == "https://rp.example/hook"
+    assert store.get("s1").callback_url == "https://rp.example/hook"
+
+    store.set_callback_url("s1", None)
+    assert store.callback_url("s1") is None
+    # Only existing sessions get one
+    store.set_callback_url("missing", "https://rp.example/hook")
+    assert store.callback_url("missing") is None and "missing" not in store
+
+
+def test_channels_are_released_on_delete(store):
+    channel = object()
+    store.create(session_id="s1")
+    store.attach("s1", channel)
+    store.events("s1").append({"type": "auth_complete"})
+
+    store.detach("s1", object())  # a stale channel doesn't evict the live one
+    assert store.subscribers("s1") == [channel]
+
+    store.delete("s1")
+    assert store.subscribers("s1") == []
+    assert store.events("s1", create=False) is None
+
+
+def test_sqlite_store_survives_reopen(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SQLiteSessionStore(path)
+    store.create(session_id="s1", username="gavin", pin="42")
+    store.close()
+
+    store = create_session_store(f"sqlite:///{path}")
+    assert store.session_for_username("gavin") == "s1"
+    assert store.pin("s1") == "42"
+    store.close()
+
+
+def test_shared_sqlite_store_only_expires_idle_sessions(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    first, second = (SQLiteSessionStore(path, reaper=ExpiryReaper(ttls={"session": 60})) for _ in range(2))
+    first.create(session_id="s1", username="gavin", pin="42")
+    second.attach("s1", object())
+
+    # Worker one's TTL is up, but the session was used (here, connected) elsewhere since
+    assert first._expire_session("s1") is False
+    first._write(("UPDATE sessions SET last_seen = 0 WHERE session_id = ?", ("s1",)))
+    # Worker two still has it connected, and says so
+    assert second._expire_session("s1") is False
+    assert first._expire_session("s1") is False
+
+    second.detach("s1", second.subscribers("s1")[0])
+    first._write(("UPDATE sessions SET last_seen = 0 WHERE session_id = ?", ("s1",)))
+    assert first._expire_session("s1") is True
+    assert second.get("s1") is None
+    first.close()
+    second.close()
+
+
+def test_store_urls():
+    store = create_session_store("sqlite:///")
+    assert store.path == ":memory:"
+    store.close()
+    with pytest.raises(ValueError):
+        create_session_store("sqlite://memory:")
+
+
+def test_polling_queue_wakes_waiter():
+    async def scenario():
+        queue = PollingQueue()
+        waiter = asyncio.create_task(queue.wait(5))
+        await asyncio.sleep(0)
+        queue.append({"type": "auth_complete"})
+        woke = await asyncio.wait_for(waiter, 1)
+        return woke, queue.drain(), await queue.wait(0.01)
+
+    woke, events, woke_again = asyncio.run(scenario())
+    assert woke and events == [{"type": "auth_complete"}]
+    assert not woke_again
+
+
+def test_wait_any_wakes_on_first_queue_with_events():
+    async def scenario():
+        quiet, busy = PollingQueue(), PollingQueue()
+        waiter = asyncio.create_task(wait_any([(quiet, None), (busy, None)], timeout=5))
+        await asyncio.sleep(0)
+        busy.append(b"{}")
+        woke = await asyncio.wait_for(waiter, 1)
+        return woke, await wait_any([(quiet, None)], timeout=0.01)
+
+    assert asyncio.run(scenario()) == (True, False)
+
+
+def test_polling_queue_replays_from_cursor():
+    queue = PollingQueue(maxlen=3)
+    first = queue.append(b"1")
+    queue.append(b"2")
+    events, cursor = queue.read()
+    assert events == [b"1", b"2"]
+
+    # A client whose response got lost asks again from its old cursor
+    assert queue.read(first) == ([b"2"], cursor)
+    assert queue.read() == ([], cursor)
+
+    for payload in (b"3", b"4", b"5"):
+        queue.append(payload)
+    assert queue.read(0)[0] == [b"3", b"4", b"5"]  # only the newest are kept
+    assert len(queue) == 0
+
+
+def test_events_from_other_workers_are_filed_in_order():
+    queue = PollingQueue(maxlen=3)
+    early, late = next_sequence(), next_sequence()
+    queue.append(b"late", late)
+    queue.append(b"early", early)  # published first, on another worker
+    assert queue.read(0) == ([b"early", b"late"], late)
+    assert queue.read(early) == ([b"late"], late)
+
+
+def test_stale_cursor_replays_everything():
+    seq = PollingQueue().append(b"x")
+    assert resume_point(seq) == seq
+    assert resume_point(seq + 10 ** 12) == 0  # no worker could have issued it
+    assert resume_point(None) == 0
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from webhooks import (ID_HEADER, SIGNATURE_HEADER, MemoryOutbox, SQLiteOutbox, WebhookDispatcher, create_outbox,
+                      sign, verify_signature)
+
+SECRET = b"test-secret"
+
+
+class StubReceiver:
+    """Local HTTP server answering webhook POSTs with scripted statuses"""
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.requests = []
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                receiver.requests.append((dict(self.headers), body))
+                self.send_response(receiver.statuses.pop(0) if receiver.statuses else 200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/hook"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def deliver_until(dispatcher, done, timeout=5):
+    async def scenario():
+        dispatcher.start()
+        deadline = time.monotonic() + timeout
+        while not done() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await dispatcher.stop()
+
+    asyncio.run(scenario())
+
+
+def test_signature_round_trip():
+    header = sign(SECRET, 1000, b"{}")
+    assert verify_signature(SECRET, header, b"{}", now=1010)
+    assert not verify_signature(SECRET, header, b"{ }", now=1010)
+    assert not verify_signature(b"other", header, b"{}", now=1010)
+    assert not verify_signature(SECRET, header, b"{}", now=5000)
+    assert not verify_signature(SECRET, "garbage", b"{}")
+
+
+def test_dispatcher_retries_until_delivered():
+    outbox = MemoryOutbox()
+    dispatcher = WebhookDispatcher(outbox, SECRET, backoff=0.01)
+    with StubReceiver([503, 503]) as receiver:
+        dispatcher.enqueue(receiver.url, {"id": "evt-1", "type": "auth_complete"})
+        deliver_until(dispatcher, lambda: len(outbox) == 0)
+
+    assert len(receiver.requests) == 3
+    headers, body = receiver.requests[-1]
+    assert json.loads(body) == {"id": "evt-1", "type": "auth_complete"}
+    assert headers[ID_HEADER] == "evt-1"
+    assert verify_signature(SECRET, headers[SIGNATURE_HEADER], body)
+
+
+def test_dispatcher_gives_up_on_client_errors():
+    outbox = MemoryOutbox()
+    dispatcher = WebhookDispatcher(outbox, SECRET, backoff=0.01)
+    with StubReceiver([400]) as receiver:
+        dispatcher.enqueue(receiver.url, {"id": "evt-1"})
+        deliver_until(dispatcher, lambda: len(outbox) == 0)
+    assert len(receiver.requests) == 1
+
+
+def test_dispatcher_survives_unexpected_errors():
+    class FlakyOutbox(MemoryOutbox):
+        failures = 1
+
+        def due(self, now, limit):
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("database is locked")
+            return super().due(now, limit)
+
+    outbox = FlakyOutbox()
+    dispatcher = WebhookDispatcher(outbox, SECRET, backoff=0.01, poll_interval=0.05)
+    with StubReceiver([]) as receiver:
+        # httpx raises InvalidURL (not an HTTPError) for this one: dropped, not retried
+        dispatcher.enqueue("http://[not-a-host/hook", {"id": "evt-bad"})
+        dispatcher.enqueue(receiver.url, {"id": "evt-good"})
+        deliver_until(dispatcher, lambda: len(outbox) == 0)
+    assert len(outbox) == 0 and len(receiver.requests) == 1
+
+
+def test_sqlite_outbox_survives_restart(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    with StubReceiver([]) as receiver:
+        # Queued by a process that stops before sending it
+        WebhookDispatcher(SQLiteOutbox(path), SECRET).enqueue(receiver.url, {"id": "evt-1"})
+
+        outbox = create_outbox(f"sqlite:///{path}")
+        assert [d.id for d in outbox.due(time.time(), 10)] == ["evt-1"]
+        deliver_until(WebhookDispatcher(outbox, SECRET), lambda: len(outbox) == 0)
+    assert len(receiver.requests) == 1
+
+
+def test_unknown_outbox_url():
+    with pytest.raises(ValueError):
+        create_outbox("redis://nope")
@@ -0,0 +1,30 @@
+import pytest
+
+import wire
+from events import AUTH_COMPLETE, Event
+
+
+def test_values_round_trip():
+    value = {"n": [0, 127, 128, 65536, 2 ** 40, -1, -33, -200, -(2 ** 40)], "f": 1.5, "s": "é" * 40,
+             "b": b"\x00\xff", "none": None, "flags": [True, False], "nested": {"k": list(range(20))}}
+    assert wire.unpackb(wire.packb(value)) == value
+
+
+def test_matches_messagepack_spec_encoding():
+    assert wire.packb([3, {}]) == b"\x92\x03\x80"
+    assert wire.packb({"retry": 1500}) == b"\x81\xa5retry\xcd\x05\xdc"
+    assert wire.packb([None, True, -1]) == b"\x93\xc0\xc3\xff"
+
+
+def test_events_use_integer_codes():
+    assert AUTH_COMPLETE.packed == b"\x92\x03\x80"
+    assert len(AUTH_COMPLETE.packed) < len(AUTH_COMPLETE.payload)
+    assert wire.decode_message(Event.build("custom", {"a": 1}).packed) == {"type": "custom", "data": {"a": 1}}
+    with pytest.raises(ValueError):
+        wire.unpackb(b"\x92\x03\x80\x00")
+
+
+def test_negotiate():
+    assert wire.negotiate(["other", "stronghold.msgpack"]) == (wire.MSGPACK, "stronghold.msgpack")
+    assert wire.negotiate([], "msgpack") == (wire.MSGPACK, None)
+    assert wire.negotiate(None) == (wire.JSON, None)
@@ -49,14 +49,8 @@ class MobileStepUp {
             document.getElementById('pin-email').textContent = username;
             
             window.mobileDebug.log('Checking for active session');
-            window.mobileDebug.log('API Call - POST /get-pin-options');
-            const response = await fetch('/get-pin-options', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ username })
-            });
+            window.mobileDebug.log('API Call - GET /get-pin-options');
+            const response = await fetch(`/get-pin-options?username=${encodeURIComponent(username)}`);
             
             if (!response.ok) {
                 window.mobileDebug.error(`Server returned status: ${response.status}`);
@@ -178,13 +172,18 @@ class MobileStepUp {
                 applicationServerKey: this.urlBase64ToUint8Array(vapidPublicKey)
             });
 
-            // Send subscription to server
+            // Send subscription to server, linked to this user and session
+            const usernameInput = document.getElementById('username-input');
             await fetch('/register-push', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify(subscription)
+                body: JSON.stringify({
+                    subscription: subscription.toJSON(),
+                    username: usernameInput ? usernameInput.value.trim() : null,
+                    session_id: this.sessionId
+                })
             });
             
             console.log('Push notification subscription successful');
@@ -215,13 +214,7 @@ class MobileStepUp {
             window.mobileDebug.log(`Handling PIN selection for username: ${username}`);
             
             // Get session ID from active session
-            const response = await fetch('/get-pin-options', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ username })
-            });
+            const response = await fetch(`/get-pin-options?username=${encodeURIComponent(username)}`);
             
             if (!response.ok) {
                 throw new Error('Failed to get session info');
@@ -387,13 +380,7 @@ class MobileStepUp {
         
         try {
             // Check for active session
-            const response = await fetch('/get-pin-options', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ username })
-            });
+            const response = await fetch(`/get-pin-options?username=${encodeURIComponent(username)}`);
             
             if (response.ok) {
                 // Session exists, show yes/no options
@@ -1,9 +1,101 @@
+// Compact binary WebSocket frames (see wire.py): [eventCode, data] in MessagePack
+const WIRE_SUBPROTOCOL = 'stronghold.msgpack';
+const EVENT_NAMES = {
+  1: 'step_up_initiated',
+  2: 'mobile_message',
+  3: 'auth_complete',
+  4: 'auth_failed',
+  5: 'cleanup_session',
+  6: 'step_up_completed',
+  7: 'reconnect'
+};
+
+function unpackMessagePack(buffer) {
+  const view = new DataView(buffer);
+  const bytes = new Uint8Array(buffer);
+  const text = new TextDecoder();
+  let pos = 0;
+
+  const str = (length) => {
+    const value = text.decode(bytes.subarray(pos, pos + length));
+    pos += length;
+    return value;
+  };
+  const bin = (length) => {
+    pos += length;
+    return bytes.slice(pos - length, pos);
+  };
+  const array = (length) => {
+    const items = [];
+    for (let i = 0; i < length; i++) items.push(next());
+    return items;
+  };
+  const map = (length) => {
+    const result = {};
+    for (let i = 0; i < length; i++) {
+      const key = next();
+      result[key] = next();
+    }
+    return result;
+  };
+  const read = (size, getter) => {
+    const value = getter.call(view, pos);
+    pos += size;
+    return value;
+  };
+  const next = () => {
+    const tag = bytes[pos++];
+    if (tag < 0x80) return tag;
+    if (tag >= 0xe0) return tag - 0x100;
+    if (tag >= 0xa0 && tag <= 0xbf) return str(tag & 0x1f);
+    if (tag >= 0x90 && tag <= 0x9f) return array(tag & 0x0f);
+    if (tag >= 0x80 && tag <= 0x8f) return map(tag & 0x0f);
+    switch (tag) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xca: return read(4, view.getFloat32);
+      case 0xcb: return read(8, view.getFloat64);
+      case 0xcc: return read(1, view.getUint8);
+      case 0xcd: return read(2, view.getUint16);
+      case 0xce: return read(4, view.getUint32);
+      case 0xcf: return Number(read(8, view.getBigUint64));
+      case 0xd0: return read(1, view.getInt8);
+      case 0xd1: return read(2, view.getInt16);
+      case 0xd2: return read(4, view.getInt32);
+      case 0xd3: return Number(read(8, view.getBigInt64));
+      case 0xd9: return str(read(1, view.getUint8));
+      case 0xda: return str(read(2, view.getUint16));
+      case 0xdb: return str(read(4, view.getUint32));
+      case 0xc4: return bin(read(1, view.getUint8));
+      case 0xc5: return bin(read(2, view.getUint16));
+      case 0xc6: return bin(read(4, view.getUint32));
+      case 0xdc: return array(read(2, view.getUint16));
+      case 0xdd: return array(read(4, view.getUint32));
+      case 0xde: return map(read(2, view.getUint16));
+      case 0xdf: return map(read(4, view.getUint32));
+    }
+    throw new Error(`Unsupported MessagePack type 0x${tag.toString(16)}`);
+  };
+  return next();
+}
+
+// A WebSocket message as {type, data}, whichever format the server sent
+function decodeWireMessage(payload) {
+  if (typeof payload === 'string') {
+    return JSON.parse(payload);
+  }
+  const [code, data] = unpackMessagePack(payload);
+  return { type: EVENT_NAMES[code] || code, data };
+}
+
 class Stronghold {
   constructor() {
     this.eventSource = null;
     this.containerElement = null;
     this.timerInterval = null;
     this.pollingInterval = null;
+    this.longPollTimeout = 25;  // Seconds the server may hold each poll open
     this.clientId = null;
     this.currentClientId = null;  // Store the current client ID
     this.sessionId = null;
@@ -80,13 +172,14 @@ class Stronghold {
       const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
       const wsUrl = `${wsProtocol}//${window.location.host}/ws/${this.sessionId}`;
       console.log('Connecting to WebSocket URL:', wsUrl);
-      this.ws = new WebSocket(wsUrl);
+      this.ws = new WebSocket(wsUrl, [WIRE_SUBPROTOCOL]);
+      this.ws.binaryType = 'arraybuffer';
       
       this.ws.onmessage = (event) => {
         console.log('WebSocket message received:', event.data);
         let data;
         try {
-          data = JSON.parse(event.data);
+          data = decodeWireMessage(event.data);
         } catch (e) {
           console.error('Failed to parse WebSocket message:', e);
           return;
@@ -98,6 +191,9 @@ class Stronghold {
         } else if (data.type === 'auth_failed') {
           console.log('Received auth_failed via WebSocket');
           this.handleAuthFailed();
+        } else if (data.type === 'reconnect') {
+          // The server is restarting; it picks a delay so clients don't all return at once
+          this.reconnectAfter = data.data.retry;
         }
       };
       
@@ -113,6 +209,14 @@ class Stronghold {
       
       this.ws.onclose = () => {
         console.log('WebSocket connection closed');
+        if (this.reconnectAfter !== undefined) {
+          const delay = this.reconnectAfter;
+          this.reconnectAfter = undefined;
+          console.log(`Reconnecting WebSocket in ${delay}ms`);
+          setTimeout(() => this.setupWebSocket().catch(error => {
+            console.error('WebSocket reconnect failed:', error);
+          }), delay);
+        }
       };
     });
   }
@@ -218,7 +322,8 @@ class Stronghold {
       this.ws.close();
     }
 
-    this.ws = new WebSocket(`wss://${window.location.host}/ws/${this.sessionId}`);
+    this.ws = new WebSocket(`wss://${window.location.host}/ws/${this.sessionId}`, [WIRE_SUBPROTOCOL]);
+    this.ws.binaryType = 'arraybuffer';
     console.log('WebSocket connection initialized with session ID:', this.sessionId);
 
     this.ws.onopen = () => {
@@ -266,6 +371,7 @@ class Stronghold {
     // Clear any existing polling interval
     if (this.pollingInterval) {
       clearInterval(this.pollingInterval);
+      this.pollingInterval = null;
     }
     
     // Close WebSocket connection
@@ -333,16 +439,29 @@ class Stronghold {
       clearInterval(this.pollingInterval);
     }
     
-    console.log('Setting up polling for session:', this.sessionId);
-    this.pollingInterval = setInterval(async () => {
+    console.log('Setting up long-polling for session:', this.sessionId);
+    // pollingInterval holds a token for the running loop; clearing or
+    // replacing it stops the loop after the in-flight request returns
+    const token = {};
+    this.pollingInterval = token;
+    this.longPoll(token);
+  }
+
+  async longPoll(token) {
+    while (this.pollingInterval === token) {
       try {
         console.log('Polling for updates...');
-        const response = await fetch(`/poll-updates/${this.sessionId}`);
+        // Resume from the last cursor so events from a lost response are sent again
+        const cursor = this.pollCursor !== undefined ? `&cursor=${this.pollCursor}` : '';
+        const response = await fetch(`/poll-updates/${this.sessionId}?wait=${this.longPollTimeout}${cursor}`);
         if (!response.ok) {
           throw new Error(`HTTP error! status: ${response.status}`);
         }
         const updates = await response.json();
         console.log('Polling received updates:', updates);
+        if (updates.cursor !== undefined) {
+          this.pollCursor = updates.cursor;
+        }
         
         if (updates.events && updates.events.length > 0) {
           updates.events.forEach(event => {
@@ -350,15 +469,17 @@ class Stronghold {
             if (event.type === 'auth_complete') {
               console.log('Received auth_complete event, handling...');
               this.handleAuthComplete();
-              // Clear polling interval after successful auth
-              clearInterval(this.pollingInterval);
+              // Stop polling after successful auth
+              this.pollingInterval = null;
             }
           });
         }
       } catch (error) {
         console.error('Polling error:', error);
+        // Back off before retrying so a failing server isn't hammered
+        await new Promise(resolve => setTimeout(resolve, 1000));
       }
-    }, 1000);
+    }
   }
 
   setupEventListeners() {
@@ -367,7 +488,7 @@ class Stronghold {
     this.ws.onmessage = (event) => {
       console.log('Message received:', event.data);
       try {
-        const message = JSON.parse(event.data);
+        const message = decodeWireMessage(event.data);
         if (message.type === 'auth_complete') {
           this.handleAuthComplete();
         } else if (message.type === 'auth_failed') {
@@ -1,24 +1,58 @@
-const CACHE_NAME = 'jpm-digital-v1';
+// The asset build (assets.py) prepends self.ASSET_MANIFEST; served straight
+// from v2/static there is none and the original file names are cached instead.
+const ASSET_MANIFEST = self.ASSET_MANIFEST || { version: 'dev', files: {} };
+const CACHE_PREFIX = 'jpm-digital-';
+const CACHE_NAME = CACHE_PREFIX + ASSET_MANIFEST.version;
+
+const asset = path => '/static/' + (ASSET_MANIFEST.files[path] || path);
+
 const urlsToCache = [
   '/mobile',
-  '/static/css/styles.css',
-  '/static/mobile.js',
-  '/static/components/login-form.js',
-  '/static/JPMorganLogo.png',
-  '/static/icons/icon-192x192.png',
-  '/static/icons/icon-512x512.png'
+  asset('css/styles.css'),
+  asset('mobile.js'),
+  asset('components/login-form.js'),
+  asset('JPMorganLogo.png'),
+  asset('icons/icon-192x192.png'),
+  asset('icons/icon-512x512.png')
 ];
 
 self.addEventListener('install', event => {
   event.waitUntil(
     caches.open(CACHE_NAME)
       .then(cache => cache.addAll(urlsToCache))
+      .then(() => self.skipWaiting())
+  );
+});
+
+// Drop the caches of earlier builds
+self.addEventListener('activate', event => {
+  event.waitUntil(
+    caches.keys()
+      .then(names => Promise.all(names
+        .filter(name => name.startsWith(CACHE_PREFIX) && name !== CACHE_NAME)
+        .map(name => caches.delete(name))))
+      .then(() => self.clients.claim())
   );
 });
 
 self.addEventListener('fetch', event => {
+  // Pages reference the current asset names, so fetch them fresh when online
+  if (event.request.mode === 'navigate') {
+    event.respondWith(
+      fetch(event.request)
+        .then(response => {
+          if (response.ok) {
+            const copy = response.clone();
+            caches.open(CACHE_NAME).then(cache => cache.put(event.request, copy));
+          }
+          return response;
+        })
+        .catch(() => caches.match(event.request))
+    );
+    return;
+  }
   event.respondWith(
     caches.match(event.request)
       .then(response => response || fetch(event.request))
   );
-}); 
\ No newline at end of file
+});
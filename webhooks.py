@@ -0,0 +1,365 @@
+"""
+Signed webhook callbacks for server-to-server step-ups.
+
+A relying party that creates a step-up through the API registers a callback
+URL; when the step-up completes or fails the result is written to an outbox
+and WebhookDispatcher POSTs it from a background task over a pooled
+httpx.AsyncClient. Failed deliveries (network errors, 408/429/5xx) stay in
+the outbox and are retried with jittered exponential backoff; other 4xx
+responses are final. With a SQLite outbox, deliveries that were pending when
+the process stopped are sent after it starts again.
+
+Delivery is at-least-once: receivers should de-duplicate on the payload's
+"id" (also sent as the Stronghold-Webhook-Id header). Each body is signed
+with HMAC-SHA256 over "<timestamp>.<body>" and sent as
+
+    Stronghold-Signature: t=<unix timestamp>,v1=<hex digest>
+
+which `verify_signature` checks on the receiving side.
+
+Callback URLs come from API clients, so `check_callback_url` only accepts
+http(s) URLs whose host resolves to public addresses: the server must not
+be usable to POST into its own network (loopback, private, link-local and
+other reserved ranges). Hosts listed in STRONGHOLD_WEBHOOK_ALLOWED_HOSTS
+skip the check, for receivers that really are internal.
+"""
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Collection, Dict, List, Optional
+
+import httpx
+
+from metrics import Counter
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_RESULTS = Counter(
+    "stronghold_webhook_deliveries_total",
+    "Webhook delivery attempts by outcome",
+    labelnames=("result",),
+)
+for _result in ("sent", "retried", "failed"):
+    WEBHOOK_RESULTS.inc(0, _result)
+
+SIGNATURE_HEADER = "Stronghold-Signature"
+ID_HEADER = "Stronghold-Webhook-Id"
+
+# Statuses worth retrying; any other non-2xx response is final
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+ALLOWED_HOSTS = frozenset(host.strip().lower()
+                          for host in os.environ.get("STRONGHOLD_WEBHOOK_ALLOWED_HOSTS", "").split(",")
+                          if host.strip())
+
+
+def is_public_address(address: str) -> bool:
+    """False for loopback, private, link-local, multicast and otherwise reserved addresses"""
+    ip = ipaddress.ip_address(address)
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+async def check_callback_url(url: str, allowed_hosts: Optional[Collection[str]] = None) -> Optional[str]:
+    """Why `url` can't be used as a callback, or None if it can"""
+    if allowed_hosts is None:
+        allowed_hosts = ALLOWED_HOSTS
+    try:
+        parsed = httpx.URL(url)
+    except (httpx.InvalidURL, TypeError, ValueError):
+        return "callback_url is not a valid URL"
+    if parsed.scheme not in ("http", "https") or not parsed.host:
+        return "callback_url must be an http(s) URL"
+    host = parsed.host.lower()
+    if host in allowed_hosts:
+        return None
+    try:
+        addresses = [ipaddress.ip_address(host).compressed]
+    except ValueError:
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, parsed.port)
+        except OSError:
+            return "callback_url host does not resolve"
+        addresses = [info[4][0] for info in infos]
+    if not addresses or not all(is_public_address(address.split("%")[0]) for address in addresses):
+        return "callback_url must point at a public address"
+    return None
+
+
+def sign(secret: bytes, timestamp: int, body: bytes) -> str:
+    """Value of the Stronghold-Signature header for `body` sent at `timestamp`"""
+    digest = hmac.new(secret, b"%d." % timestamp + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def verify_signature(secret: bytes, header: str, body: bytes, tolerance: float = 300,
+                     now: Optional[float] = None) -> bool:
+    """Check a Stronghold-Signature header; stale timestamps are rejected to stop replays"""
+    try:
+        fields = dict(part.split("=", 1) for part in header.split(","))
+        timestamp = int(fields["t"])
+    except (KeyError, ValueError):
+        return False
+    if abs((time.time() if now is None else now) - timestamp) > tolerance:
+        return False
+    return hmac.compare_digest(sign(secret, timestamp, body), header)
+
+
+class Delivery:
+    """One pending webhook in the outbox"""
+    __slots__ = ("id", "url", "body", "attempts", "next_attempt")
+
+    def __init__(self, id: str, url: str, body: bytes, attempts: int = 0, next_attempt: float = 0):
+        self.id = id
+        self.url = url
+        self.body = body
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+
+
+class Outbox:
+    """Deliveries that have not succeeded (or been given up on) yet"""
+
+    def add(self, delivery: Delivery) -> None:
+        raise NotImplementedError
+
+    def due(self, now: float, limit: int) -> List[Delivery]:
+        """Up to `limit` deliveries whose next attempt is at or before `now`, oldest first"""
+        raise NotImplementedError
+
+    def next_due(self) -> Optional[float]:
+        """When the earliest delivery is due, or None if the outbox is empty"""
+        raise NotImplementedError
+
+    def reschedule(self, delivery: Delivery) -> None:
+        raise NotImplementedError
+
+    def remove(self, delivery_id: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryOutbox(Outbox):
+    """Outbox for a single process; pending deliveries are lost on restart"""
+
+    def __init__(self):
+        self._deliveries: "OrderedDict[str, Delivery]" = OrderedDict()
+
+    def add(self, delivery):
+        self._deliveries[delivery.id] = delivery
+
+    def due(self, now, limit):
+        due = [d for d in self._deliveries.values() if d.next_attempt <= now]
+        due.sort(key=lambda d: d.next_attempt)
+        return due[:limit]
+
+    def next_due(self):
+        return min((d.next_attempt for d in self._deliveries.values()), default=None)
+
+    def reschedule(self, delivery):
+        if delivery.id in self._deliveries:
+            self._deliveries[delivery.id] = delivery
+
+    def remove(self, delivery_id):
+        self._deliveries.pop(delivery_id, None)
+
+    def __len__(self):
+        return len(self._deliveries)
+
+
+class SQLiteOutbox(Outbox):
+    """Outbox in a local SQLite file, so pending deliveries survive restarts"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS webhook_outbox (
+            id           TEXT PRIMARY KEY,
+            url          TEXT NOT NULL,
+            body         BLOB NOT NULL,
+            attempts     INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS webhook_outbox_due ON webhook_outbox (next_attempt);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def add(self, delivery):
+        self._execute("INSERT OR REPLACE INTO webhook_outbox VALUES (?, ?, ?, ?, ?)",
+                      (delivery.id, delivery.url, delivery.body, delivery.attempts, delivery.next_attempt))
+
+    def due(self, now, limit):
+        rows = self._execute("SELECT id, url, body, attempts, next_attempt FROM webhook_outbox "
+                             "WHERE next_attempt <= ? ORDER BY next_attempt LIMIT ?", (now, limit))
+        return [Delivery(*row) for row in rows]
+
+    def next_due(self):
+        return self._execute("SELECT MIN(next_attempt) FROM webhook_outbox")[0][0]
+
+    def reschedule(self, delivery):
+        self._execute("UPDATE webhook_outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+                      (delivery.attempts, delivery.next_attempt, delivery.id))
+
+    def remove(self, delivery_id):
+        self._execute("DELETE FROM webhook_outbox WHERE id = ?", (delivery_id,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM webhook_outbox")[0][0]
+
+
+def create_outbox(url: Optional[str] = None) -> Outbox:
+    """
+    Build an outbox from a URL: "memory" (the default) or "sqlite:///path/to.db".
+    Falls back to the STRONGHOLD_WEBHOOK_OUTBOX environment variable.
+    """
+    url = url or os.environ.get("STRONGHOLD_WEBHOOK_OUTBOX", "memory")
+    if url == "memory":
+        return MemoryOutbox()
+    if url.startswith("sqlite:///"):
+        return SQLiteOutbox(url[len("sqlite:///"):] or ":memory:")
+    raise ValueError(f"Unknown webhook outbox: {url}")
+
+
+class WebhookDispatcher:
+    """Delivers outbox entries from a background task with pooled connections"""
+
+    def __init__(self, outbox: Outbox, secret: bytes, max_connections: int = 64,
+                 max_attempts: int = 8, backoff: float = 1, max_backoff: float = 300,
+                 timeout: float = 10, poll_interval: float = 30,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.outbox = outbox
+        self.secret = secret
+        self.max_connections = max_connections
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def enqueue(self, url: str, payload: Dict) -> Delivery:
+        """Store a delivery in the outbox; it is sent as soon as the dispatcher runs"""
+        body = dumps(payload)
+        delivery = Delivery(payload["id"], url, body, next_attempt=time.time())
+        self.outbox.add(delivery)
+        self._wakeup.set()
+        return delivery
+
+    async def deliver(self, delivery: Delivery) -> bool:
+        """One attempt; True once the delivery has left the outbox (sent or given up)"""
+        timestamp = int(time.time())
+        headers = {
+            "Content-Type": "application/json",
+            SIGNATURE_HEADER: sign(self.secret, timestamp, delivery.body),
+            ID_HEADER: delivery.id,
+        }
+        status = None
+        final = False
+        try:
+            response = await self._client.post(delivery.url, content=delivery.body, headers=headers)
+            status = response.status_code
+            if 200 <= status < 300:
+                WEBHOOK_RESULTS.inc(1, "sent")
+                self.outbox.remove(delivery.id)
+                return True
+        except httpx.HTTPError as e:
+            logger.debug("Webhook to %s failed: %s", delivery.url, e)
+        except Exception as e:
+            # Not a network problem (a URL httpx can't use, say): retrying won't help
+            logger.error("Webhook to %s could not be sent: %s", delivery.url, e)
+            final = True
+
+        delivery.attempts += 1
+        if (final or (status is not None and status not in RETRY_STATUSES)
+                or delivery.attempts >= self.max_attempts):
+            WEBHOOK_RESULTS.inc(1, "failed")
+            logger.error("Giving up on webhook %s to %s after %s attempts (status %s)",
+                         delivery.id, delivery.url, delivery.attempts, status)
+            self.outbox.remove(delivery.id)
+            return True
+        WEBHOOK_RESULTS.inc(1, "retried")
+        # Full jitter keeps retries for a failing receiver from arriving together
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** (delivery.attempts - 1))))
+        delivery.next_attempt = time.time() + delay
+        self.outbox.reschedule(delivery)
+        return False
+
+    async def run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                due = self.outbox.due(time.time(), self.max_connections)
+                if due:
+                    results = await asyncio.gather(*(self.deliver(delivery) for delivery in due),
+                                                   return_exceptions=True)
+                    errors = [result for result in results if isinstance(result, Exception)]
+                    if not errors:
+                        continue
+                    # deliver() handles send failures, so this is the outbox itself; back off
+                    raise errors[0]
+                next_due = self.outbox.next_due()
+            except Exception as e:
+                # Keep dispatching; whatever is pending stays in the outbox for the next pass
+                logger.error("Webhook dispatcher error: %s", e)
+                next_due = None
+            timeout = self.poll_interval if next_due is None else max(next_due - time.time(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), min(timeout, self.poll_interval))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> asyncio.Task:
+        if self._client is None:
+            limits = httpx.Limits(max_connections=self.max_connections,
+                                  max_keepalive_connections=self.max_connections)
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=limits, transport=self._transport)
+        if self._task is None or self._task.done():
+            # Bound to the running loop; anything queued before now is picked up by run()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self) -> None:
+        """Stop sending; whatever is still pending stays in the outbox"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
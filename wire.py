@@ -0,0 +1,231 @@
+"""
+Compact binary wire format for WebSocket clients.
+
+Clients that ask for it (the "stronghold.msgpack" WebSocket subprotocol, or
+?encoding=msgpack) get each event as a MessagePack array of an integer event
+code and the event's data instead of a JSON text frame:
+
+    {"type":"auth_complete","data":{}}   34 bytes of JSON
+    [3, {}]                               3 bytes of MessagePack
+
+and may send their own messages the same way. Event types without a code are
+sent as [type, data]. The `msgpack` package is used when installed;
+otherwise the small encoder and decoder below cover the types events carry
+(None, bool, int, float, str, bytes, list, dict).
+
+SSE is a UTF-8 text format, so SSE streams keep sending JSON.
+"""
+import struct
+from typing import Any, Tuple
+
+try:
+    import msgpack
+except ImportError:  # optional: built-in encoder
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+SUBPROTOCOLS = {"stronghold.msgpack": MSGPACK, "stronghold.json": JSON}
+
+# Stable codes; only ever append (stronghold.js has the same table)
+EVENT_CODES = {
+    "step_up_initiated": 1,
+    "mobile_message": 2,
+    "auth_complete": 3,
+    "auth_failed": 4,
+    "cleanup_session": 5,
+    "step_up_completed": 6,
+    "reconnect": 7,
+}
+EVENT_TYPES = {code: name for name, code in EVENT_CODES.items()}
+
+
+def negotiate(subprotocols, encoding: str = None) -> Tuple[str, str]:
+    """
+    (encoding, subprotocol to accept) for a WebSocket handshake: the first
+    subprotocol we know wins, then the ?encoding= parameter, then JSON.
+    """
+    for subprotocol in subprotocols or ():
+        if subprotocol in SUBPROTOCOLS:
+            return SUBPROTOCOLS[subprotocol], subprotocol
+    return (MSGPACK if encoding == MSGPACK else JSON), None
+
+
+# -- MessagePack ---------------------------------------------------------------
+
+def _pack(obj: Any, out: bytearray) -> None:
+    if obj is None:
+        out.append(0xC0)
+    elif obj is True:
+        out.append(0xC3)
+    elif obj is False:
+        out.append(0xC2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xFF)
+        elif 0 <= obj < 2 ** 64:
+            for limit, fmt, tag in ((2 ** 8, ">B", 0xCC), (2 ** 16, ">H", 0xCD), (2 ** 32, ">I", 0xCE),
+                                    (2 ** 64, ">Q", 0xCF)):
+                if obj < limit:
+                    out.append(tag)
+                    out += struct.pack(fmt, obj)
+                    break
+        elif -(2 ** 63) <= obj < 0:
+            for limit, fmt, tag in ((2 ** 7, ">b", 0xD0), (2 ** 15, ">h", 0xD1), (2 ** 31, ">i", 0xD2),
+                                    (2 ** 63, ">q", 0xD3)):
+                if obj >= -limit:
+                    out.append(tag)
+                    out += struct.pack(fmt, obj)
+                    break
+        else:
+            raise ValueError(f"Integer out of range: {obj}")
+    elif isinstance(obj, float):
+        out.append(0xCB)
+        out += struct.pack(">d", obj)
+    elif isinstance(obj, str):
+        data = obj.encode()
+        size = len(data)
+        if size < 32:
+            out.append(0xA0 | size)
+        elif size < 2 ** 8:
+            out += b"\xd9" + struct.pack(">B", size)
+        elif size < 2 ** 16:
+            out += b"\xda" + struct.pack(">H", size)
+        else:
+            out += b"\xdb" + struct.pack(">I", size)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        size = len(obj)
+        if size < 2 ** 8:
+            out += b"\xc4" + struct.pack(">B", size)
+        elif size < 2 ** 16:
+            out += b"\xc5" + struct.pack(">H", size)
+        else:
+            out += b"\xc6" + struct.pack(">I", size)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        _header(len(obj), 0x90, 0xDC, out)
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        _header(len(obj), 0x80, 0xDE, out)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError(f"Cannot pack {type(obj).__name__}")
+
+
+def _header(size: int, fix: int, tag16: int, out: bytearray) -> None:
+    if size < 16:
+        out.append(fix | size)
+    elif size < 2 ** 16:
+        out.append(tag16)
+        out += struct.pack(">H", size)
+    else:
+        out.append(tag16 + 1)
+        out += struct.pack(">I", size)
+
+
+def _unpack(data: bytes, pos: int) -> Tuple[Any, int]:
+    tag = data[pos]
+    pos += 1
+    if tag < 0x80:
+        return tag, pos
+    if tag >= 0xE0:
+        return tag - 0x100, pos
+    if 0xA0 <= tag <= 0xBF:
+        end = pos + (tag & 0x1F)
+        return data[pos:end].decode(), end
+    if 0x90 <= tag <= 0x9F:
+        return _unpack_array(data, pos, tag & 0x0F)
+    if 0x80 <= tag <= 0x8F:
+        return _unpack_map(data, pos, tag & 0x0F)
+    if tag == 0xC0:
+        return None, pos
+    if tag in (0xC2, 0xC3):
+        return tag == 0xC3, pos
+    fixed = _FIXED.get(tag)
+    if fixed is not None:
+        fmt, size = fixed
+        return struct.unpack_from(fmt, data, pos)[0], pos + size
+    if tag in _SIZED:
+        fmt, size, kind = _SIZED[tag]
+        length = struct.unpack_from(fmt, data, pos)[0]
+        pos += size
+        if kind == "str":
+            return data[pos:pos + length].decode(), pos + length
+        if kind == "bin":
+            return bytes(data[pos:pos + length]), pos + length
+        if kind == "array":
+            return _unpack_array(data, pos, length)
+        return _unpack_map(data, pos, length)
+    raise ValueError(f"Unsupported MessagePack type 0x{tag:02x}")
+
+
+def _unpack_array(data, pos, length):
+    items = []
+    for _ in range(length):
+        item, pos = _unpack(data, pos)
+        items.append(item)
+    return items, pos
+
+
+def _unpack_map(data, pos, length):
+    result = {}
+    for _ in range(length):
+        key, pos = _unpack(data, pos)
+        result[key], pos = _unpack(data, pos)
+    return result, pos
+
+
+_FIXED = {
+    0xCA: (">f", 4), 0xCB: (">d", 8),
+    0xCC: (">B", 1), 0xCD: (">H", 2), 0xCE: (">I", 4), 0xCF: (">Q", 8),
+    0xD0: (">b", 1), 0xD1: (">h", 2), 0xD2: (">i", 4), 0xD3: (">q", 8),
+}
+_SIZED = {
+    0xD9: (">B", 1, "str"), 0xDA: (">H", 2, "str"), 0xDB: (">I", 4, "str"),
+    0xC4: (">B", 1, "bin"), 0xC5: (">H", 2, "bin"), 0xC6: (">I", 4, "bin"),
+    0xDC: (">H", 2, "array"), 0xDD: (">I", 4, "array"),
+    0xDE: (">H", 2, "map"), 0xDF: (">I", 4, "map"),
+}
+
+
+if msgpack is not None:
+    def packb(obj: Any) -> bytes:
+        return msgpack.packb(obj)
+
+    def unpackb(data: bytes) -> Any:
+        return msgpack.unpackb(data)
+else:
+    def packb(obj: Any) -> bytes:
+        out = bytearray()
+        _pack(obj, out)
+        return bytes(out)
+
+    def unpackb(data: bytes) -> Any:
+        obj, end = _unpack(data, 0)
+        if end != len(data):
+            raise ValueError("Trailing data after MessagePack value")
+        return obj
+
+
+# -- events ------------------------------------------------------------------
+
+def encode_event(event_type: str, data: Any) -> bytes:
+    """[code, data] frame for an event"""
+    return packb([EVENT_CODES.get(event_type, event_type), data])
+
+
+def decode_message(frame: bytes) -> dict:
+    """A client's binary frame back into a {"type", "data"} message"""
+    message = unpackb(frame)
+    if isinstance(message, list) and len(message) == 2:
+        code, data = message
+        return {"type": EVENT_TYPES.get(code, code), "data": data}
+    if isinstance(message, dict):
+        return message
+    raise ValueError("Expected a [code, data] frame")